@@ -1,34 +1,144 @@
-from flask import Flask, render_template, request, send_file, jsonify
-from pytubefix import YouTube
+from flask import Flask, Blueprint, render_template, request, send_file, jsonify, Response, stream_with_context, g
+from werkzeug.security import safe_join
+from werkzeug.exceptions import HTTPException
+from urllib.parse import quote
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import os
 import threading
 import time
-from datetime import datetime
 import json
 import ssl
 import subprocess
 import shutil
+import uuid
+import socket
+import re
+import hmac
+from contextlib import nullcontext
 
-# Исправление проблемы с SSL сертификатами на macOS
-# Это отключает проверку SSL сертификатов (для разработки)
-ssl._create_default_https_context = ssl._create_unverified_context
+from download_pool import DownloadPool, QueueFullError
+from video_cache import VideoInfoCache
+from result_store import ResultStore, SQLiteResultStore
+from fetcher import StreamFetcher, LiveFile, DEFAULT_HEADERS, EXPIRED_URL_CODES
+from http_client import HTTPClient, BandwidthShaper, SharedBandwidthShaper
+from progress import ProgressTracker, parse_ffmpeg_progress
+from storage import StorageManager, SQLiteStorageManager
+from thumbnails import ThumbnailCache, MAX_THUMBNAIL_SIZE
+from metrics import REGISTRY, CONTENT_TYPE, THROUGHPUT_BUCKETS, Counter, Gauge, Histogram
+from ffmpeg_probe import probe_ffmpeg
+from muxing import merge_timeout, low_priority, FFmpegWatchdog
+from clip import fetch_clip, cut_clip, parse_clip_options
+from transcode import transcode_file, parse_audio_options, audio_extension, AUDIO_FORMATS
+from batch import BatchRunner, iter_zip, unique_name, is_playlist_url, is_channel_url
+from job_store import Job, MemoryJobStore, SQLiteJobStore, FINISHED_STATUSES, ACTIVE_STATUSES
 
-app = Flask(__name__)
+# Маршруты приложения; само приложение собирает create_app()
+bp = Blueprint('downloader', __name__)
 
-# Конфигурация
-app.config['DOWNLOAD_FOLDER'] = 'downloads'
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB limit
-app.config['SECRET_KEY'] = 'your-secret-key-change-this'
+# Настройки и компоненты процесса создаются в create_app(), а не при импорте:
+# импорт модуля дешевый, pytubefix загружается при первом извлечении видео
+config = None
+job_store = None
+download_pool = None
+video_cache = None
+info_extractor = None
+result_store = None
+storage = None
+http_client = None
+bandwidth = None
+thumbnail_cache = None
+stream_fetcher = None
+ffmpeg_info = None
+flask_app = None
+flask_app_lock = threading.Lock()
 
-# Создаем папку для загрузок
-if not os.path.exists(app.config['DOWNLOAD_FOLDER']):
-    os.makedirs(app.config['DOWNLOAD_FOLDER'])
+# Идентификатор этого процесса: по нему видно, чьи задачи остались без владельца
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
-# Хранилище для статуса загрузок
-download_status = {}
+# Файлы, которые еще скачиваются и уже могут отдаваться клиенту (download_id -> LiveFile)
+live_files = {}
 
-def merge_video_audio(video_path, audio_path, output_path):
+# Пакеты, задачи которых еще ставятся в очередь (batch_id -> BatchRunner)
+batch_runners = {}
+
+# Метрики для Prometheus (GET /metrics). Счетчики компонентов читаются в момент запроса
+STAGE_SECONDS = Histogram(
+    'ytdl_stage_seconds', 'Длительность этапов загрузки', ['stage']
+)
+FFMPEG_SECONDS = Histogram(
+    'ytdl_ffmpeg_seconds', 'Время работы ffmpeg (без ожидания свободного слота)', ['operation']
+)
+DOWNLOAD_THROUGHPUT = Histogram(
+    'ytdl_download_throughput_bytes_per_second', 'Средняя скорость скачивания потоков с YouTube',
+    ['stage'], buckets=THROUGHPUT_BUCKETS
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'ytdl_http_request_seconds', 'Время обработки HTTP-запросов', ['endpoint', 'method', 'status']
+)
+DOWNLOADS_TOTAL = Counter(
+    'ytdl_downloads_total', 'Завершенные загрузки по результату', ['result']
+)
+ERRORS_TOTAL = Counter(
+    'ytdl_errors_total', 'Ошибки загрузок по типу исключения', ['type']
+)
+Gauge('ytdl_queue_depth', 'Загрузки в очереди пула',
+      callback=lambda: download_pool.stats()['queued'])
+Gauge('ytdl_workers_busy', 'Занятые потоки пула и слоты ffmpeg', ['kind'],
+      callback=lambda: {(kind,): download_pool.stats()[kind] for kind in ('active', 'merging', 'transcoding')})
+Gauge('ytdl_threads', 'Потоки процесса', callback=threading.active_count)
+Gauge('ytdl_info_cache_entries', 'Видео в кэше метаданных',
+      callback=lambda: video_cache.stats()['entries'])
+Gauge('ytdl_info_cache_hit_ratio', 'Доля попаданий в кэш метаданных',
+      callback=lambda: video_cache.stats()['hit_ratio'])
+Counter('ytdl_info_cache_requests_total', 'Обращения к кэшу метаданных', ['result'],
+        callback=lambda: {(result,): video_cache.stats()[key] for result, key in (('hit', 'hits'), ('miss', 'misses'))})
+Counter('ytdl_result_store_requests_total', 'Запросы готовых файлов', ['result'],
+        callback=lambda: {(result,): result_store.stats()[key]
+                          for result, key in (('hit', 'hits'), ('coalesced', 'coalesced'), ('miss', 'misses'))})
+Gauge('ytdl_storage_bytes', 'Место, занятое готовыми файлами',
+      callback=lambda: storage.stats()['total_bytes'])
+Counter('ytdl_storage_evictions_total', 'Файлы, вытесненные при нехватке места',
+        callback=lambda: storage.stats()['evictions'])
+Counter('ytdl_http_connections_total', 'Соединения к серверам потоков: новые и взятые из пула', ['result'],
+        callback=lambda: {(result,): http_client.stats()[result] for result in ('created', 'reused')})
+Counter('ytdl_thumbnail_requests_total', 'Запросы превью: из кэша и со скачиванием', ['result'],
+        callback=lambda: {(result,): thumbnail_cache.stats()[key] for result, key in (('hit', 'hits'), ('miss', 'misses'))})
+Counter('ytdl_bandwidth_throttled_seconds_total', 'Суммарное ожидание из-за ограничения скорости',
+        callback=lambda: bandwidth.stats()['throttled_seconds'])
+
+def observe_fetch(stage, started, nbytes):
+    """Записывает длительность этапа со скачиванием и среднюю скорость скачивания"""
+    elapsed = time.perf_counter() - started
+    STAGE_SECONDS.observe(elapsed, stage=stage)
+    if nbytes and elapsed > 0:
+        DOWNLOAD_THROUGHPUT.observe(nbytes / elapsed, stage=stage)
+
+def load_video(url):
+    """Извлекает видео через pytubefix. Он импортируется здесь, а не при запуске: это самый тяжелый импорт"""
+    from pytubefix import YouTube
+    return YouTube(url)
+
+def ffmpeg_problems():
+    """Почему ffmpeg этого узла не годится для загрузок (пустой список - годится)"""
+    if not ffmpeg_info.available:
+        return [ffmpeg_info.error]
+    missing = ffmpeg_info.missing(config['FFMPEG_REQUIRED_MUXERS'], config['FFMPEG_REQUIRED_ENCODERS'])
+    return [f"ffmpeg без поддержки {', '.join(missing)}"] if missing else []
+
+def available_audio_formats():
+    """Форматы перекодирования аудио, для которых у ffmpeg есть кодек и контейнер"""
+    return [audio_format for audio_format, (codec, container, _) in AUDIO_FORMATS.items()
+            if codec in ffmpeg_info.encoders and container in ffmpeg_info.muxers]
+
+def ffmpeg_timeout(nbytes):
+    """Таймаут ffmpeg для входа размером nbytes: большим 4K-видео нужно больше времени"""
+    return merge_timeout(nbytes, config['MERGE_TIMEOUT'], config['MERGE_MIN_RATE'])
+
+def merge_video_audio(video_path, audio_path, output_path, duration=None, on_progress=None, timeout=None):
     """Объединяет видео и аудио потоки через ffmpeg"""
+    timeout = timeout or config['MERGE_TIMEOUT']
     try:
         # Проверяем, что входные файлы существуют
         if not os.path.exists(video_path):
@@ -45,17 +155,34 @@ def merge_video_audio(video_path, audio_path, output_path):
             '-c:a', 'copy',  # Копируем аудио без перекодирования
             '-y',  # Перезаписывать выходной файл если существует
             '-loglevel', 'error',  # Только ошибки
+            '-progress', 'pipe:1',  # Прогресс в stdout в формате key=value
+            '-nostats',
             output_path
         ]
         
-        # Запускаем ffmpeg
-        result = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True,
-            timeout=300  # Таймаут 5 минут
-        )
+        # Запускаем ffmpeg с пониженным приоритетом и читаем прогресс, пока он работает
+        process = subprocess.Popen(low_priority(cmd, config['FFMPEG_NICE']), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr_output = []
+        stderr_reader = threading.Thread(target=lambda: stderr_output.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+        
+        timed_out = threading.Event()
+        def kill_on_timeout():
+            timed_out.set()
+            process.kill()
+        timer = threading.Timer(timeout, kill_on_timeout)
+        timer.start()
+        try:
+            parse_ffmpeg_progress(process.stdout, duration, on_progress or (lambda percent: None))
+            process.wait()
+            stderr_reader.join()
+        finally:
+            timer.cancel()
+        
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stderr=b''.join(stderr_output))
         
         # Проверяем, что выходной файл создан
         if not os.path.exists(output_path):
@@ -98,240 +225,574 @@ def merge_video_audio(video_path, audio_path, output_path):
             pass
         return False
 
-def download_video_background(url, quality, download_id):
-    """Фоновая загрузка видео"""
+def merge_video_audio_streaming(video_stream, audio_stream, output_path, progress=None, refresh=None, job=None,
+                                timeout=None, keep=(None, None)):
+    """Объединяет потоки через ffmpeg, подавая байты в pipe по мере скачивания.
+
+    Объединение идет одновременно со скачиванием. keep - пути (видео, аудио),
+    в .part-файлы которых байты сохраняются по пути в ffmpeg: если объединение
+    не удастся, скачивание продолжится с того же места, а не с начала.
+
+    Скачивание может идти сколько угодно долго (например, с ограничением
+    скорости), поэтому timeout ограничивает только ffmpeg: сколько запись в
+    pipe может ждать, пока он прочитает, и сколько он работает после конца входов.
+    """
+    timeout = timeout or config['MERGE_TIMEOUT']
+    video_read, video_write = os.pipe()
+    audio_read, audio_write = os.pipe()
+    cmd = [
+        'ffmpeg',
+        '-i', f'pipe:{video_read}',
+        '-i', f'pipe:{audio_read}',
+        '-c:v', 'copy',
+        '-c:a', 'copy',
+        '-y',
+        '-loglevel', 'error',
+        output_path
+    ]
+    
+    try:
+        process = subprocess.Popen(
+            low_priority(cmd, config['FFMPEG_NICE']),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=(video_read, audio_read)
+        )
+    except Exception:
+        for fd in (video_read, video_write, audio_read, audio_write):
+            os.close(fd)
+        raise
+    
+    # Читающие концы нужны только ffmpeg
+    os.close(video_read)
+    os.close(audio_read)
+    
+    errors = []
+    watchdog = FFmpegWatchdog(process, timeout, inputs=2)
+    
+    def feed(index, stream, fd, keep_path):
+        try:
+            with os.fdopen(fd, 'wb') as pipe:
+                # Соединения загрузки делятся между видео и аудио
+                stream_fetcher.copy_to(stream, watchdog.writer(index, pipe), progress, refresh, job=job,
+                                       connections=max(1, stream_fetcher.max_connections // 2), keep=keep_path)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            watchdog.input_done()
+    
+    feeders = [
+        threading.Thread(target=feed, args=(0, video_stream, video_write, keep[0]), daemon=True),
+        threading.Thread(target=feed, args=(1, audio_stream, audio_write, keep[1]), daemon=True)
+    ]
+    for feeder in feeders:
+        feeder.start()
+    stderr_output = []
+    stderr_reader = threading.Thread(target=lambda: stderr_output.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+    
     try:
-        yt = YouTube(url)
+        process.wait()
+    finally:
+        for feeder in feeders:
+            feeder.join()
+        stderr_reader.join()
+    
+    if watchdog.timed_out:
+        raise Exception("Таймаут при объединении видео и аудио")
+    if process.returncode != 0:
+        raise Exception(f"Ошибка ffmpeg: {b''.join(stderr_output).decode(errors='replace')}")
+    if errors:
+        raise errors[0]
+    if not os.path.exists(output_path):
+        raise Exception("Выходной файл не был создан")
+
+def download_video_background(url, quality, download_id, audio_format=None, audio_bitrate=None,
+                              clip_start=None, clip_end=None):
+    """Фоновая загрузка видео.
+
+    С audio_format - аудио, перекодированное в этот формат; с clip_start/clip_end -
+    только этот отрезок видео (секунды).
+    """
+    try:
+        with STAGE_SECONDS.time(stage='extraction'):
+            yt = video_cache.get(url)
         
         # Получаем информацию о видео
-        video_info = {
-            'title': yt.title,
-            'author': yt.author,
-            'length': yt.length,
-            'views': yt.views,
-            'thumbnail': yt.thumbnail_url,
-            'status': 'processing'
-        }
+        update_status(
+            download_id,
+            title=yt.title,
+            author=yt.author,
+            length=yt.length,
+            views=yt.views,
+            thumbnail=thumbnail_url(yt.video_id),
+            status='processing'
+        )
         
-        download_status[download_id] = video_info
+        # Выбираем потоки по индексу, построенному при извлечении видео
+        with STAGE_SECONDS.time(stage='selection'):
+            selection = yt.stream_index.select('audio' if audio_format else quality)
+        if not selection:
+            raise Exception("Не удалось найти подходящий поток для скачивания")
         
-        # Выбираем поток в зависимости от качества
-        stream = None
-        file_extension = 'mp4'
+        use_adaptive = selection.use_adaptive
+        stream = selection.single.stream if selection.single else None
+        adaptive_video = selection.video.stream if use_adaptive else None
+        adaptive_audio = selection.audio.stream if use_adaptive else None
+        file_extension = selection.extension
+        itags = selection.itags
+        clip = clip_start is not None
         
-        if quality == 'highest':
-            # Сначала пробуем progressive потоки
-            progressive_streams = yt.streams.filter(progressive=True)
-            adaptive_video_streams = yt.streams.filter(adaptive=True, only_video=True)
-            adaptive_audio_streams = yt.streams.filter(adaptive=True, only_audio=True)
-            
-            # Выбираем лучший progressive поток
-            best_progressive = None
-            if progressive_streams:
-                sorted_progressive = sorted([s for s in progressive_streams if s.resolution], 
-                                          key=lambda x: int(x.resolution.replace('p', '')) if x.resolution and 'p' in x.resolution else 0,
-                                          reverse=True)
-                if sorted_progressive:
-                    best_progressive = sorted_progressive[0]
-            
-            # Выбираем лучший adaptive поток
-            best_adaptive_video = None
-            best_adaptive_audio = None
-            if adaptive_video_streams and adaptive_audio_streams:
-                sorted_adaptive_video = sorted([s for s in adaptive_video_streams if s.resolution], 
-                                              key=lambda x: int(x.resolution.replace('p', '')) if x.resolution and 'p' in x.resolution else 0,
-                                              reverse=True)
-                sorted_adaptive_audio = sorted([s for s in adaptive_audio_streams if hasattr(s, 'abr')], 
-                                             key=lambda x: int(str(x.abr).replace('kbps', '')) if hasattr(x, 'abr') and 'kbps' in str(x.abr) else 0,
-                                             reverse=True)
-                if sorted_adaptive_video:
-                    best_adaptive_video = sorted_adaptive_video[0]
-                if sorted_adaptive_audio:
-                    best_adaptive_audio = sorted_adaptive_audio[0]
-            
-            # Сравниваем качество и выбираем лучший вариант
-            use_adaptive = False
-            if best_adaptive_video and best_adaptive_audio:
-                adaptive_res = int(best_adaptive_video.resolution.replace('p', '')) if best_adaptive_video.resolution and 'p' in best_adaptive_video.resolution else 0
-                progressive_res = int(best_progressive.resolution.replace('p', '')) if best_progressive and best_progressive.resolution and 'p' in best_progressive.resolution else 0
-                if adaptive_res > progressive_res:
-                    use_adaptive = True
-            
-            if use_adaptive:
-                # Используем adaptive потоки с объединением
-                stream = None  # Будем обрабатывать отдельно
-                video_info['use_adaptive'] = True
-                video_info['adaptive_video'] = best_adaptive_video
-                video_info['adaptive_audio'] = best_adaptive_audio
-            else:
-                # Используем progressive поток
-                stream = best_progressive if best_progressive else yt.streams.get_highest_resolution()
-                video_info['use_adaptive'] = False
-        elif quality == 'lowest':
-            stream = yt.streams.filter(progressive=True).get_lowest_resolution()
-        elif quality == 'audio':
-            audio_all = yt.streams.filter(only_audio=True)
-            if audio_all:
-                # Сортируем по битрейту
-                sorted_audio = sorted([s for s in audio_all if hasattr(s, 'abr')], 
-                                     key=lambda x: int(x.abr.replace('kbps', '')) if hasattr(x, 'abr') and 'kbps' in str(x.abr) else 0,
-                                     reverse=True)
-                stream = sorted_audio[0] if sorted_audio else audio_all.first()
-            else:
-                stream = yt.streams.get_audio_only()
-            if stream:
-                file_extension = stream.subtype if hasattr(stream, 'subtype') else 'webm'
-        else:
-            # Для конкретного разрешения - сначала пробуем progressive, потом adaptive
-            stream = None
-            use_adaptive = False
-            
-            # Ищем progressive поток с точным разрешением
-            for s in yt.streams.filter(progressive=True):
-                if s.resolution == quality:
-                    stream = s
-                    break
-            
-            # Если не нашли progressive, пробуем adaptive
-            if not stream:
-                adaptive_video = yt.streams.filter(res=quality, adaptive=True, only_video=True).first()
-                adaptive_audio = yt.streams.filter(adaptive=True, only_audio=True).order_by('abr').desc().first()
-                
-                if adaptive_video and adaptive_audio:
-                    use_adaptive = True
-                    video_info['use_adaptive'] = True
-                    video_info['adaptive_video'] = adaptive_video
-                    video_info['adaptive_audio'] = adaptive_audio
-                else:
-                    # Если не нашли точное совпадение, ищем ближайшее большее разрешение в progressive
-                    all_progressive = list(yt.streams.filter(progressive=True))
-                    sorted_progressive = sorted([s for s in all_progressive if s.resolution], 
-                                              key=lambda x: int(x.resolution.replace('p', '')) if x.resolution and 'p' in x.resolution else 0)
-                    target_res = int(quality.replace('p', '')) if 'p' in quality else 0
-                    for s in sorted_progressive:
-                        res_num = int(s.resolution.replace('p', '')) if s.resolution and 'p' in s.resolution else 0
-                        if res_num >= target_res:
-                            stream = s
-                            break
-                    
-                    # Если не нашли большее, берем максимальное доступное
-                    if not stream and sorted_progressive:
-                        stream = sorted_progressive[-1]
-            else:
-                video_info['use_adaptive'] = False
+        # Отсутствие ffmpeg известно с запуска - не качаем то, что потом не обработать
+        if (use_adaptive or clip or audio_format) and not ffmpeg_info.available:
+            raise Exception(f"Для этой загрузки нужен ffmpeg: {ffmpeg_info.error}")
         
-        # Обрабатываем скачивание в зависимости от типа потока
-        filename_base = f"{download_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        file_extension = 'mp4'
+        # Для клипа скачивается примерно такая же доля потоков, как доля длительности
+        size_ratio = 1.0
+        if clip:
+            if yt.length:
+                clip_end = min(clip_end or yt.length, yt.length)
+                if clip_start >= clip_end:
+                    raise Exception("Начало клипа за пределами видео")
+                size_ratio = (clip_end - clip_start) / yt.length
         
-        if video_info.get('use_adaptive') and video_info.get('adaptive_video') and video_info.get('adaptive_audio'):
-            # Скачиваем adaptive потоки и объединяем через ffmpeg
-            adaptive_video = video_info['adaptive_video']
-            adaptive_audio = video_info['adaptive_audio']
-            
-            # Обновляем информацию о размере
-            video_size = adaptive_video.filesize / (1024 * 1024) if adaptive_video.filesize else 0
-            audio_size = adaptive_audio.filesize / (1024 * 1024) if adaptive_audio.filesize else 0
-            video_info['filesize'] = video_size + audio_size
-            video_info['resolution'] = adaptive_video.resolution if hasattr(adaptive_video, 'resolution') else 'Unknown'
-            
-            # Определяем расширение
-            if hasattr(adaptive_video, 'subtype') and adaptive_video.subtype:
-                file_extension = adaptive_video.subtype
-            else:
-                file_extension = 'mp4'
-            
-            # Скачиваем видео и аудио потоки
-            video_path = adaptive_video.download(
-                output_path=app.config['DOWNLOAD_FOLDER'],
-                filename=f"{filename_base}_video"
-            )
-            audio_path = adaptive_audio.download(
-                output_path=app.config['DOWNLOAD_FOLDER'],
-                filename=f"{filename_base}_audio"
-            )
-            
-            # Объединяем через ffmpeg
-            output_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f"{filename_base}.{file_extension}")
-            if merge_video_audio(video_path, audio_path, output_path):
-                filepath = output_path
-            else:
-                raise Exception("Не удалось объединить видео и аудио потоки")
-            
-            # Удаляем объекты Stream из video_info (они не сериализуются в JSON)
-            if 'adaptive_video' in video_info:
-                del video_info['adaptive_video']
-            if 'adaptive_audio' in video_info:
-                del video_info['adaptive_audio']
+        # Обновляем информацию о размере
+        status_fields = {
+            'use_adaptive': use_adaptive,
+            'filesize': selection.filesize * size_ratio / (1024 * 1024),
+            'resolution': selection.resolution_label or ('Unknown' if use_adaptive else 'audio'),
+        }
+        if not use_adaptive and not audio_format and not clip:
+            status_fields['stream_url'] = f"/stream/{download_id}"
+        update_status(download_id, **status_fields)
+        
+        # Тот же файл уже готов или прямо сейчас скачивается другой загрузкой.
+        # Перекодированное аудио переиспользуется по (видео, формат, битрейт)
+        if audio_format:
+            file_extension = audio_extension(audio_format)
+            result_key = result_store.make_transcode_key(yt.video_id, audio_bitrate, file_extension)
+        elif clip:
+            clip_range = f"{round(clip_start * 1000)}-{round(clip_end * 1000) if clip_end else 'end'}ms"
+            result_key = result_store.make_key(yt.video_id, itags, file_extension, variant=clip_range)
         else:
-            # Скачиваем progressive поток
-            if not stream:
-                raise Exception("Не удалось найти подходящий поток для скачивания")
+            result_key = result_store.make_key(yt.video_id, itags, file_extension)
+        state, value = result_store.acquire(result_key, download_id)
+        if state == 'done':
+            storage.touch(value)
+            mark_completed(download_id, value)
+            DOWNLOADS_TOTAL.inc(result='cache_hit')
+            return
+        if state == 'follower':
+            update_status(download_id, status='downloading', coalesced_with=value)
+            DOWNLOADS_TOTAL.inc(result='coalesced')
+            return
+        
+        # Скачиваем во временные файлы и переносим результат под постоянным именем
+        try:
+            filepath = result_store.path_for(result_key)
+            # Имена временных файлов постоянны для задачи, чтобы после перезапуска их можно было докачать
+            filename_base = download_id
+            live = None
+            refresh = lambda s: refresh_stream_url(url, s.itag)
             
-            # Обновляем информацию о размере
-            video_info['filesize'] = stream.filesize / (1024 * 1024) if stream.filesize else 0
-            video_info['resolution'] = stream.resolution if hasattr(stream, 'resolution') else 'audio'
+            # Счетчик байтов для прогресса, скорости и ETA
+            total_bytes = sum(s.filesize or 0 for s in ([adaptive_video, adaptive_audio] if use_adaptive else [stream]))
+            total_bytes = int(total_bytes * size_ratio)
+            tracker = ProgressTracker(total_bytes, lambda snapshot: update_status(download_id, **snapshot))
+            update_status(download_id, status='downloading', **tracker.snapshot())
+            # Освобождаем место под файл до начала скачивания
+            storage.reserve(download_id, total_bytes, file_extension)
             
-            # Определяем расширение файла из потока
-            if hasattr(stream, 'subtype') and stream.subtype:
-                file_extension = stream.subtype
-            elif hasattr(stream, 'mime_type'):
-                mime = stream.mime_type
-                if 'mp4' in mime:
-                    file_extension = 'mp4'
-                elif 'webm' in mime:
-                    file_extension = 'webm'
-                elif quality == 'audio':
-                    file_extension = 'webm'
+            if clip:
+                output_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}.{file_extension}")
+                video_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}_video")
+                audio_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}_audio")
+                if use_adaptive:
+                    parts = [(adaptive_video, video_path), (adaptive_audio, audio_path)]
                 else:
-                    file_extension = 'mp4'
-            elif quality == 'audio':
-                file_extension = 'webm'
+                    parts = [(stream, video_path if stream.includes_video_track else audio_path)]
+                
+                # Фрагментированный MP4: по индексу сегментов (sidx) скачиваем только
+                # нужные сегменты. Иначе поток идет в ffmpeg через pipe с начала до конца
+                # клипа - тоже через загрузчик, с общим пулом соединений и ограничением скорости
+                inputs = []
+                started = time.perf_counter()
+                for part_stream, part_path in parts:
+                    offset = fetch_clip(stream_fetcher, part_stream, part_path, clip_start, clip_end, tracker.add, refresh,
+                                        job=download_id)
+                    if offset is not None:
+                        inputs.append((part_path, offset))
+                    else:
+                        inputs.append((lambda pipe, part_stream=part_stream: stream_fetcher.copy_to(
+                            part_stream, pipe, tracker.add, refresh, job=download_id,
+                            connections=max(1, stream_fetcher.max_connections // len(parts))
+                        ), clip_start))
+                observe_fetch('fetch', started, tracker.downloaded)
+                
+                update_status(download_id, status='merging', merge_progress=0)
+                # Клип из pipe копирует пакеты по мере скачивания и, как потоковое
+                # объединение, слот ffmpeg не занимает
+                piped = any(callable(source) for source, _ in inputs)
+                try:
+                    with STAGE_SECONDS.time(stage='clip'), nullcontext() if piped else download_pool.merge_slot(), \
+                            FFMPEG_SECONDS.time(operation='clip'):
+                        cut_clip(
+                            inputs, output_path,
+                            clip_end - clip_start if clip_end else None,
+                            timeout=ffmpeg_timeout(total_bytes),
+                            on_progress=lambda percent: update_status(download_id, merge_progress=percent),
+                            niceness=config['FFMPEG_NICE']
+                        )
+                finally:
+                    for _, part_path in parts:
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+            elif use_adaptive:
+                output_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}.{file_extension}")
+                video_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}_video")
+                audio_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}_audio")
+                merged = False
+                
+                # Есть недокачанные .part-файлы прошлой попытки - продолжаем их, а не качаем заново
+                has_partial = any(os.path.exists(path + '.part.json') for path in (video_path, audio_path))
+                
+                # Сначала пробуем объединять на лету, подавая потоки в ffmpeg по мере скачивания
+                if config['STREAMING_MERGE'] and not has_partial:
+                    try:
+                        started = time.perf_counter()
+                        # Объединение на лету только копирует потоки, а время уходит на скачивание,
+                        # поэтому слот ffmpeg оно не занимает: таких объединений не больше потоков пула
+                        with FFMPEG_SECONDS.time(operation='merge_streaming'):
+                            merge_video_audio_streaming(adaptive_video, adaptive_audio, output_path, tracker.add, refresh,
+                                                        job=download_id, keep=(video_path, audio_path))
+                        observe_fetch('fetch_merge', started, tracker.downloaded)
+                        merged = True
+                        for path in (video_path, audio_path):
+                            for leftover in (path + '.part', path + '.part.json'):
+                                if os.path.exists(leftover):
+                                    os.remove(leftover)
+                    except Exception as e:
+                        # Полученное уже лежит в .part-файлах - fetch_all продолжит с того же места
+                        print(f"Потоковое объединение не удалось, докачиваем во временные файлы: {str(e)}")
+                        if os.path.exists(output_path):
+                            os.remove(output_path)
+                
+                if not merged:
+                    # Скачиваем видео и аудио потоки одновременно
+                    tracker = ProgressTracker(total_bytes, lambda snapshot: update_status(download_id, **snapshot))
+                    started = time.perf_counter()
+                    stream_fetcher.fetch_all([
+                        (adaptive_video, video_path),
+                        (adaptive_audio, audio_path)
+                    ], tracker.add, refresh, job=download_id)
+                    observe_fetch('fetch', started, tracker.downloaded)
+                    update_status(download_id, **tracker.snapshot())
+                    
+                    # Объединяем через ffmpeg (число одновременных процессов ограничено)
+                    update_status(download_id, status='merging', merge_progress=0)
+                    with STAGE_SECONDS.time(stage='merge'), download_pool.merge_slot(), \
+                            FFMPEG_SECONDS.time(operation='merge'):
+                        merged = merge_video_audio(
+                            video_path, audio_path, output_path,
+                            duration=yt.length,
+                            on_progress=lambda percent: update_status(download_id, merge_progress=percent),
+                            timeout=ffmpeg_timeout(total_bytes)
+                        )
+                    if not merged:
+                        raise Exception("Не удалось объединить видео и аудио потоки")
+            elif audio_format:
+                # Сначала скачиваем аудио (с докачкой), затем кодируем: слот перекодирования
+                # (ядро процессора) занят только на время работы ffmpeg
+                output_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}.{file_extension}.part")
+                audio_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}_audio")
+                started = time.perf_counter()
+                stream_fetcher.fetch(stream, audio_path, tracker.add, refresh, job=download_id)
+                observe_fetch('fetch', started, tracker.downloaded)
+                update_status(download_id, **tracker.snapshot())
+                
+                update_status(download_id, status='merging', merge_progress=0)
+                try:
+                    with STAGE_SECONDS.time(stage='transcode'), download_pool.transcode_slot(), \
+                            FFMPEG_SECONDS.time(operation='transcode'):
+                        transcode_file(
+                            audio_path, output_path, audio_format, audio_bitrate,
+                            timeout=merge_timeout(os.path.getsize(audio_path), config['TRANSCODE_TIMEOUT'],
+                                                  config['TRANSCODE_MIN_RATE']),
+                            niceness=config['FFMPEG_NICE']
+                        )
+                finally:
+                    if os.path.exists(audio_path):
+                        os.remove(audio_path)
             else:
-                file_extension = 'mp4'
-            
-            # Скачиваем файл
-            filepath = stream.download(
-                output_path=app.config['DOWNLOAD_FOLDER'],
-                filename=filename_base
-            )
-            
-            # Проверяем расширение скачанного файла
-            actual_extension = os.path.splitext(filepath)[1].lstrip('.')
+                # Скачиваем progressive поток последовательно, чтобы клиент мог
+                # получать его через /stream/<download_id> еще во время загрузки
+                output_path = os.path.join(config['DOWNLOAD_FOLDER'], f"{filename_base}.{file_extension}.part")
+                live = LiveFile(output_path, stream.filesize, name=os.path.basename(filepath), resume=True)
+                live_files[download_id] = live
+                # По имени файла /stream в других процессах находит .part-файл на диске
+                update_status(download_id, filename=live.name)
+                tracker.add(live.written)
+                resumed = live.written
+                started = time.perf_counter()
+                stream_fetcher.copy_to(stream, live, tracker.add, refresh, start=resumed, job=download_id)
+                observe_fetch('fetch', started, tracker.downloaded - resumed)
             
-            # Если расширение не совпадает или отсутствует, переименовываем
-            if not actual_extension or actual_extension != file_extension:
-                new_filepath = os.path.splitext(filepath)[0] + f'.{file_extension}'
-                if os.path.exists(filepath):
-                    if os.path.exists(new_filepath) and new_filepath != filepath:
-                        os.remove(new_filepath)
-                    os.rename(filepath, new_filepath)
-                    filepath = new_filepath
-                elif not os.path.exists(filepath):
-                    possible_path = os.path.join(app.config['DOWNLOAD_FOLDER'], filename_base)
-                    if os.path.exists(possible_path):
-                        new_filepath = possible_path + f'.{file_extension}'
-                        if os.path.exists(new_filepath) and new_filepath != possible_path:
-                            os.remove(new_filepath)
-                        os.rename(possible_path, new_filepath)
-                        filepath = new_filepath
-        
-        # Обновляем статус
-        video_info['status'] = 'completed'
-        video_info['filepath'] = filepath
-        video_info['filename'] = os.path.basename(filepath)
+            with STAGE_SECONDS.time(stage='rename'):
+                os.replace(output_path, filepath)
+                storage.add(filepath)
+            if live:
+                live.moved(filepath)
+                live.finish()
+        except Exception as e:
+            if live:
+                live.finish(str(e))
+            for follower_id in result_store.fail(result_key):
+                mark_failed(follower_id, str(e))
+            raise
+        finally:
+            live_files.pop(download_id, None)
+            storage.unreserve(download_id)
+        
+        # Отдаем результат этой загрузке и всем присоединившимся к ней
+        mark_completed(download_id, filepath)
+        for follower_id in result_store.complete(result_key):
+            mark_completed(follower_id, filepath)
+        DOWNLOADS_TOTAL.inc(result='completed')
         
     except Exception as e:
-        if download_id in download_status:
-            download_status[download_id]['status'] = 'error'
-            download_status[download_id]['error'] = str(e)
+        DOWNLOADS_TOTAL.inc(result='error')
+        ERRORS_TOTAL.inc(type=type(e).__name__)
+        # Ссылки на потоки истекли и обновить их не удалось - при повторной попытке извлекаем заново.
+        # Остальные ошибки (ffmpeg, неверный отрезок) запись кэша не портят
+        if isinstance(e, HTTPError) and e.code in EXPIRED_URL_CODES:
+            video_cache.invalidate(url)
+        mark_failed(download_id, str(e))
+
+def thumbnail_url(video_id):
+    """Ссылка на превью через локальный кэш (/thumbnail), а не напрямую на YouTube"""
+    return f"/thumbnail/{video_id}?size={config['THUMBNAIL_PAGE_SIZE']}"
+
+def fetch_thumbnail(video_id):
+    """Скачивает оригинальное превью видео с YouTube"""
+    info = video_cache.peek(video_id)
+    url = info.thumbnail_url if info and info.thumbnail_url else f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
+    with http_client.request(url, headers=DEFAULT_HEADERS, timeout=15) as response:
+        data = response.read(MAX_THUMBNAIL_SIZE + 1)
+    if len(data) > MAX_THUMBNAIL_SIZE:
+        raise Exception("Превью слишком большое")
+    return data
+
+def refresh_stream_url(url, itag):
+    """Заново извлекает видео и возвращает свежую подписанную ссылку на поток itag"""
+    video_cache.invalidate(url)
+    for stream in video_cache.get(url).streams:
+        if stream.itag == itag:
+            return stream.url
+    raise Exception(f"Поток {itag} больше не доступен")
+
+def owner_alive(owner):
+    """Работает ли еще процесс, взявший задачу (owner - 'хост:pid')"""
+    if not owner:
+        return False
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        # Процесс на другой машине проверить нельзя - считаем живым
+        return True
+    if os.name != 'posix':
+        return int(pid) == os.getpid()
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def resume_interrupted_jobs():
+    """Возобновляет незавершенные загрузки, процесс которых остановился"""
+    batches = {}
+    for job in job_store.list_by_status(ACTIVE_STATUSES):
+        if owner_alive(job.owner):
+            continue
+        # Задачу могут одновременно подхватывать несколько процессов - берет один
+        if not job_store.claim(job.download_id, job.owner, WORKER_ID):
+            continue
+        update_status(job.download_id, status='queued')
+        if job.batch_id:
+            # Задачи пакета снова идут через лимит пакета
+            batches.setdefault(job.batch_id, []).append(job)
+            continue
+        try:
+            submit_download(job)
+        except QueueFullError as e:
+            mark_failed(job.download_id, str(e))
+    for batch_id, jobs in batches.items():
+        jobs.sort(key=lambda job: job.created_at)
+        start_batch(batch_id, [job.download_id for job in jobs], config['BATCH_CONCURRENCY'])
+
+def expand_batch_urls(data):
+    """Список URL видео пакета: переданный список или содержимое плейлиста/канала"""
+    limit = config['BATCH_MAX_VIDEOS']
+    urls = data.get('urls')
+    if urls:
+        if not isinstance(urls, list) or not all(isinstance(url, str) and url.strip() for url in urls):
+            raise ValueError('urls must be a list of URLs')
+        if len(urls) > limit:
+            raise ValueError(f'Too many videos in batch (max {limit})')
+        return [url.strip() for url in urls]
+    
+    url = data.get('url')
+    if not url:
+        raise ValueError('urls or url is required')
+    from pytubefix import Playlist, Channel
+    if is_playlist_url(url):
+        source = Playlist(url)
+    elif is_channel_url(url):
+        source = Channel(url)
+    else:
+        return [url]
+    # Списки видео pytubefix ленивые: дальше лимита страницы не загружаются
+    return list(islice(source.video_urls, limit))
+
+def prefetch_video_info(download_id, url):
+    """Извлекает метаданные видео, пока его загрузка ждет в очереди, и уточняет ее место в очереди"""
+    try:
+        yt = video_cache.get(url)
+    except Exception as e:
+        # Ошибку сообщит сама загрузка, когда дойдет до этого видео
+        print(f"Не удалось получить информацию о {url}: {str(e)}")
+        return
+    job = job_store.get(download_id)
+    if job and job.status == 'queued':
+        update_status(download_id, title=yt.title, author=yt.author, length=yt.length,
+                      views=yt.views, thumbnail=thumbnail_url(yt.video_id))
+        download_pool.reprioritize(download_id, cost=estimate_cost(yt, job))
+
+def estimate_cost(yt, job):
+    """Оценка длительности задачи в секундах по выбранным потокам: скачивание плюс работа ffmpeg"""
+    selection = yt.stream_index.select('audio' if job.audio_format else job.quality)
+    if not selection:
+        return 0
+    size = selection.filesize
+    if job.clip_start is not None and yt.length:
+        clip_end = min(job.clip_end or yt.length, yt.length)
+        size *= max(0, clip_end - job.clip_start) / yt.length
+    cost = size / config['SCHEDULER_FETCH_RATE']
+    if job.audio_format:
+        cost += size / config['SCHEDULER_TRANSCODE_RATE']
+    elif selection.use_adaptive or job.clip_start is not None:
+        cost += size / config['SCHEDULER_MERGE_RATE']
+    return cost
+
+def schedule_options(job):
+    """Класс приоритета и оценка стоимости задачи для очереди пула.
+
+    Видео, которое еще не в кэше, получает оценку по умолчанию до извлечения.
+    """
+    if job is None:
+        return {}
+    yt = video_cache.peek(job.url)
+    return {'priority': job.priority or 'normal', 'cost': estimate_cost(yt, job) if yt else None}
+
+def admin_denied(action):
+    """Проверяет токен ADMIN_TOKEN (Authorization: Bearer <токен>) для action.
+
+    Возвращает (сообщение, статус), если запрос его не прошел, иначе None.
+    """
+    token = config['ADMIN_TOKEN']
+    if not token:
+        return f'{action} is disabled (ADMIN_TOKEN is not set)', 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return 'Invalid admin token', 401
+    return None
+
+def priority_error(priority):
+    """Ответ с ошибкой для недопустимого класса приоритета или None.
+
+    Классы, которые обгоняют обычные задачи в общей очереди, доступны только с ADMIN_TOKEN.
+    """
+    classes = config['PRIORITY_CLASSES']
+    if priority not in classes:
+        return jsonify({'error': f"priority must be one of: {', '.join(classes)}", 'success': False}), 400
+    if classes[priority] < classes.get('normal', 0):
+        denied = admin_denied(f'Priority {priority}')
+        if denied:
+            message, status = denied
+            return jsonify({'error': message, 'success': False}), status
+    return None
+
+def submit_download(job):
+    """Ставит одиночную загрузку в очередь пула и возвращает ее позицию"""
+    options = schedule_options(job)
+    position = download_pool.submit(
+        job.download_id, download_video_background, job.url, job.quality, job.download_id,
+        job.audio_format, job.audio_bitrate, job.clip_start, job.clip_end, **options
+    )
+    if options['cost'] is None:
+        info_extractor.submit(prefetch_video_info, job.download_id, job.url)
+    return position
+
+def run_batch_job(download_id):
+    """Выполняет загрузку из пакета в потоке пула"""
+    job = job_store.get(download_id)
+    if job is None:
+        return
+    download_video_background(job.url, job.quality, download_id, job.audio_format, job.audio_bitrate,
+                              job.clip_start, job.clip_end)
+
+def start_batch(batch_id, download_ids, concurrency):
+    """Начинает ставить задачи пакета в очередь пула"""
+    runner = BatchRunner(
+        download_pool, run_batch_job, download_ids,
+        concurrency=concurrency,
+        on_finish=lambda: batch_runners.pop(batch_id, None),
+        options=lambda download_id: schedule_options(job_store.get(download_id))
+    )
+    batch_runners[batch_id] = runner
+    runner.start()
+
+def job_is_active(download_id):
+    """Выполняется ли загрузка (или ждет в очереди)"""
+    job = job_store.get(download_id)
+    return job is not None and job.status in ACTIVE_STATUSES
 
-@app.route('/')
+def update_status(download_id, **fields):
+    """Обновляет статус загрузки (подписчики /events узнают об этом через хранилище)"""
+    job_store.update(download_id, **fields)
+
+def mark_completed(download_id, filepath):
+    """Отмечает загрузку завершенной с готовым файлом"""
+    update_status(download_id, status='completed', filepath=filepath, filename=os.path.basename(filepath),
+                  progress=100, eta=0)
+
+def mark_failed(download_id, error):
+    """Отмечает загрузку завершившейся с ошибкой"""
+    update_status(download_id, status='error', error=error)
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@bp.after_app_request
+def observe_request(response):
+    # Для потоковых ответов (/stream, /events, ZIP) это время до начала отдачи тела
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            # Имя маршрута без префикса blueprint
+            endpoint=(request.endpoint or 'unknown').rpartition('.')[2],
+            method=request.method,
+            status=response.status_code
+        )
+    return response
+
+@bp.route('/')
 def index():
     """Главная страница"""
     return render_template('index.html')
 
-@app.route('/get_info', methods=['POST'])
+@bp.route('/get_info', methods=['POST'])
 def get_video_info():
     """Получение информации о видео"""
     try:
@@ -339,132 +800,55 @@ def get_video_info():
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
-        yt = YouTube(url)
+        yt = video_cache.get(url)
         
-        # Получаем все доступные потоки
-        progressive_streams = yt.streams.filter(progressive=True)
-        adaptive_video_streams = yt.streams.filter(adaptive=True, only_video=True)
-        adaptive_audio_streams = yt.streams.filter(adaptive=True, only_audio=True)
-        audio_streams = yt.streams.filter(only_audio=True)
+        index = yt.stream_index
         
-        # Объединяем progressive и adaptive потоки для отображения
-        all_video_streams = list(progressive_streams)
-        # Добавляем adaptive потоки, которые можно объединить с аудио
-        for adaptive_video in adaptive_video_streams:
-            if adaptive_video.resolution and adaptive_audio_streams:
-                all_video_streams.append(adaptive_video)
+        def video_quality(selection, label):
+            """Описание варианта видео для списка качеств"""
+            stream_type = 'adaptive' if selection.use_adaptive else 'progressive'
+            if stream_type == 'adaptive':
+                label += " [HD]"
+            label += f" - {selection.filesize / (1024 * 1024):.1f}MB"
+            return {'label': label, 'type': 'video', 'stream_type': stream_type}
         
-        # Формируем список доступных качеств
+        # Формируем список доступных качеств (лучший поток на каждое разрешение)
         qualities = []
-        resolutions = set()
-        
-        # Сортируем все потоки по разрешению
-        sorted_streams = sorted([s for s in all_video_streams if s.resolution], 
-                               key=lambda x: int(x.resolution.replace('p', '')) if x.resolution and 'p' in x.resolution else 0,
-                               reverse=True)
-        
-        for stream in sorted_streams:
-            if stream.resolution and stream.resolution not in resolutions:
-                resolutions.add(stream.resolution)
-                filesize_mb = stream.filesize / (1024 * 1024) if stream.filesize else 0
-                # Для adaptive потоков добавляем размер аудио
-                is_adaptive = hasattr(stream, 'is_progressive') and not stream.is_progressive
-                if is_adaptive and adaptive_audio_streams:
-                    best_audio = sorted([s for s in adaptive_audio_streams if hasattr(s, 'abr')], 
-                                       key=lambda x: int(str(x.abr).replace('kbps', '')) if hasattr(x, 'abr') and 'kbps' in str(x.abr) else 0,
-                                       reverse=True)
-                    if best_audio:
-                        audio_size = best_audio[0].filesize / (1024 * 1024) if best_audio[0].filesize else 0
-                        filesize_mb += audio_size
-                
-                # Определяем тип потока
-                stream_type = 'adaptive' if hasattr(stream, 'is_progressive') and not stream.is_progressive else 'progressive'
-                quality_label = f"Video ({stream.resolution})"
-                if stream_type == 'adaptive':
-                    quality_label += " [HD]"
-                quality_label += f" - {filesize_mb:.1f}MB"
-                
-                qualities.append({
-                    'value': stream.resolution,
-                    'label': quality_label,
-                    'type': 'video',
-                    'stream_type': stream_type
-                })
+        for selection in index.video_options():
+            option = video_quality(selection, f"Video ({selection.resolution_label})")
+            qualities.append(dict(option, value=selection.resolution_label))
         
         # Добавляем аудио опции
-        if audio_streams:
-            sorted_audio = sorted([s for s in audio_streams if hasattr(s, 'abr')], 
-                                 key=lambda x: int(str(x.abr).replace('kbps', '')) if hasattr(x, 'abr') and 'kbps' in str(x.abr) else 0,
-                                 reverse=True)
-            audio = sorted_audio[0] if sorted_audio else audio_streams.first()
-            if audio:
-                audio_filesize_mb = audio.filesize / (1024 * 1024) if audio.filesize else 0
-                audio_format = audio.subtype if hasattr(audio, 'subtype') else 'webm'
-                qualities.append({
-                    'value': 'audio',
-                    'label': f"Audio Only ({audio_format.upper()}) - {audio_filesize_mb:.1f}MB",
-                    'type': 'audio'
-                })
+        audio = index.audio()
+        if audio:
+            qualities.append({
+                'value': 'audio',
+                'label': f"Audio Only ({audio.extension.upper()}) - {audio.filesize / (1024 * 1024):.1f}MB",
+                'type': 'audio'
+            })
         
         # Добавляем опции для максимального и минимального качества
-        if all_video_streams:
-            # Для highest используем лучший поток из всех доступных (progressive или adaptive)
-            highest_sorted = sorted([s for s in all_video_streams if s.resolution], 
-                                   key=lambda x: int(x.resolution.replace('p', '')) if x.resolution and 'p' in x.resolution else 0,
-                                   reverse=True)
-            highest = highest_sorted[0] if highest_sorted else None
-            if not highest and progressive_streams:
-                highest = progressive_streams.get_highest_resolution()
-            
-            # Для lowest используем только progressive потоки (они проще для скачивания)
-            lowest_sorted = sorted([s for s in progressive_streams if s.resolution], 
-                                 key=lambda x: int(x.resolution.replace('p', '')) if x.resolution and 'p' in x.resolution else 9999)
-            lowest = lowest_sorted[0] if lowest_sorted else None
-            if not lowest and progressive_streams:
-                lowest = progressive_streams.get_lowest_resolution()
-            
-            if highest:
-                highest_filesize_mb = highest.filesize / (1024 * 1024) if highest.filesize else 0
-                # Для adaptive добавляем размер аудио
-                highest_is_adaptive = hasattr(highest, 'is_progressive') and not highest.is_progressive
-                if highest_is_adaptive and adaptive_audio_streams:
-                    best_audio = sorted([s for s in adaptive_audio_streams if hasattr(s, 'abr')], 
-                                      key=lambda x: int(str(x.abr).replace('kbps', '')) if hasattr(x, 'abr') and 'kbps' in str(x.abr) else 0,
-                                      reverse=True)
-                    if best_audio:
-                        audio_size = best_audio[0].filesize / (1024 * 1024) if best_audio[0].filesize else 0
-                        highest_filesize_mb += audio_size
-                
-                highest_res = highest.resolution if highest.resolution else 'Unknown'
-                stream_type = 'adaptive' if highest_is_adaptive else 'progressive'
-                quality_label = f"Highest Quality ({highest_res})"
-                if stream_type == 'adaptive':
-                    quality_label += " [HD]"
-                quality_label += f" - {highest_filesize_mb:.1f}MB"
-                
-                qualities.insert(0, {
-                    'value': 'highest',
-                    'label': quality_label,
-                    'type': 'video',
-                    'stream_type': stream_type
-                })
-            
-            if lowest:
-                lowest_filesize_mb = lowest.filesize / (1024 * 1024) if lowest.filesize else 0
-                lowest_res = lowest.resolution if lowest.resolution else 'Unknown'
-                qualities.append({
-                    'value': 'lowest',
-                    'label': f"Lowest Quality ({lowest_res}) - {lowest_filesize_mb:.1f}MB",
-                    'type': 'video',
-                    'stream_type': 'progressive'
-                })
+        highest = index.highest()
+        if highest:
+            option = video_quality(highest, f"Highest Quality ({highest.resolution_label or 'Unknown'})")
+            qualities.insert(0, dict(option, value='highest'))
+        
+        # Для lowest используем только progressive потоки (они проще для скачивания)
+        lowest = index.lowest()
+        if lowest:
+            qualities.append({
+                'value': 'lowest',
+                'label': f"Lowest Quality ({lowest.resolution_label or 'Unknown'}) - {lowest.filesize / (1024 * 1024):.1f}MB",
+                'type': 'video',
+                'stream_type': 'progressive'
+            })
         
         return jsonify({
             'title': yt.title,
             'author': yt.author,
             'length': str(yt.length // 60) + ":" + str(yt.length % 60).zfill(2),
             'views': f"{yt.views:,}",
-            'thumbnail': yt.thumbnail_url,
+            'thumbnail': thumbnail_url(yt.video_id),
             'qualities': qualities,
             'success': True
         })
@@ -472,7 +856,7 @@ def get_video_info():
     except Exception as e:
         return jsonify({'error': str(e), 'success': False}), 400
 
-@app.route('/download', methods=['POST'])
+@bp.route('/download', methods=['POST'])
 def download_video():
     """Запуск загрузки видео"""
     try:
@@ -482,97 +866,528 @@ def download_video():
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
+        # Перекодирование аудио (mp3/opus/aac с заданным битрейтом) - по желанию
+        try:
+            audio_format, audio_bitrate = parse_audio_options(
+                request.json.get('audio_format'), request.json.get('audio_bitrate')
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        if audio_format:
+            quality = 'audio'
+        
+        # Отрезок видео: start/end в секундах или [чч:]мм:сс
+        try:
+            clip_start, clip_end = parse_clip_options(request.json.get('start'), request.json.get('end'))
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        if clip_start is not None and audio_format:
+            return jsonify({'error': 'start/end cannot be combined with audio_format', 'success': False}), 400
+        
+        # Без ffmpeg или нужного кодека такая загрузка заведомо не удастся
+        if audio_format and audio_format not in available_audio_formats():
+            return jsonify({'error': f'audio_format {audio_format} is not available on this server', 'success': False}), 503
+        if clip_start is not None and not ffmpeg_info.available:
+            return jsonify({'error': 'Clips are not available on this server', 'success': False}), 503
+        
+        # Класс приоритета в очереди; внутри класса короткие задачи идут первыми
+        priority = request.json.get('priority', 'normal')
+        error = priority_error(priority)
+        if error:
+            return error
+        
         # Генерируем уникальный ID для загрузки
-        download_id = f"dl_{int(time.time())}_{hash(url) % 10000}"
+        download_id = f"dl_{int(time.time())}_{uuid.uuid4().hex[:8]}"
         
-        # Запускаем загрузку в фоновом потоке
-        thread = threading.Thread(
-            target=download_video_background,
-            args=(url, quality, download_id)
-        )
-        thread.daemon = True
-        thread.start()
+        # Ставим загрузку в очередь пула
+        job = Job(download_id=download_id, url=url, quality=quality, owner=WORKER_ID,
+                  audio_format=audio_format, audio_bitrate=audio_bitrate,
+                  clip_start=clip_start, clip_end=clip_end, priority=priority)
+        job_store.create(job)
+        try:
+            position = submit_download(job)
+        except QueueFullError as e:
+            job_store.delete(download_id)
+            response = jsonify({'error': str(e), 'success': False})
+            response.headers['Retry-After'] = '30'
+            return response, 429
         
         return jsonify({
             'download_id': download_id,
-            'message': 'Download started',
+            'queue_position': position,
+            'message': 'Download queued',
             'success': True
         })
         
     except Exception as e:
         return jsonify({'error': str(e), 'success': False}), 400
 
-@app.route('/status/<download_id>')
+def build_status(download_id):
+    """Снимок статуса загрузки для ответа клиенту, None если загрузка не найдена"""
+    job = job_store.get(download_id)
+    if job is None:
+        return None
+    status = job.to_dict()
+    
+    # Для задач в очереди сообщаем позицию. Очередь другого процесса не видна -
+    # для его задач позиция оценивается по порядку постановки
+    if job.status == 'queued':
+        position = download_pool.position(download_id)
+        if position is None and job.owner != WORKER_ID:
+            position = job_store.queued_ahead(job) + 1
+        status['queue_position'] = position
+    
+    # Присоединившаяся загрузка показывает прогресс загрузки-лидера
+    if job.coalesced_with and job.status == 'downloading':
+        leader = job_store.get(job.coalesced_with)
+        if leader:
+            for key in ('downloaded_bytes', 'total_bytes', 'speed', 'eta', 'progress', 'merge_progress'):
+                if getattr(leader, key) is not None:
+                    status[key] = getattr(leader, key)
+    
+    # Если загрузка завершена, добавляем ссылку для скачивания
+    if job.status == 'completed':
+        status['download_url'] = f"/download_file/{job.filename}"
+    
+    return status
+
+@bp.route('/status/<download_id>')
 def get_download_status(download_id):
     """Проверка статуса загрузки"""
-    if download_id in download_status:
-        status = download_status[download_id].copy()
-        
-        # Удаляем объекты Stream, которые не могут быть сериализованы в JSON
-        if 'adaptive_video' in status:
-            del status['adaptive_video']
-        if 'adaptive_audio' in status:
-            del status['adaptive_audio']
-        
-        # Если загрузка завершена, добавляем ссылку для скачивания
-        if status.get('status') == 'completed':
-            status['download_url'] = f"/download_file/{status['filename']}"
-        
-        return jsonify(status)
-    else:
+    status = build_status(download_id)
+    if status is None:
         return jsonify({'error': 'Download not found'}), 404
+    return jsonify(status)
+
+@bp.route('/events/<download_id>')
+def download_events(download_id):
+    """Поток Server-Sent Events с изменениями статуса загрузки"""
+    if job_store.get(download_id) is None:
+        return jsonify({'error': 'Download not found'}), 404
+    
+    def generate():
+        last_sent = None
+        last_sent_at = time.time()
+        while True:
+            status = build_status(download_id)
+            if status is None:
+                return
+            
+            payload = json.dumps(status, ensure_ascii=False)
+            if payload != last_sent:
+                last_sent = payload
+                last_sent_at = time.time()
+                yield f"data: {payload}\n\n"
+            elif time.time() - last_sent_at >= config['EVENTS_KEEPALIVE']:
+                # Комментарий SSE не дает прокси закрыть простаивающее соединение
+                last_sent_at = time.time()
+                yield ": keepalive\n\n"
+            if status.get('status') in FINISHED_STATUSES:
+                return
+            
+            job_store.wait(config['EVENTS_KEEPALIVE'])
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def guess_mimetype(filename):
+    """Определяет тип контента по расширению"""
+    if filename.endswith('.mp4'):
+        return 'video/mp4'
+    elif filename.endswith('.webm'):
+        return 'video/webm'
+    elif filename.endswith('.mkv'):
+        return 'video/x-matroska'
+    elif filename.endswith('.mp3'):
+        return 'audio/mpeg'
+    elif filename.endswith('.opus'):
+        return 'audio/ogg'
+    elif filename.endswith('.m4a'):
+        return 'audio/mp4'
+    return 'application/octet-stream'
 
-@app.route('/download_file/<filename>')
+def public_filename(filename):
+    """Имя файла для пользователя (без служебного префикса)"""
+    return filename.split('_', 1)[-1] if '_' in filename else filename
+
+@bp.route('/download_file/<filename>')
 def download_file(filename):
-    """Скачивание готового файла"""
+    """Скачивание готового файла (Range, If-Range, ETag и Last-Modified поддерживаются)"""
     try:
-        filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
+        filepath = safe_join(os.path.abspath(config['DOWNLOAD_FOLDER']), filename)
         
-        if not os.path.exists(filepath):
+        if filepath is None or not os.path.isfile(filepath):
             return "File not found", 404
         
-        # Определяем тип контента
-        if filename.endswith('.mp4'):
-            mimetype = 'video/mp4'
-        elif filename.endswith('.webm'):
-            mimetype = 'video/webm'
-        elif filename.endswith('.mp3'):
-            mimetype = 'audio/mpeg'
+        # Байты отдает nginx (internal location с alias на папку загрузок),
+        # он же обрабатывает Range - Python в передаче не участвует
+        if config['FILE_OFFLOAD'] == 'x-accel':
+            storage.touch(filepath)
+            response = Response(mimetype=guess_mimetype(filename))
+            response.headers['X-Accel-Redirect'] = f"{config['X_ACCEL_PREFIX'].rstrip('/')}/{quote(filename)}"
+            response.headers['Content-Disposition'] = f'attachment; filename="{public_filename(filename)}"'
+            return response
+        
+        # При FILE_OFFLOAD = 'x-sendfile' Flask сам ставит заголовок X-Sendfile
+        # (USE_X_SENDFILE) и тела у ответа нет: файл отдает веб-сервер, и когда
+        # он закончит, мы не узнаем - как и для x-accel, только отмечаем обращение.
+        # Иначе под gunicorn файл уходит через os.sendfile, и пока он отдается,
+        # вытеснять его нельзя
+        offloaded = config['FILE_OFFLOAD'] == 'x-sendfile'
+        if offloaded:
+            storage.touch(filepath)
         else:
-            mimetype = 'application/octet-stream'
+            storage.acquire(filepath)
+        try:
+            response = send_file(
+                filepath,
+                as_attachment=True,
+                download_name=public_filename(filename),
+                mimetype=guess_mimetype(filename),
+                conditional=True,
+                etag=True,
+                max_age=config['FILE_MAX_AGE']
+            )
+        except Exception:
+            if not offloaded:
+                storage.release(filepath)
+            raise
         
-        return send_file(
-            filepath,
-            as_attachment=True,
-            download_name=filename.split('_', 1)[-1] if '_' in filename else filename,
-            mimetype=mimetype
-        )
+        body = response.response
+        if offloaded:
+            return response
+        if not hasattr(body, 'close'):
+            # Ответ без файла (например, 304) - файл уже не используется
+            storage.release(filepath)
+            return response
+        
+        # send_file отдает файл напрямую (direct_passthrough), и сервер закрывает
+        # сам файл, минуя call_on_close - освобождаем файл при его закрытии
+        close_file = body.close
+        released = []
         
+        def close():
+            try:
+                close_file()
+            finally:
+                if not released:
+                    released.append(True)
+                    storage.release(filepath)
+        body.close = close
+        return response
+        
+    except HTTPException:
+        # 416 для Range за пределами файла и другие ответы send_file отдаем как есть
+        raise
     except Exception as e:
         return str(e), 500
 
-@app.route('/cleanup', methods=['POST'])
+@bp.route('/stream/<download_id>')
+def stream_download(download_id):
+    """Отдача файла клиенту по мере скачивания с YouTube (progressive и аудио)"""
+    deadline = time.time() + config['STREAM_WAIT_TIMEOUT']
+    while True:
+        job = job_store.get(download_id)
+        if job is None:
+            return jsonify({'error': 'Download not found'}), 404
+        
+        if job.status == 'completed':
+            return download_file(job.filename)
+        if job.status == 'error':
+            return jsonify({'error': job.error}), 500
+        
+        # Присоединившиеся загрузки читают файл загрузки-лидера
+        source_id = job.coalesced_with or download_id
+        live = live_files.get(source_id)
+        if live:
+            break
+        
+        # Загрузку ведет другой процесс - читаем ее .part-файл с диска
+        source = job_store.get(source_id) if source_id != download_id else job
+        if source and source.status == 'downloading' and source.stream_url and source.filename:
+            part_path = os.path.join(config['DOWNLOAD_FOLDER'],
+                                     f"{source_id}{os.path.splitext(source.filename)[1]}.part")
+            try:
+                reader = open(part_path, 'rb')
+            except FileNotFoundError:
+                reader = None
+            if reader:
+                return stream_part_file(source, reader)
+        
+        # Объединяемые adaptive-потоки, перекодируемое аудио и клипы нельзя отдавать до конца обработки
+        if job.use_adaptive or job.audio_format or job.clip_start is not None or time.time() >= deadline:
+            return jsonify({'error': 'Streaming is not available for this download yet'}), 409
+        time.sleep(0.2)
+    
+    try:
+        reader = live.open_reader()
+    except OSError:
+        # Файл только что переименован - загрузка уже завершена
+        return stream_download(download_id)
+    
+    filename = live.name
+    headers = {'Content-Disposition': f'attachment; filename="{public_filename(filename)}"'}
+    if live.total:
+        headers['Content-Length'] = str(live.total)
+    return Response(
+        stream_with_context(live.iter_bytes(reader)),
+        mimetype=guess_mimetype(filename),
+        headers=headers
+    )
+
+def stream_part_file(job, reader):
+    """Ответ /stream по .part-файлу загрузки, которую ведет другой процесс"""
+    headers = {'Content-Disposition': f'attachment; filename="{public_filename(job.filename)}"'}
+    if job.total_bytes:
+        headers['Content-Length'] = str(job.total_bytes)
+    return Response(
+        stream_with_context(tail_part_file(job.download_id, reader)),
+        mimetype=guess_mimetype(job.filename),
+        headers=headers
+    )
+
+def tail_part_file(download_id, reader, chunk_size=1024 * 1024, poll_interval=0.2, timeout=60):
+    """Отдает байты .part-файла по мере записи.
+
+    Файл пишет другой процесс, поэтому сколько байтов уже записано, видно по
+    размеру открытого файла (после переименования он остается тем же), а
+    чем закончилась загрузка - по ее статусу в общем хранилище задач.
+    """
+    offset = 0
+    last_progress = time.time()
+    try:
+        while True:
+            available = os.fstat(reader.fileno()).st_size - offset
+            if available > 0:
+                chunk = reader.read(min(chunk_size, available))
+                offset += len(chunk)
+                last_progress = time.time()
+                yield chunk
+                continue
+            job = job_store.get(download_id)
+            if job is None or job.status == 'error':
+                raise Exception(job.error if job else "Загрузка удалена")
+            if job.status == 'completed':
+                # Все записанное уже прочитано (проверяем еще раз после статуса)
+                if os.fstat(reader.fileno()).st_size == offset:
+                    return
+                continue
+            if time.time() - last_progress > timeout:
+                raise Exception("Загрузка не продвигается")
+            time.sleep(poll_interval)
+    finally:
+        reader.close()
+
+@bp.route('/batch', methods=['POST'])
+def create_batch():
+    """Пакетная загрузка: список URL или ссылка на плейлист/канал"""
+    try:
+        data = request.json or {}
+        quality = data.get('quality', 'highest')
+        try:
+            audio_format, audio_bitrate = parse_audio_options(data.get('audio_format'), data.get('audio_bitrate'))
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        if audio_format:
+            quality = 'audio'
+            if audio_format not in available_audio_formats():
+                return jsonify({'error': f'audio_format {audio_format} is not available on this server', 'success': False}), 503
+        priority = data.get('priority', 'normal')
+        error = priority_error(priority)
+        if error:
+            return error
+        concurrency = int(data.get('concurrency', config['BATCH_CONCURRENCY']))
+        # Один пакет не может занять больше потоков, чем есть в пуле
+        concurrency = max(1, min(concurrency, config['FETCH_WORKERS']))
+        
+        try:
+            urls = expand_batch_urls(data)
+        except ValueError as e:
+            return jsonify({'error': str(e), 'success': False}), 400
+        if not urls:
+            return jsonify({'error': 'No videos found', 'success': False}), 400
+        
+        batch_id = f"batch_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+        download_ids = []
+        for url in urls:
+            download_id = f"dl_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+            job_store.create(Job(download_id=download_id, url=url, quality=quality,
+                                 audio_format=audio_format, audio_bitrate=audio_bitrate,
+                                 batch_id=batch_id, priority=priority, owner=WORKER_ID))
+            download_ids.append(download_id)
+            info_extractor.submit(prefetch_video_info, download_id, url)
+        
+        start_batch(batch_id, download_ids, concurrency)
+        
+        return jsonify({
+            'batch_id': batch_id,
+            'download_ids': download_ids,
+            'count': len(download_ids),
+            'concurrency': concurrency,
+            'message': 'Batch queued',
+            'success': True
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e), 'success': False}), 400
+
+@bp.route('/batch/<batch_id>')
+def get_batch_status(batch_id):
+    """Общий прогресс пакета и статусы его загрузок"""
+    jobs = job_store.list_by_batch(batch_id)
+    if not jobs:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    items = [build_status(job.download_id) or job.to_dict() for job in jobs]
+    counts = {}
+    for item in items:
+        counts[item['status']] = counts.get(item['status'], 0) + 1
+    finished = sum(counts.get(status, 0) for status in FINISHED_STATUSES)
+    
+    # Прогресс пакета - средний прогресс загрузок (завершенные считаются целиком)
+    progress = sum(100 if item['status'] in FINISHED_STATUSES else item.get('progress') or 0
+                   for item in items) / len(items)
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'status': 'completed' if finished == len(items) else 'running',
+        'total': len(items),
+        'counts': counts,
+        'progress': round(progress, 1),
+        'downloaded_bytes': sum(item.get('downloaded_bytes') or 0 for item in items),
+        'total_bytes': sum(item.get('total_bytes') or 0 for item in items),
+        'archive_url': f"/batch/{batch_id}/zip",
+        'items': items
+    })
+
+@bp.route('/batch/<batch_id>/zip')
+def download_batch_zip(batch_id):
+    """ZIP-архив с файлами пакета, который собирается по мере готовности файлов"""
+    if not job_store.list_by_batch(batch_id):
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    def entries():
+        sent = set()
+        names = set()
+        # Одно и то же видео в пакете дважды - в архив попадает один раз
+        files = set()
+        errors = []
+        while True:
+            jobs = job_store.list_by_batch(batch_id)
+            for job in jobs:
+                if job.download_id in sent or job.status not in FINISHED_STATUSES:
+                    continue
+                sent.add(job.download_id)
+                if job.status == 'completed' and job.filepath in files:
+                    continue
+                if job.status == 'completed' and job.filepath and os.path.exists(job.filepath):
+                    files.add(job.filepath)
+                    with storage.using(job.filepath):
+                        yield job.filepath, unique_name(public_filename(job.filename), names), None
+                else:
+                    errors.append(f"{job.url}: {job.error or 'file not found'}")
+            if len(sent) == len(jobs):
+                break
+            job_store.wait(config['EVENTS_KEEPALIVE'])
+        if errors:
+            yield None, unique_name('errors.txt', names), '\n'.join(errors) + '\n'
+    
+    return Response(
+        stream_with_context(chunk for chunk in iter_zip(entries()) if chunk),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{batch_id}.zip"',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@bp.route('/stats')
+def get_stats():
+    """Статистика очереди загрузок и кэша метаданных"""
+    return jsonify({
+        'queue': download_pool.stats(),
+        'info_cache': video_cache.stats(),
+        'results': result_store.stats(),
+        'storage': storage.stats(),
+        'http': http_client.stats(),
+        'thumbnails': thumbnail_cache.stats(),
+        'bandwidth': bandwidth.stats(),
+        'jobs': job_store.count(),
+        'batches': len(batch_runners)
+    })
+
+@bp.route('/health')
+def health():
+    """Готов ли узел принимать загрузки: 503, если ffmpeg не найден или не умеет нужного"""
+    problems = ffmpeg_problems()
+    return jsonify({
+        'status': 'unavailable' if problems else 'ok',
+        'problems': problems,
+        'worker': WORKER_ID,
+        'ffmpeg': ffmpeg_info.to_dict(),
+        'audio_formats': available_audio_formats()
+    }), 503 if problems else 200
+
+@bp.route('/thumbnail/<video_id>')
+def get_thumbnail(video_id):
+    """Превью видео из локального кэша. ?size=<ширина> - уменьшенная копия"""
+    if not re.fullmatch(r'[\w-]{11}', video_id):
+        return jsonify({'error': 'Invalid video id'}), 404
+    try:
+        thumbnail, exact = thumbnail_cache.get(video_id, request.args.get('size', type=int))
+    except Exception as e:
+        return jsonify({'error': f'Thumbnail unavailable: {str(e)}'}), 502
+    
+    response = Response(thumbnail.data, mimetype=thumbnail.mimetype)
+    response.set_etag(thumbnail.etag)
+    response.cache_control.public = True
+    # Пока уменьшенная копия строится, оригинал кэшируется браузером ненадолго
+    response.cache_control.max_age = config['THUMBNAIL_MAX_AGE'] if exact else 60
+    return response.make_conditional(request)
+
+@bp.route('/bandwidth', methods=['GET', 'POST'])
+def bandwidth_limits():
+    """Текущие ограничения скорости; POST {"limit": байт/с, "job_limit": байт/с} меняет их на лету.
+
+    Изменение доступно только с токеном ADMIN_TOKEN (Authorization: Bearer <токен>).
+    """
+    if request.method == 'POST':
+        denied = admin_denied('Changing limits')
+        if denied:
+            message, status = denied
+            return jsonify({'error': message}), status
+        data = request.get_json(silent=True) or {}
+        limits = {}
+        for field, name in (('limit', 'rate'), ('job_limit', 'job_rate')):
+            if data.get(field) is None:
+                continue
+            value = data[field]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                return jsonify({'error': f'{field} must be a non-negative number of bytes per second'}), 400
+            limits[name] = value
+        bandwidth.configure(**limits)
+    return jsonify(bandwidth.stats())
+
+@bp.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@bp.route('/cleanup', methods=['POST'])
 def cleanup_old_files():
-    """Очистка старых файлов (опционально)"""
+    """Очистка папки загрузок сейчас, не дожидаясь фоновой"""
     try:
-        # Удаляем файлы старше 24 часов
-        import time
-        current_time = time.time()
-        deleted_files = []
-        
-        for filename in os.listdir(app.config['DOWNLOAD_FOLDER']):
-            filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-            file_age = current_time - os.path.getmtime(filepath)
-            
-            if file_age > 24 * 3600:  # 24 часа
-                os.remove(filepath)
-                deleted_files.append(filename)
+        # Вытесняем файлы сверх бюджета и старше STORAGE_MAX_AGE, убираем брошенные временные
+        deleted_files = storage.sweep()
         
         # Очищаем старые статусы
-        global download_status
-        download_status = {k: v for k, v in download_status.items() 
-                          if v.get('status') != 'completed' or 
-                          'filepath' in v and os.path.exists(v['filepath'])}
+        for job in job_store.list_by_status(['completed']):
+            if not job.filepath or not os.path.exists(job.filepath):
+                job_store.delete(job.download_id)
+        job_store.evict_expired()
         
         return jsonify({
             'message': f'Cleaned up {len(deleted_files)} old files',
@@ -583,5 +1398,166 @@ def cleanup_old_files():
     except Exception as e:
         return jsonify({'error': str(e), 'success': False}), 500
 
+def create_app(overrides=None):
+    """Создает приложение и компоненты процесса.
+    
+    Настройки берутся из config.py, файла из YTDL_SETTINGS, переменных окружения
+    YTDL_* и, последними, из overrides. Компоненты - глобальные переменные модуля
+    (ими пользуются фоновые загрузки), поэтому в процессе одно приложение.
+    """
+    global config, job_store, download_pool, video_cache, info_extractor, result_store, storage, \
+        http_client, bandwidth, thumbnail_cache, stream_fetcher, ffmpeg_info, flask_app
+    
+    app = Flask(__name__)
+    app.config.from_object('config')
+    app.config.from_envvar('YTDL_SETTINGS', silent=True)
+    app.config.from_prefixed_env('YTDL')
+    app.config.update(overrides or {})
+    app.config['USE_X_SENDFILE'] = app.config['FILE_OFFLOAD'] == 'x-sendfile'
+    config = app.config
+    
+    if not config['SSL_VERIFY']:
+        # Исправление проблемы с SSL сертификатами на macOS
+        # Это отключает проверку SSL сертификатов (для разработки)
+        ssl._create_default_https_context = ssl._create_unverified_context
+    
+    # Возможности ffmpeg проверяются один раз; узел без них не должен брать загрузки (/health)
+    ffmpeg_info = probe_ffmpeg()
+    problems = ffmpeg_problems()
+    if problems:
+        print(f"ffmpeg не готов: {'; '.join(problems)}")
+        if config['REQUIRE_FFMPEG']:
+            raise RuntimeError(f"ffmpeg не готов: {'; '.join(problems)}")
+    
+    # Создаем папку для загрузок
+    os.makedirs(config['DOWNLOAD_FOLDER'], exist_ok=True)
+    
+    # Хранилище задач загрузки: SQLite общий для всех процессов, memory - только для одного
+    if config['JOB_STORE'] == 'sqlite':
+        job_store = SQLiteJobStore(config['JOB_DB_PATH'], ttl=config['JOB_TTL'])
+    else:
+        job_store = MemoryJobStore(ttl=config['JOB_TTL'])
+    
+    # Пул фоновых загрузок
+    download_pool = DownloadPool(
+        fetch_workers=config['FETCH_WORKERS'],
+        merge_workers=config['MERGE_WORKERS'],
+        max_queue=config['MAX_QUEUE_SIZE'],
+        transcode_workers=config['TRANSCODE_WORKERS'],
+        on_wait=lambda seconds: STAGE_SECONDS.observe(seconds, stage='queue_wait'),
+        priorities=config['PRIORITY_CLASSES'],
+        aging=config['SCHEDULER_AGING'],
+        default_cost=config['SCHEDULER_DEFAULT_COST']
+    )
+    
+    # Кэш метаданных и списков потоков (общий для /get_info и /download)
+    video_cache = VideoInfoCache(
+        lambda url: load_video(url),
+        max_entries=config['INFO_CACHE_SIZE'],
+        ttl=config['INFO_CACHE_TTL']
+    )
+    
+    # Извлечение метаданных видео из пакетов заранее, пока загрузки ждут очереди
+    info_extractor = ThreadPoolExecutor(
+        max_workers=config['BATCH_EXTRACT_WORKERS'],
+        thread_name_prefix='info-extractor'
+    )
+    
+    # Готовые файлы, общие для всех пользователей
+    if config['JOB_STORE'] == 'sqlite':
+        # Одинаковые запросы в разные процессы тоже присоединяются к одной загрузке
+        result_store = SQLiteResultStore(
+            config['DOWNLOAD_FOLDER'],
+            config['JOB_DB_PATH'],
+            is_active=lambda download_id: job_is_active(download_id)
+        )
+    else:
+        result_store = ResultStore(config['DOWNLOAD_FOLDER'])
+    
+    # Место на диске: LRU-вытеснение готовых файлов и уборка брошенных временных.
+    # С общим хранилищем задач индекс места тоже общий для всех процессов
+    if config['JOB_STORE'] == 'sqlite':
+        storage = SQLiteStorageManager(
+            config['DOWNLOAD_FOLDER'],
+            config['JOB_DB_PATH'],
+            max_bytes=config['STORAGE_MAX_BYTES'],
+            max_age=config['STORAGE_MAX_AGE'],
+            is_active=lambda download_id: job_is_active(download_id),
+            owner=WORKER_ID,
+            owner_alive=owner_alive
+        )
+    else:
+        storage = StorageManager(
+            config['DOWNLOAD_FOLDER'],
+            max_bytes=config['STORAGE_MAX_BYTES'],
+            max_age=config['STORAGE_MAX_AGE'],
+            is_active=lambda download_id: job_is_active(download_id)
+        )
+    
+    # Общий пул HTTP-соединений к серверам потоков
+    http_client = HTTPClient(
+        max_per_host=config['HTTP_MAX_PER_HOST'],
+        idle_timeout=config['HTTP_IDLE_TIMEOUT']
+    )
+    
+    # Ограничение скорости: общее, поровну между загрузками, и на одну загрузку.
+    # С общим хранилищем задач лимиты общие для всех процессов
+    if config['JOB_STORE'] == 'sqlite':
+        bandwidth = SharedBandwidthShaper(
+            config['JOB_DB_PATH'],
+            WORKER_ID,
+            rate=config['BANDWIDTH_LIMIT'],
+            job_rate=config['JOB_BANDWIDTH_LIMIT']
+        )
+        bandwidth.start()
+    else:
+        bandwidth = BandwidthShaper(
+            rate=config['BANDWIDTH_LIMIT'],
+            job_rate=config['JOB_BANDWIDTH_LIMIT']
+        )
+    
+    # Превью видео: скачиваются с YouTube один раз и отдаются через /thumbnail
+    thumbnail_cache = ThumbnailCache(
+        config['THUMBNAIL_FOLDER'],
+        lambda video_id: fetch_thumbnail(video_id),
+        max_bytes=config['THUMBNAIL_CACHE_BYTES'],
+        memory_bytes=config['THUMBNAIL_MEMORY_BYTES'],
+        sizes=config['THUMBNAIL_SIZES'],
+        executor=ThreadPoolExecutor(max_workers=config['THUMBNAIL_WORKERS'], thread_name_prefix='thumbnail')
+    )
+    
+    # Загрузчик потоков по range-запросам
+    stream_fetcher = StreamFetcher(
+        max_connections=config['FETCH_CONNECTIONS'],
+        segment_size=config['SEGMENT_SIZE'],
+        retries=config['FETCH_RETRIES'],
+        backoff=config['FETCH_BACKOFF'],
+        client=http_client,
+        shaper=bandwidth
+    )
+    
+    app.register_blueprint(bp)
+    
+    # Продолжаем загрузки, прерванные остановкой процесса
+    if config['RESUME_ON_STARTUP']:
+        resume_interrupted_jobs()
+    
+    # Индекс файлов строится один раз, дальше обновляется по событиям загрузок
+    storage.scan()
+    storage.start(config['STORAGE_SWEEP_INTERVAL'])
+    
+    flask_app = app
+    return app
+
+def __getattr__(name):
+    # app.app (gunicorn app:app, from app import app) - приложение, созданное create_app(),
+    # или приложение с настройками по умолчанию
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with flask_app_lock:
+        if flask_app is None:
+            create_app()
+    return flask_app
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5001)
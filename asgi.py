@@ -0,0 +1,354 @@
+# ASGI-режим приложения: uvicorn asgi:application
+#
+# /status и /events обслуживаются прямо в event loop: тысячи клиентов,
+# следящих за прогрессом, не занимают потоков. Остальные маршруты идут во
+# Flask-приложение через мост, который выполняет код Flask (извлечение
+# метаданных, чтение файлов) в пуле потоков, а отправку байтов клиенту -
+# асинхронно, поэтому медленный клиент не держит поток на всю передачу.
+# Скачивание и ffmpeg по-прежнему выполняются в DownloadPool.
+import asyncio
+import contextvars
+import io
+import json
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wsgi import FileWrapper
+
+import app as downloader
+from job_store import FINISHED_STATUSES
+
+STATUS_PATH = re.compile(r'^/status/([^/]+)$')
+EVENTS_PATH = re.compile(r'^/events/([^/]+)$')
+QUEUE_POSITION_INTERVAL = 2  # Как часто обновлять позицию в очереди для /events, секунды
+FILE_BLOCK_SIZE = 1024 * 1024  # Блок чтения файлов ответа (send_file): один переход в пул на блок
+
+
+class JobChangeNotifier:
+    """Один поток следит за версиями задач, на которые подписаны клиенты, и в event loop
+    будит только подписчиков изменившихся задач.
+
+    Проверка изменений - один запрос к хранилищу на все подписки, а не
+    build_status на каждого клиента при каждом пробуждении хранилища.
+    """
+
+    def __init__(self, store, loop, timeout=1.0):
+        self.store = store
+        self.loop = loop
+        self.timeout = timeout
+        self._subscribers = {}  # download_id -> события подписчиков
+        self._versions = {}  # Версии задач при прошлой проверке (только поток наблюдателя)
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._watch, name='job-change-notifier', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def subscribe(self, download_id):
+        event = asyncio.Event()
+        with self._lock:
+            self._subscribers.setdefault(download_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, download_id, event):
+        with self._lock:
+            events = self._subscribers.get(download_id)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self._subscribers[download_id]
+
+    async def wait(self, event, timeout):
+        """Ждет изменения задачи подписки не дольше timeout секунд. True, если она изменилась"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        event.clear()
+        return True
+
+    def _watch(self):
+        while not self._stopped:
+            self.store.wait(self.timeout)
+            with self._lock:
+                download_ids = list(self._subscribers)
+            if not download_ids:
+                self._versions = {}
+                continue
+            try:
+                versions = self.store.versions(download_ids)
+            except Exception as e:
+                print(f"Ошибка при проверке изменений задач: {str(e)}")
+                continue
+            # Удаленная задача тоже изменение: подписчик узнает, что ее больше нет
+            changed = [download_id for download_id in download_ids
+                       if versions.get(download_id) != self._versions.get(download_id)]
+            self._versions = versions
+            if not changed:
+                continue
+            try:
+                self.loop.call_soon_threadsafe(self._fire, changed)
+            except RuntimeError:
+                # event loop уже закрыт
+                return
+
+    def _fire(self, changed):
+        with self._lock:
+            events = [event for download_id in changed for event in self._subscribers.get(download_id, ())]
+        for event in events:
+            event.set()
+
+
+class AsyncApplication:
+    """ASGI-приложение поверх Flask-приложения app"""
+
+    def __init__(self, flask_app, threads=32, body_threads=256):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+        # Тела ответов читаются в отдельном пуле: /stream ждет байтов загрузки
+        # до минуты внутри next(), и зрители не должны занимать потоки маршрутов
+        self.body_executor = ThreadPoolExecutor(max_workers=body_threads, thread_name_prefix='asgi-body')
+        self.notifier = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        if self.notifier is None:
+            # Сервер без поддержки lifespan
+            self.start_notifier()
+
+        path = scope['path']
+        if scope['method'] == 'GET':
+            match = STATUS_PATH.match(path)
+            if match:
+                await self.status(match.group(1), send)
+                return
+            match = EVENTS_PATH.match(path)
+            if match:
+                await self.events(match.group(1), receive, send)
+                return
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start_notifier()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.notifier:
+                    self.notifier.stop()
+                self.executor.shutdown(wait=False)
+                self.body_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def start_notifier(self):
+        self.notifier = JobChangeNotifier(downloader.job_store, asyncio.get_running_loop())
+        self.notifier.start()
+
+    async def run_blocking(self, func, *args, context=None, executor=None):
+        """Выполняет блокирующий вызов в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        executor = executor or self.executor
+        if context is not None:
+            return await loop.run_in_executor(executor, context.run, func, *args)
+        return await loop.run_in_executor(executor, func, *args)
+
+    async def status(self, download_id, send):
+        """GET /status/<download_id> без Flask"""
+        status = await self.run_blocking(downloader.build_status, download_id)
+        if status is None:
+            await send_json(send, 404, {'error': 'Download not found'})
+        else:
+            await send_json(send, 200, status)
+
+    async def events(self, download_id, receive, send):
+        """GET /events/<download_id>: SSE в event loop, без отдельного потока на клиента"""
+        status = await self.run_blocking(downloader.build_status, download_id)
+        if status is None:
+            await send_json(send, 404, {'error': 'Download not found'})
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        changes = self.notifier.subscribe(download_id)
+        keepalive = self.flask_app.config['EVENTS_KEEPALIVE']
+        loop = asyncio.get_running_loop()
+        last_sent = None
+        last_sent_at = loop.time()
+        try:
+            while not disconnected.done():
+                if status is None:
+                    break
+                payload = json.dumps(status, ensure_ascii=False)
+                if payload != last_sent:
+                    last_sent = payload
+                    last_sent_at = loop.time()
+                    await send_body(send, f"data: {payload}\n\n".encode())
+                elif loop.time() - last_sent_at >= keepalive:
+                    # Комментарий SSE не дает прокси закрыть простаивающее соединение
+                    last_sent_at = loop.time()
+                    await send_body(send, b": keepalive\n\n")
+                if status.get('status') in FINISHED_STATUSES:
+                    break
+
+                # Позиция в очереди меняется без изменения самой задачи - ее уточняем периодически
+                queued = status.get('status') == 'queued'
+                changed = await self.notifier.wait(changes, QUEUE_POSITION_INTERVAL if queued else keepalive)
+                if changed or queued:
+                    status = await self.run_blocking(downloader.build_status, download_id)
+            if not disconnected.done():
+                await send_body(send, b'', more_body=False)
+        finally:
+            self.notifier.unsubscribe(download_id, changes)
+            disconnected.cancel()
+
+    async def call_wsgi(self, scope, receive, send):
+        """Передает запрос Flask, читая ответ по частям в пуле потоков"""
+        body = await read_body(receive, self.flask_app.config.get('MAX_CONTENT_LENGTH'))
+        if body is None:
+            await send_json(send, 413, {'error': 'Request body is too large'})
+            return
+
+        environ = build_environ(scope, body)
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        # Все шаги одного запроса выполняются в одном контексте: контексты
+        # Flask хранятся в contextvars, а части ответа читают разные потоки
+        context = contextvars.copy_context()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+
+        result = await self.run_blocking(self.flask_app, environ, start_response, context=context)
+        try:
+            iterator = iter(result)
+            chunk = await self.run_blocking(next, iterator, None, context=context, executor=self.body_executor)
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': started['headers'],
+            })
+            while chunk is not None and not disconnected.done():
+                if chunk:
+                    await send_body(send, chunk)
+                chunk = await self.run_blocking(next, iterator, None, context=context, executor=self.body_executor)
+            if not disconnected.done():
+                await send_body(send, b'', more_body=False)
+        finally:
+            disconnected.cancel()
+            if hasattr(result, 'close'):
+                await self.run_blocking(result.close, context=context, executor=self.body_executor)
+
+
+async def read_body(receive, limit=None):
+    """Читает тело запроса целиком. None, если оно больше limit"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if limit and size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def send_body(send, data, more_body=True):
+    await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+
+async def send_json(send, status, data):
+    body = json.dumps(data, ensure_ascii=False).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send_body(send, body, more_body=False)
+
+
+def build_environ(scope, body):
+    """WSGI environ для ASGI-запроса"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        # Тело уже прочитано целиком, так что длина известна и для chunked-запросов
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        # send_file читает файл этими блоками вместо 8 КБ по умолчанию
+        'wsgi.file_wrapper': lambda file, buffer_size=FILE_BLOCK_SIZE: FileWrapper(file, max(buffer_size, FILE_BLOCK_SIZE)),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            continue
+        else:
+            key = f"HTTP_{name}"
+            # Повторные заголовки склеиваются через запятую, а Cookie - через '; '
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            environ[key] = f"{environ[key]}{separator}{value}" if key in environ else value
+    return environ
+
+
+app = downloader.create_app()
+application = AsyncApplication(app, threads=app.config['ASGI_THREADS'], body_threads=app.config['ASGI_BODY_THREADS'])
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("Для ASGI-режима установите сервер: pip install uvicorn")
+        sys.exit(1)
+    uvicorn.run(application, host='0.0.0.0', port=5001)
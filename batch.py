@@ -0,0 +1,139 @@
+import os
+import re
+import threading
+import zipfile
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+
+from download_pool import QueueFullError
+
+# Ссылки на каналы: /channel/<id>, /c/<имя>, /user/<имя>, /@<handle>
+CHANNEL_PATTERN = re.compile(r'youtube\.com/(?:channel/|c/|user/|@)')
+
+
+def is_playlist_url(url):
+    return 'list' in parse_qs(urlparse(url).query)
+
+
+def is_channel_url(url):
+    return bool(CHANNEL_PATTERN.search(url))
+
+
+class BatchRunner:
+    """Ставит задачи пакета в общую очередь пула, не больше concurrency одновременно.
+
+    Остальные задачи пакета ждут здесь и не занимают места в очереди, поэтому
+    большой плейлист не вытесняет одиночные загрузки других пользователей.
+    """
+
+    def __init__(self, pool, func, download_ids, concurrency=2, retry_delay=5, on_finish=None, options=None):
+        # func(download_id) выполняет одну загрузку в потоке пула
+        self.pool = pool
+        self.func = func
+        # options(download_id) -> аргументы pool.submit (класс приоритета, оценка стоимости)
+        self.options = options or (lambda download_id: {})
+        self.concurrency = max(1, concurrency)
+        self.retry_delay = retry_delay
+        self.on_finish = on_finish
+
+        self._pending = deque(download_ids)
+        self._running = 0
+        self._lock = threading.Lock()
+        self._retry_timer = None
+
+    def start(self):
+        self._schedule()
+
+    def _schedule(self):
+        with self._lock:
+            while self._pending and self._running < self.concurrency:
+                download_id = self._pending[0]
+                try:
+                    self.pool.submit(download_id, self._run, download_id, **self.options(download_id))
+                except QueueFullError:
+                    # Очередь занята другими загрузками - пробуем позже
+                    if self._retry_timer is None:
+                        self._retry_timer = threading.Timer(self.retry_delay, self._retry)
+                        self._retry_timer.daemon = True
+                        self._retry_timer.start()
+                    return
+                self._pending.popleft()
+                self._running += 1
+            finished = not self._pending and self._running == 0
+        if finished and self.on_finish:
+            self.on_finish()
+
+    def _retry(self):
+        with self._lock:
+            self._retry_timer = None
+        self._schedule()
+
+    def _run(self, download_id):
+        try:
+            self.func(download_id)
+        finally:
+            with self._lock:
+                self._running -= 1
+            self._schedule()
+
+
+class ZipStream:
+    """Файлоподобный буфер только для записи: zipfile пишет в него, генератор забирает байты.
+
+    У буфера нет seek/tell, поэтому zipfile записывает размеры и CRC после
+    данных каждого файла и архив можно отдавать клиенту по частям.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(entries, chunk_size=1024 * 1024):
+    """Собирает ZIP на лету. entries - итератор (путь или None, имя в архиве, байты или None).
+
+    Для путей файл копируется блоками без сжатия (видео уже сжато),
+    для записей без пути в архив пишутся переданные байты.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for path, arcname, data in entries:
+            if path is None:
+                archive.writestr(arcname, data)
+            else:
+                # Размер известен заранее - zipfile сам решит, нужен ли ZIP64
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                info.compress_type = zipfile.ZIP_STORED
+                with open(path, 'rb') as source, archive.open(info, 'w') as target:
+                    while True:
+                        chunk = source.read(chunk_size)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield stream.drain()
+            yield stream.drain()
+    # Центральный каталог записывается при закрытии архива
+    yield stream.drain()
+
+
+def unique_name(name, used):
+    """Имя в архиве без повторов: video.mp4, video (2).mp4, ..."""
+    base, ext = os.path.splitext(name)
+    candidate = name
+    counter = 2
+    while candidate in used:
+        candidate = f"{base} ({counter}){ext}"
+        counter += 1
+    used.add(candidate)
+    return candidate
@@ -0,0 +1,123 @@
+import os
+import shutil
+import subprocess
+import time
+
+from urllib.parse import urlparse, parse_qs
+
+# Потоки тестового видео: itag -> описание. Размеры - доли от размера
+# adaptive-видео 1080p, чтобы один параметр масштабировал весь набор
+STREAMS = {
+    '18': {'kind': 'progressive', 'resolution': '360p', 'share': 0.25, 'subtype': 'mp4'},
+    '22': {'kind': 'progressive', 'resolution': '720p', 'share': 0.5, 'subtype': 'mp4'},
+    '137': {'kind': 'video', 'resolution': '1080p', 'share': 1.0, 'subtype': 'mp4'},
+    '140': {'kind': 'audio', 'abr': '128kbps', 'share': 0.0625, 'subtype': 'mp4'},
+}
+
+
+def make_fixtures(folder, video_size, duration, use_ffmpeg=False):
+    """Создает файлы потоков. Возвращает {itag: путь}.
+
+    С use_ffmpeg - настоящие MP4/M4A из тестового сигнала (их сможет объединить
+    ffmpeg), иначе случайные байты нужного размера для заглушки ffmpeg.
+    """
+    os.makedirs(folder, exist_ok=True)
+    files = {}
+    for itag, info in STREAMS.items():
+        path = os.path.join(folder, f"{itag}.{'m4a' if info['kind'] == 'audio' else 'mp4'}")
+        size = max(1024, int(video_size * info['share']))
+        if use_ffmpeg:
+            generate_media(path, info, size, duration)
+        else:
+            write_random(path, size)
+        files[itag] = path
+    return files
+
+
+def write_random(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def generate_media(path, info, size, duration):
+    """Кодирует тестовый сигнал с битрейтом, дающим примерно size байт"""
+    bitrate = max(8000, int(size * 8 / duration))
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error']
+    if info['kind'] != 'audio':
+        height = int(info['resolution'].rstrip('p'))
+        cmd += ['-f', 'lavfi', '-i', f"testsrc2=size={height * 16 // 9}x{height}:rate=30:duration={duration}"]
+    if info['kind'] != 'video':
+        cmd += ['-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}"]
+    if info['kind'] != 'audio':
+        cmd += ['-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', str(bitrate)]
+    if info['kind'] != 'video':
+        cmd += ['-c:a', 'aac', '-b:a', '128k' if info['kind'] == 'progressive' else str(bitrate)]
+    subprocess.run(cmd + ['-movflags', '+faststart', path], check=True)
+
+
+def ffmpeg_available():
+    return shutil.which('ffmpeg') is not None
+
+
+class FakeStream:
+    """Поток с теми атрибутами pytubefix.Stream, которые использует приложение"""
+
+    def __init__(self, base_url, video_id, itag, info, filesize):
+        self.itag = int(itag)
+        self.filesize = filesize
+        self.subtype = info['subtype']
+        self.is_progressive = info['kind'] == 'progressive'
+        self.is_adaptive = not self.is_progressive
+        self.includes_video_track = info['kind'] != 'audio'
+        self.includes_audio_track = info['kind'] != 'video'
+        self.type = 'audio' if info['kind'] == 'audio' else 'video'
+        self.mime_type = f"{self.type}/{self.subtype}"
+        self.resolution = info.get('resolution')
+        self.abr = info.get('abr')
+        self.fps = 30 if self.includes_video_track else None
+        self.bitrate = None
+        self.video_codec = 'avc1.640028' if self.includes_video_track else None
+        self.audio_codec = 'mp4a.40.2' if self.includes_audio_track else None
+        self.codecs = [codec for codec in (self.video_codec, self.audio_codec) if codec]
+        # ID видео в ссылке только для логов: содержимое одинаково для всех видео
+        self.url = f"{base_url}/{itag}?id={video_id}&expire={int(time.time()) + 6 * 3600}"
+
+
+class FakeYouTubeFactory:
+    """Замена pytubefix.YouTube: любое видео состоит из потоков STREAMS.
+
+    extract_latency имитирует время извлечения (запросы к YouTube и расшифровку подписей).
+    """
+
+    def __init__(self, base_url, files, duration, extract_latency=0.0):
+        self.base_url = base_url
+        self.sizes = {itag: os.path.getsize(path) for itag, path in files.items()}
+        self.duration = duration
+        self.extract_latency = extract_latency
+        self.extractions = 0
+
+    def __call__(self, url, *args, **kwargs):
+        self.extractions += 1
+        if self.extract_latency:
+            time.sleep(self.extract_latency)
+        return FakeYouTube(self, url)
+
+
+class FakeYouTube:
+    def __init__(self, factory, url):
+        self.watch_url = url
+        self.video_id = parse_qs(urlparse(url).query).get('v', [url.rstrip('/').rsplit('/', 1)[-1]])[0]
+        self.title = f"Benchmark video {self.video_id}"
+        self.author = 'benchmark'
+        self.length = factory.duration
+        self.views = 0
+        self.thumbnail_url = f"{factory.base_url}/thumbnail/{self.video_id}.jpg"
+        self.streams = [
+            FakeStream(factory.base_url, self.video_id, itag, info, factory.sizes[itag])
+            for itag, info in STREAMS.items()
+        ]
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# Бенчмарки загрузчика без доступа к YouTube.
+#
+# pytubefix.YouTube подменяется фейком (fake_youtube.py), а потоки отдает
+# локальный HTTP-сервер (stream_server.py) с заданной скоростью и задержкой.
+# Без ffmpeg в PATH используется заглушка из bin/: она проверяет путь данных,
+# но не стоимость настоящего объединения.
+#
+# Запуск из корня репозитория:
+#   python benchmarks/run.py --output results.json
+#   python benchmarks/run.py --bandwidth-mbps 50 --latency-ms 30 --baseline results.json
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+from fake_youtube import FakeYouTubeFactory, make_fixtures, ffmpeg_available
+from stream_server import StreamServer
+
+SAMPLE_PATTERN = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарки YouTube Downloader на локальной замене YouTube')
+    parser.add_argument('--output', help='Файл для результатов в JSON (по умолчанию stdout)')
+    parser.add_argument('--baseline', help='Результаты прошлой ревизии для сравнения')
+    parser.add_argument('--video-mb', type=float, default=8, help='Размер adaptive-видео 1080p, МБ (остальные потоки пропорционально)')
+    parser.add_argument('--duration', type=int, default=60, help='Длительность тестового видео, секунды')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='Скорость одного соединения, Мбит/с (0 - без ограничения)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Задержка ответа сервера потоков, мс')
+    parser.add_argument('--extract-ms', type=float, default=200, help='Время извлечения видео фейковым pytubefix, мс')
+    parser.add_argument('--ffmpeg', choices=('auto', 'system', 'stub'), default='auto')
+    parser.add_argument('--info-requests', type=int, default=20, help='Запросов /get_info на сценарий')
+    parser.add_argument('--repeat', type=int, default=3, help='Загрузок на один вариант пропускной способности')
+    parser.add_argument('--concurrency', default='1,10,100', help='Уровни параллельности через запятую')
+    parser.add_argument('--concurrency-quality', default='360p', help='Качество для сценария параллельности')
+    parser.add_argument('--timeout', type=float, default=600, help='Максимальное время сценария, секунды')
+    parser.add_argument('--keep', action='store_true', help='Не удалять рабочую папку')
+    return parser.parse_args()
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except Exception:
+        return None
+
+
+def summarize(values, scale=1.0, digits=3):
+    """min/mean/p50/p95/max списка значений"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'min': round(ordered[0] * scale, digits),
+        'mean': round(statistics.fmean(ordered) * scale, digits),
+        'p50': round(percentile(50) * scale, digits),
+        'p95': round(percentile(95) * scale, digits),
+        'max': round(ordered[-1] * scale, digits),
+    }
+
+
+def scrape(client):
+    """Снимок /metrics: {(имя, метки): значение}"""
+    samples = {}
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        match = SAMPLE_PATTERN.match(line)
+        if match:
+            labels = tuple(sorted(LABEL_PATTERN.findall(match.group(2) or '')))
+            samples[(match.group(1), labels)] = float(match.group(3))
+    return samples
+
+
+def histogram_delta(before, after, name, label):
+    """Количество и средняя длительность наблюдений гистограммы между двумя снимками"""
+    result = {}
+    for (sample, labels), value in after.items():
+        if sample != f"{name}_count":
+            continue
+        count = value - before.get((sample, labels), 0)
+        if not count:
+            continue
+        total = after[(f"{name}_sum", labels)] - before.get((f"{name}_sum", labels), 0)
+        key = dict(labels).get(label, '')
+        result[key] = {'count': int(count), 'mean_seconds': round(total / count, 4)}
+    return result
+
+
+class Bench:
+    def __init__(self, app_module, args):
+        self.app = app_module
+        self.client = app_module.app.test_client()
+        self.args = args
+
+    def new_url(self):
+        # Новый ID на каждую загрузку: иначе сработает кэш готовых файлов
+        return f"https://www.youtube.com/watch?v=b{uuid.uuid4().hex[:10]}"
+
+    def reset_downloads(self):
+        """Удаляет готовые файлы прошлого сценария, чтобы не копить их на диске"""
+        folder = self.app.app.config['DOWNLOAD_FOLDER']
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                os.remove(path)
+        self.app.storage.scan()
+
+    def submit(self, url, quality):
+        response = self.client.post('/download', json={'url': url, 'quality': quality})
+        if response.status_code == 429:
+            return None
+        if response.status_code != 200:
+            raise Exception(f"/download вернул {response.status_code}: {response.get_data(as_text=True)}")
+        return response.json['download_id']
+
+    def wait(self, submitted):
+        """Ждет завершения задач {download_id: время отправки}. Возвращает {download_id: (job, секунды)}"""
+        finished = {}
+        deadline = time.monotonic() + self.args.timeout
+        while len(finished) < len(submitted):
+            if time.monotonic() > deadline:
+                raise Exception(f"Не дождались {len(submitted) - len(finished)} загрузок")
+            for download_id, started in submitted.items():
+                if download_id in finished:
+                    continue
+                job = self.app.job_store.get(download_id)
+                if job and job.status in ('completed', 'error'):
+                    finished[download_id] = (job, time.monotonic() - started)
+            time.sleep(0.01)
+        return finished
+
+    def download(self, quality, count):
+        """count загрузок, отправленных одновременно"""
+        submitted = {}
+        rejected = 0
+        started = time.monotonic()
+        for _ in range(count):
+            download_id = self.submit(self.new_url(), quality)
+            if download_id is None:
+                rejected += 1
+            else:
+                submitted[download_id] = time.monotonic()
+        finished = self.wait(submitted)
+        elapsed = time.monotonic() - started
+
+        errors = [job.error for job, _ in finished.values() if job.status == 'error']
+        completed = [(job, seconds) for job, seconds in finished.values() if job.status == 'completed']
+        total_bytes = sum(os.path.getsize(job.filepath) for job, _ in completed if job.filepath)
+        return {
+            'jobs': count,
+            'completed': len(completed),
+            'rejected': rejected,
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'wall_seconds': round(elapsed, 3),
+            'latency_seconds': summarize([seconds for _, seconds in completed]),
+            'throughput_mb_s': round(total_bytes / elapsed / 1e6, 3) if elapsed else None,
+            'per_job_mb_s': summarize([os.path.getsize(job.filepath) / seconds for job, seconds in completed
+                                       if job.filepath and seconds], scale=1e-6),
+        }
+
+    def get_info(self):
+        def measure(urls):
+            latencies = []
+            for url in urls:
+                started = time.perf_counter()
+                response = self.client.post('/get_info', json={'url': url})
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise Exception(f"/get_info вернул {response.status_code}")
+            return summarize(latencies, scale=1000)
+
+        count = self.args.info_requests
+        warm_url = self.new_url()
+        self.client.post('/get_info', json={'url': warm_url})
+        return {
+            'cold_ms': measure([self.new_url() for _ in range(count)]),
+            'warm_ms': measure([warm_url] * count),
+        }
+
+    def throughput(self):
+        """Одна загрузка за раз: progressive (720p) против adaptive (1080p + аудио)"""
+        results = {}
+        for path, quality in (('progressive', '720p'), ('adaptive', '1080p')):
+            before = scrape(self.client)
+            runs = [self.download(quality, 1) for _ in range(self.args.repeat)]
+            after = scrape(self.client)
+            results[path] = {
+                'quality': quality,
+                'mb_s': summarize([run['throughput_mb_s'] for run in runs if run['completed']]),
+                'seconds': summarize([run['wall_seconds'] for run in runs if run['completed']]),
+                'errors': sum(run['errors'] for run in runs),
+                'stages': histogram_delta(before, after, 'ytdl_stage_seconds', 'stage'),
+            }
+            self.reset_downloads()
+        return results
+
+    def merge(self):
+        """Стоимость ffmpeg: объединение на лету против объединения скачанных файлов"""
+        results = {}
+        streaming = self.app.app.config['STREAMING_MERGE']
+        try:
+            for mode, enabled in (('streaming', True), ('files', False)):
+                self.app.app.config['STREAMING_MERGE'] = enabled
+                before = scrape(self.client)
+                runs = [self.download('1080p', 1) for _ in range(self.args.repeat)]
+                after = scrape(self.client)
+                results[mode] = {
+                    'seconds': summarize([run['wall_seconds'] for run in runs if run['completed']]),
+                    'errors': sum(run['errors'] for run in runs),
+                    'ffmpeg': histogram_delta(before, after, 'ytdl_ffmpeg_seconds', 'operation'),
+                    'stages': histogram_delta(before, after, 'ytdl_stage_seconds', 'stage'),
+                }
+                self.reset_downloads()
+        finally:
+            self.app.app.config['STREAMING_MERGE'] = streaming
+        return results
+
+    def concurrency(self):
+        results = {}
+        for level in (int(value) for value in self.args.concurrency.split(',') if value.strip()):
+            log(f"  {level} одновременных загрузок")
+            before = scrape(self.client)
+            result = self.download(self.args.concurrency_quality, level)
+            after = scrape(self.client)
+            result['queue_wait'] = histogram_delta(before, after, 'ytdl_stage_seconds', 'stage').get('queue_wait')
+            results[str(level)] = result
+            self.reset_downloads()
+        return results
+
+
+def flatten(data, prefix=''):
+    values = {}
+    for key, value in data.items():
+        path = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def compare(baseline, results):
+    """Печатает изменения числовых результатов относительно прошлой ревизии"""
+    old, new = flatten(baseline), flatten(results)
+    log(f"\nСравнение с {baseline.get('revision')} -> {results.get('revision')}:")
+    for key in sorted(set(old) & set(new)):
+        if key.startswith('params.') or key.endswith('.count') or not old[key]:
+            continue
+        change = (new[key] - old[key]) / old[key] * 100
+        log(f"  {key}: {old[key]} -> {new[key]} ({change:+.1f}%)")
+
+
+def main():
+    args = parse_args()
+    use_ffmpeg = args.ffmpeg == 'system' or (args.ffmpeg == 'auto' and ffmpeg_available())
+    if args.ffmpeg == 'system' and not ffmpeg_available():
+        sys.exit('ffmpeg не найден в PATH')
+
+    workdir = tempfile.mkdtemp(prefix='ytdl-bench-')
+    server = None
+    try:
+        log(f"Рабочая папка: {workdir}")
+        files = make_fixtures(os.path.join(workdir, 'streams'), int(args.video_mb * 1024 * 1024),
+                              args.duration, use_ffmpeg=use_ffmpeg)
+        server = StreamServer(files, bandwidth=args.bandwidth_mbps * 1e6 / 8, latency=args.latency_ms / 1000).start()
+        if not use_ffmpeg:
+            os.environ['PATH'] = os.path.join(BENCH_DIR, 'bin') + os.pathsep + os.environ.get('PATH', '')
+
+        # downloads/ и jobs.db приложения создаются в рабочей папке
+        os.chdir(workdir)
+        import app as app_module
+        app_module.load_video = FakeYouTubeFactory(server.base_url, files, args.duration, args.extract_ms / 1000)
+        app_module.create_app()
+        bench = Bench(app_module, args)
+
+        results = {
+            'revision': git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'ffmpeg': 'system' if use_ffmpeg else 'stub',
+            'params': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'keep')},
+        }
+        log('get_info...')
+        results['get_info'] = bench.get_info()
+        log('Пропускная способность...')
+        results['throughput'] = bench.throughput()
+        log('Объединение...')
+        results['merge'] = bench.merge()
+        log('Параллельные загрузки...')
+        results['concurrency'] = bench.concurrency()
+        results['server'] = server.stats()
+    finally:
+        if server:
+            server.stop()
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(value, size):
+    """'bytes=a-b' или 'a-b' -> (a, b) включительно, None если диапазон не задан"""
+    if not value:
+        return None
+    match = re.fullmatch(r'(?:bytes=)?(\d*)-(\d*)', value.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        # Суффикс: последние N байт
+        return max(0, size - int(match.group(2))), size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    return start, min(end, size - 1)
+
+
+class StreamServer:
+    """Локальная замена googlevideo: отдает файлы потоков с поддержкой range-запросов.
+
+    bandwidth - ограничение скорости одного соединения (байт/с, 0 - без
+    ограничения), latency - задержка перед ответом на каждый запрос, секунды.
+    """
+
+    def __init__(self, files, bandwidth=0, latency=0.0, host='127.0.0.1', port=0):
+        # itag (строкой) -> путь к файлу потока
+        self.files = files
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever, name='stream-server', daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'bytes_sent': self.bytes_sent}
+
+    def _count(self, nbytes):
+        with self._lock:
+            self.bytes_sent += nbytes
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self.handle_request(send_body=False)
+
+            def do_GET(self):
+                self.handle_request(send_body=True)
+
+            def handle_request(self, send_body):
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+                parsed = urlparse(self.path)
+                path = server.files.get(parsed.path.strip('/'))
+                if path is None:
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+
+                # Как и googlevideo, принимаем диапазон и в параметре range, и в заголовке Range
+                byte_range = parse_range(parse_qs(parsed.query).get('range', [None])[0], size)
+                status = 200
+                if byte_range is None:
+                    byte_range = parse_range(self.headers.get('Range'), size)
+                    if byte_range is not None:
+                        status = 206
+                start, end = byte_range or (0, size - 1)
+                if start >= size or end < start:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{size}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                length = end - start + 1
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(length))
+                self.send_header('Accept-Ranges', 'bytes')
+                if status == 206:
+                    self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+                self.end_headers()
+                if not send_body:
+                    return
+
+                started = time.monotonic()
+                sent = 0
+                try:
+                    with open(path, 'rb') as f:
+                        f.seek(start)
+                        while sent < length:
+                            chunk = f.read(min(CHUNK_SIZE, length - sent))
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
+                            sent += len(chunk)
+                            server._count(len(chunk))
+                            if server.bandwidth:
+                                # Не отдаем больше bandwidth байт за прошедшее время
+                                delay = sent / server.bandwidth - (time.monotonic() - started)
+                                if delay > 0:
+                                    time.sleep(delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
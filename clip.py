@@ -0,0 +1,233 @@
+import io
+import math
+import os
+import struct
+import subprocess
+import threading
+
+from progress import parse_ffmpeg_progress
+from muxing import low_priority, FFmpegWatchdog
+
+HEAD_CHUNK = 64 * 1024  # Сколько байт начала файла читать за раз при поиске sidx
+MAX_INIT_SIZE = 4 * 1024 * 1024  # Дальше sidx не ищем: это не фрагментированный MP4
+
+
+def parse_time(value):
+    """'90', '1:30', '01:02:03.5' -> секунды. None для пустого значения"""
+    if value is None or value == '':
+        return None
+    # bool - подкласс int: True не должно становиться секундой
+    if isinstance(value, bool):
+        raise ValueError('start/end must be a number or a string')
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        seconds = 0.0
+        for part in str(value).strip().split(':'):
+            seconds = seconds * 60 + float(part)
+    # float() принимает 'nan' и 'inf' - такое время не имеет смысла
+    if not math.isfinite(seconds):
+        raise ValueError('start/end must be finite')
+    if seconds < 0:
+        raise ValueError('start/end must not be negative')
+    return seconds
+
+
+def parse_clip_options(start, end):
+    """Проверяет start/end из запроса. Возвращает (start, end) или бросает ValueError"""
+    try:
+        start, end = parse_time(start), parse_time(end)
+    except ValueError:
+        raise ValueError('start/end must be seconds or [hh:]mm:ss')
+    if start is None and end is None:
+        return None, None
+    start = start or 0.0
+    if end is not None and end <= start:
+        raise ValueError('end must be greater than start')
+    return start, end
+
+
+class SegmentIndex:
+    """Индекс сегментов фрагментированного MP4 (бокс sidx)"""
+
+    def __init__(self, init_size, segments):
+        # Байты [0, init_size) - инициализация (ftyp + moov), без нее сегменты не читаются
+        self.init_size = init_size
+        # (начало, конец) в секундах и (первый, последний) байт каждого сегмента
+        self.segments = segments
+
+    def byte_range(self, start, end):
+        """Диапазон байтов сегментов, покрывающих [start, end], и время начала первого из них"""
+        selected = [segment for segment in self.segments
+                    if segment[1] > start and (end is None or segment[0] < end)]
+        if not selected:
+            return None
+        return selected[0][2], selected[-1][3], selected[0][0]
+
+
+def parse_sidx(data, anchor):
+    """Разбирает тело бокса sidx. anchor - смещение первого байта после бокса"""
+    version = data[0]
+    timescale = struct.unpack('>I', data[8:12])[0]
+    if version == 0:
+        earliest, first_offset = struct.unpack('>II', data[12:20])
+        position = 20
+    else:
+        earliest, first_offset = struct.unpack('>QQ', data[12:28])
+        position = 28
+    count = struct.unpack('>H', data[position + 2:position + 4])[0]
+    position += 4
+
+    segments = []
+    offset = anchor + first_offset
+    time = earliest
+    for _ in range(count):
+        size, duration = struct.unpack('>II', data[position:position + 8])
+        size &= 0x7FFFFFFF
+        segments.append((time / timescale, (time + duration) / timescale, offset, offset + size - 1))
+        offset += size
+        time += duration
+        position += 12
+    return segments
+
+
+def find_segment_index(read_range, filesize):
+    """Ищет sidx в начале потока. read_range(start, end) возвращает байты. None, если индекса нет"""
+    head = b''
+
+    def ensure(end):
+        nonlocal head
+        while len(head) < end and len(head) < filesize:
+            head += read_range(len(head), min(filesize, len(head) + max(HEAD_CHUNK, end - len(head))) - 1)
+        return len(head) >= end
+
+    position = 0
+    while position < MAX_INIT_SIZE and ensure(position + 16):
+        size, box_type = struct.unpack('>I4s', head[position:position + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', head[position + 8:position + 16])[0]
+            header = 16
+        if size < header or (position == 0 and box_type != b'ftyp'):
+            return None
+        if box_type == b'sidx':
+            if not ensure(position + size):
+                return None
+            body = head[position + header:position + size]
+            return SegmentIndex(position, parse_sidx(body, position + size))
+        if box_type in (b'moof', b'mdat'):
+            # Медиаданные начались раньше индекса
+            return None
+        position += size
+    return None
+
+
+def fetch_clip(fetcher, stream, path, start, end, progress=None, refresh=None, job=None):
+    """Скачивает только сегменты потока, покрывающие [start, end].
+
+    Возвращает смещение начала клипа от начала скачанного файла в секундах
+    или None, если у потока нет индекса сегментов (не фрагментированный MP4).
+    """
+    filesize = stream.filesize
+    if not filesize or stream.subtype != 'mp4':
+        return None
+
+    def read_range(range_start, range_end):
+        buffer = io.BytesIO()
+        fetcher.copy_to(stream, buffer, None, refresh, start=range_start, end=range_end, job=job)
+        return buffer.getvalue()
+
+    index = find_segment_index(read_range, filesize)
+    if index is None:
+        return None
+    byte_range = index.byte_range(start, end)
+    if byte_range is None:
+        return None
+    first_byte, last_byte, segment_start = byte_range
+
+    # Инициализация + нужные сегменты: сегменты хранят свое время (tfdt),
+    # поэтому такой файл читается ffmpeg как кусок исходного
+    with open(path, 'wb') as f:
+        fetcher.copy_to(stream, f, progress, refresh, start=0, end=index.init_size - 1, job=job)
+        fetcher.copy_to(stream, f, progress, refresh, start=first_byte, end=last_byte, job=job)
+    return start - segment_start
+
+
+def cut_clip(inputs, output_path, duration, timeout=300, on_progress=None, niceness=0):
+    """Вырезает клип без перекодирования.
+
+    inputs - список (источник, смещение начала клипа в секундах). Источник -
+    путь к файлу или функция write_input(fileobj), которая пишет поток с
+    начала: он подается в ffmpeg через pipe, и когда ffmpeg дочитает до конца
+    клипа, скачивание обрывается. timeout ограничивает только ffmpeg, время
+    скачивания не считается.
+    """
+    cmd = ['ffmpeg']
+    pipes = []
+    for source, offset in inputs:
+        if callable(source):
+            read_fd, write_fd = os.pipe()
+            pipes.append((source, read_fd, write_fd))
+            source = f'pipe:{read_fd}'
+        cmd += ['-ss', f'{offset:.3f}', '-i', source]
+    if duration is not None:
+        cmd += ['-t', f'{duration:.3f}']
+    if len(inputs) == 2:
+        cmd += ['-map', '0:v:0', '-map', '1:a:0']
+    else:
+        cmd += ['-map', '0']
+    cmd += [
+        '-c', 'copy',
+        '-avoid_negative_ts', 'make_zero',
+        '-y',
+        '-loglevel', 'error',
+        '-progress', 'pipe:1',
+        '-nostats',
+        output_path
+    ]
+
+    try:
+        process = subprocess.Popen(low_priority(cmd, niceness), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   pass_fds=[read_fd for _, read_fd, _ in pipes])
+    finally:
+        # Читающие концы нужны только ffmpeg
+        for _, read_fd, _ in pipes:
+            os.close(read_fd)
+    stderr_output = []
+    stderr_reader = threading.Thread(target=lambda: stderr_output.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+
+    watchdog = FFmpegWatchdog(process, timeout, inputs=len(pipes))
+    errors = []
+
+    def feed(index, write_input, fd):
+        try:
+            with os.fdopen(fd, 'wb') as pipe:
+                write_input(watchdog.writer(index, pipe))
+        except BrokenPipeError:
+            # ffmpeg дочитал до конца клипа - остаток потока не нужен
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            watchdog.input_done()
+
+    feeders = [threading.Thread(target=feed, args=(index, write_input, write_fd), daemon=True)
+               for index, (write_input, _, write_fd) in enumerate(pipes)]
+    for feeder in feeders:
+        feeder.start()
+    try:
+        parse_ffmpeg_progress(process.stdout, duration, on_progress or (lambda percent: None))
+        process.wait()
+    finally:
+        for feeder in feeders:
+            feeder.join()
+        stderr_reader.join()
+
+    if watchdog.timed_out:
+        raise Exception("Таймаут при вырезании клипа")
+    # Обрыв скачивания - ошибка, даже если ffmpeg успел записать укороченный клип
+    if errors:
+        raise errors[0]
+    if process.returncode != 0:
+        raise Exception(f"Ошибка ffmpeg: {b''.join(stderr_output).decode(errors='replace')}")
@@ -0,0 +1,68 @@
+"""Настройки по умолчанию.
+
+create_app() читает их, затем файл из переменной YTDL_SETTINGS (если задана),
+затем переменные окружения с префиксом YTDL_ (YTDL_FETCH_WORKERS=8; значения
+разбираются как JSON) и, наконец, словарь, переданный в create_app().
+"""
+import os
+
+from download_pool import PRIORITY_CLASSES
+
+DOWNLOAD_FOLDER = 'downloads'
+MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB limit
+SECRET_KEY = 'your-secret-key-change-this'
+SSL_VERIFY = False  # Проверка SSL-сертификатов (выключена из-за проблемы с сертификатами на macOS)
+FETCH_WORKERS = 4  # Одновременные скачивания с YouTube
+MERGE_WORKERS = 2  # Одновременные процессы ffmpeg
+MAX_QUEUE_SIZE = 100  # Максимум задач в очереди, дальше - 429
+PRIORITY_CLASSES = PRIORITY_CLASSES  # Классы приоритета: смещение в очереди, секунды оценки стоимости
+SCHEDULER_AGING = 1.0  # На сколько секунд оценки стоимости задачу продвигает секунда ожидания
+SCHEDULER_FETCH_RATE = 10 * 1024 * 1024  # Ожидаемая скорость скачивания для оценки стоимости, байт/с
+SCHEDULER_MERGE_RATE = 100 * 1024 * 1024  # Ожидаемая скорость объединения ffmpeg, байт/с
+SCHEDULER_TRANSCODE_RATE = 1024 * 1024  # Ожидаемая скорость перекодирования аудио, байт/с
+SCHEDULER_DEFAULT_COST = 30  # Оценка задачи, видео которой еще не извлечено, секунды
+INFO_CACHE_SIZE = 256  # Сколько видео держать в кэше метаданных
+INFO_CACHE_TTL = 1800  # Время жизни записи кэша, секунды
+FETCH_CONNECTIONS = 4  # Параллельных HTTP-соединений на одну загрузку
+SEGMENT_SIZE = 10 * 1024 * 1024  # Размер сегмента для range-запросов
+FETCH_RETRIES = 5  # Повторы сегмента при обрыве (с докачкой с последнего байта)
+FETCH_BACKOFF = 1.0  # Начальная пауза перед повтором, удваивается
+HTTP_MAX_PER_HOST = 16  # Одновременных соединений с одним хостом на все загрузки
+HTTP_IDLE_TIMEOUT = 30  # Сколько держать свободное keep-alive соединение, секунды
+BANDWIDTH_LIMIT = 0  # Общая скорость скачивания, байт/с (0 - без ограничения, меняется через /bandwidth)
+ADMIN_TOKEN = None  # Токен для POST /bandwidth и приоритета high (Authorization: Bearer <токен>); None - они запрещены
+JOB_BANDWIDTH_LIMIT = 0  # Скорость одной загрузки, байт/с (0 - без ограничения)
+RESUME_ON_STARTUP = True  # Продолжать прерванные загрузки при запуске
+STREAMING_MERGE = os.name == 'posix'  # Подавать потоки в ffmpeg без промежуточных файлов
+MERGE_TIMEOUT = 300  # Таймаут ffmpeg, секунды (плюс время на вход при MERGE_MIN_RATE)
+MERGE_MIN_RATE = 2 * 1024 * 1024  # Таймаут растет с размером входа: ffmpeg должен обрабатывать не медленнее, байт/с
+FFMPEG_NICE = 10  # nice для процессов ffmpeg (0 - обычный приоритет), ввод-вывод - через ionice
+TRANSCODE_WORKERS = os.cpu_count() or 2  # Одновременные перекодирования аудио (по числу ядер)
+TRANSCODE_TIMEOUT = 300  # Таймаут перекодирования скачанного аудио, секунды (плюс время на вход при TRANSCODE_MIN_RATE)
+TRANSCODE_MIN_RATE = 64 * 1024  # Таймаут растет с размером входа: кодировать не медленнее, байт/с
+FFMPEG_REQUIRED_MUXERS = ['mp4', 'webm', 'matroska']  # Без этих форматов ffmpeg узел считается неисправным (/health)
+FFMPEG_REQUIRED_ENCODERS = []  # То же для кодеков; кодеки аудиоформатов проверяются при запросе
+REQUIRE_FFMPEG = False  # Не запускаться, если ffmpeg не прошел проверку (для рабочих узлов)
+STREAM_WAIT_TIMEOUT = 30  # Сколько /stream ждет начала загрузки, секунды
+EVENTS_KEEPALIVE = 15  # Интервал keepalive в /events, секунды
+JOB_STORE = 'sqlite'  # 'sqlite' (общий для нескольких процессов) или 'memory'
+JOB_DB_PATH = 'jobs.db'
+JOB_TTL = 24 * 3600  # Сколько хранить завершенные задачи, секунды
+FILE_OFFLOAD = None  # None, 'x-sendfile' (Apache/lighttpd) или 'x-accel' (nginx)
+X_ACCEL_PREFIX = '/protected-downloads'  # internal location nginx для 'x-accel'
+FILE_MAX_AGE = 24 * 3600  # Файлы неизменяемы: имя определяется содержимым
+BATCH_MAX_VIDEOS = 200  # Максимум видео в одном пакете (/batch)
+BATCH_CONCURRENCY = 2  # Одновременных загрузок одного пакета по умолчанию
+BATCH_EXTRACT_WORKERS = 8  # Параллельное извлечение метаданных пакетов
+STORAGE_MAX_BYTES = 20 * 1024 * 1024 * 1024  # Бюджет места под готовые файлы
+STORAGE_MAX_AGE = 24 * 3600  # Удалять файлы без обращений дольше этого, секунды (None - не удалять)
+STORAGE_SWEEP_INTERVAL = 60  # Период фоновой очистки папки загрузок, секунды
+THUMBNAIL_FOLDER = 'thumbnails'  # Кэш превью видео на диске
+THUMBNAIL_CACHE_BYTES = 200 * 1024 * 1024  # Бюджет места под превью
+THUMBNAIL_MEMORY_BYTES = 16 * 1024 * 1024  # Сколько последних превью держать в памяти
+THUMBNAIL_SIZES = (320, 640)  # Ширины уменьшенных копий (нужен Pillow)
+THUMBNAIL_PAGE_SIZE = 640  # Ширина превью на странице (блок 320px, x2 для HiDPI)
+THUMBNAIL_WORKERS = 2  # Потоки для уменьшения превью
+THUMBNAIL_MAX_AGE = 7 * 24 * 3600  # Cache-Control для превью, секунды
+ASGI_THREADS = 32  # Потоки для блокирующих частей запросов в ASGI-режиме (asgi.py)
+ASGI_BODY_THREADS = 256  # Потоки для чтения тел ответов в ASGI-режиме (/stream ждет в них байтов загрузки)
@@ -0,0 +1,171 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+# Смещение ключа очереди для классов приоритета, секунды оценки стоимости
+PRIORITY_CLASSES = {'high': -600, 'normal': 0, 'low': 600}
+
+
+class QueueFullError(Exception):
+    """Очередь загрузок заполнена"""
+
+
+class QueuedTask:
+    def __init__(self, key, seq, download_id, func, args, enqueued_at, priority, cost):
+        self.key = key
+        self.seq = seq
+        self.download_id = download_id
+        self.func = func
+        self.args = args
+        self.enqueued_at = enqueued_at
+        self.priority = priority
+        self.cost = cost
+        self.removed = False
+
+    def __lt__(self, other):
+        return (self.key, self.seq) < (other.key, other.seq)
+
+
+class DownloadPool:
+    """Ограниченный пул потоков для загрузок с приоритетной очередью и отдельными лимитами на ffmpeg.
+
+    Очередь упорядочена по ключу: смещение класса приоритета + оценка
+    стоимости задачи в секундах + aging * время постановки в очередь.
+    Короткие задачи обгоняют длинные, а каждая секунда ожидания снижает
+    ключ относительно новых задач, поэтому длинные не ждут бесконечно.
+    """
+
+    def __init__(self, fetch_workers=4, merge_workers=2, max_queue=100, transcode_workers=2, on_wait=None,
+                 priorities=None, aging=1.0, default_cost=30):
+        # on_wait(секунды) вызывается, когда задача дождалась свободного потока
+        self.on_wait = on_wait
+        self.priorities = priorities or PRIORITY_CLASSES
+        self.aging = aging
+        # Стоимость задачи, которая еще не оценена (видео не извлечено)
+        self.default_cost = default_cost
+        self.fetch_workers = fetch_workers
+        self.merge_workers = merge_workers
+        self.transcode_workers = transcode_workers
+        self.max_queue = max_queue
+
+        self._heap = []
+        self._queued = {}  # download_id -> QueuedTask
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._merge_slots = threading.BoundedSemaphore(merge_workers)
+        self._transcode_slots = threading.BoundedSemaphore(transcode_workers)
+        self._active = 0
+        self._merging = 0
+        self._transcoding = 0
+        self._threads = []
+
+        for i in range(fetch_workers):
+            thread = threading.Thread(target=self._worker, name=f"download-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, download_id, func, *args, priority='normal', cost=None):
+        """Ставит задачу в очередь и возвращает ее позицию. Бросает QueueFullError, если очередь заполнена.
+
+        cost - оценка длительности задачи в секундах (None - еще неизвестна,
+        уточняется через reprioritize), priority - класс из priorities.
+        """
+        with self._cond:
+            if len(self._queued) >= self.max_queue:
+                raise QueueFullError("Очередь загрузок заполнена, попробуйте позже")
+            task = QueuedTask(None, next(self._seq), download_id, func, args, time.monotonic(),
+                              priority if priority in self.priorities else 'normal', cost)
+            self._push(task)
+            self._cond.notify()
+            return self._position(task)
+
+    def reprioritize(self, download_id, cost=None, priority=None):
+        """Меняет оценку стоимости или класс задачи в очереди. False, если задача уже не в очереди"""
+        with self._cond:
+            task = self._queued.get(download_id)
+            if task is None:
+                return False
+            # Старая запись остается в куче помеченной и пропускается при извлечении
+            updated = QueuedTask(None, task.seq, download_id, task.func, task.args, task.enqueued_at,
+                                 priority if priority in self.priorities else task.priority,
+                                 task.cost if cost is None else cost)
+            self._push(updated)
+            return True
+
+    def position(self, download_id):
+        """Позиция задачи в очереди (1 - следующая), None если задача не в очереди"""
+        with self._cond:
+            task = self._queued.get(download_id)
+            return self._position(task) if task else None
+
+    def _push(self, task):
+        cost = self.default_cost if task.cost is None else task.cost
+        task.key = self.priorities[task.priority] + cost + self.aging * task.enqueued_at
+        previous = self._queued.get(task.download_id)
+        if previous is not None:
+            previous.removed = True
+        self._queued[task.download_id] = task
+        heapq.heappush(self._heap, task)
+
+    def _position(self, task):
+        return 1 + sum(1 for other in self._queued.values() if other < task)
+
+    @contextmanager
+    def merge_slot(self):
+        """Ограничивает число одновременных процессов ffmpeg"""
+        with self._merge_slots:
+            with self._cond:
+                self._merging += 1
+            try:
+                yield
+            finally:
+                with self._cond:
+                    self._merging -= 1
+
+    @contextmanager
+    def transcode_slot(self):
+        """Ограничивает число одновременных перекодирований (они нагружают процессор)"""
+        with self._transcode_slots:
+            with self._cond:
+                self._transcoding += 1
+            try:
+                yield
+            finally:
+                with self._cond:
+                    self._transcoding -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._queued),
+                'active': self._active,
+                'merging': self._merging,
+                'transcoding': self._transcoding,
+                'fetch_workers': self.fetch_workers,
+                'merge_workers': self.merge_workers,
+                'transcode_workers': self.transcode_workers,
+                'max_queue': self.max_queue,
+            }
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queued:
+                    self._cond.wait()
+                task = heapq.heappop(self._heap)
+                if task.removed:
+                    continue
+                del self._queued[task.download_id]
+                self._active += 1
+            if self.on_wait:
+                self.on_wait(time.monotonic() - task.enqueued_at)
+            try:
+                task.func(*task.args)
+            except Exception as e:
+                print(f"Ошибка в задаче {task.download_id}: {str(e)}")
+            finally:
+                with self._cond:
+                    self._active -= 1
@@ -0,0 +1,455 @@
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.error
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from http_client import HTTPClient, BandwidthShaper
+
+CHUNK_SIZE = 1024 * 1024  # Размер блока чтения из сокета
+CHECKPOINT_INTERVAL = 4 * 1024 * 1024  # Как часто сохранять смещения .part-файла
+PIPE_SEGMENT_SIZE = 4 * 1024 * 1024  # Сегмент параллельной подачи в pipe: в памяти их не больше числа соединений
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0', 'accept-language': 'en-US,en'}
+
+# Коды ответа, при которых подписанная ссылка на поток считается истекшей
+EXPIRED_URL_CODES = (403, 410)
+
+# Ошибки соединения и ответа сервера (HTTPError - подкласс URLError, IncompleteRead - HTTPException)
+TRANSPORT_ERRORS = (urllib.error.URLError, http.client.HTTPException, OSError)
+
+
+class TransportError(Exception):
+    """Ошибка сети или сервера при чтении диапазона - только после нее запрос повторяется.
+
+    error - исходная ошибка, received - сколько байтов диапазона уже записано.
+    Ошибки записи (ffmpeg закрыл pipe, кончилось место на диске) так не
+    оборачиваются и пробрасываются сразу.
+    """
+
+    def __init__(self, error, received=0):
+        super().__init__(str(error))
+        self.error = error
+        self.received = received
+
+
+class StreamFetcher:
+    """Скачивает потоки параллельными HTTP range-запросами.
+
+    Большие потоки делятся на сегменты, которые пишутся сразу на свое место
+    в заранее выделенном .part-файле. Все потоки одной задачи используют
+    общий лимит соединений. Смещения сегментов сохраняются рядом в
+    .part.json, поэтому прерванная загрузка (обрыв сети, истекшая ссылка,
+    перезапуск процесса) продолжается с последнего полученного байта.
+
+    Запросы всех задач идут через общий пул keep-alive соединений (client),
+    а скорость ограничивает shaper; job - задача, которой принадлежат байты.
+    """
+
+    def __init__(self, max_connections=4, segment_size=10 * 1024 * 1024, timeout=30,
+                 retries=5, backoff=1.0, max_backoff=30, client=None, shaper=None):
+        self.client = client or HTTPClient()
+        self.shaper = shaper or BandwidthShaper()
+        self.max_connections = max_connections
+        self.segment_size = segment_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def fetch(self, stream, path, progress=None, refresh=None, job=None):
+        """Скачивает один поток в файл и возвращает путь"""
+        return self.fetch_all([(stream, path)], progress, refresh, job)[0]
+
+    def fetch_all(self, items, progress=None, refresh=None, job=None):
+        """Скачивает несколько потоков одновременно. items - список (stream, путь).
+
+        progress(nbytes) вызывается на каждый полученный блок, refresh(stream)
+        должен вернуть свежую ссылку на поток, если старая истекла.
+        """
+        plans = []
+        for stream, path in items:
+            plans.append(self._plan(stream, path, progress, refresh, job))
+
+        # Чередуем сегменты разных потоков, чтобы они качались одновременно,
+        # а не поток за потоком
+        interleaved = []
+        for index in range(max(len(segments) for _, segments in plans)):
+            for _, segments in plans:
+                if index < len(segments):
+                    interleaved.append(segments[index])
+
+        workers = max(1, min(self.max_connections, len(interleaved)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(task) for task in interleaved]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Задача уже не удалась - сегменты из очереди не качаем, ждем только начатые
+                for future in futures:
+                    future.cancel()
+                raise
+
+        for checkpoint, _ in plans:
+            if checkpoint:
+                checkpoint.complete()
+        return [path for _, path in items]
+
+    def copy_to(self, stream, fileobj, progress=None, refresh=None, start=0, end=None, job=None, connections=1,
+                keep=None):
+        """Скачивает поток (байты start..end включительно) и по порядку пишет их в fileobj.
+
+        С connections > 1 сегменты качаются параллельно и держатся в памяти,
+        пока до них не дойдет очередь записи. С keep (путь, поток целиком)
+        байты заодно сохраняются в keep.part с разметкой .part.json: если
+        запись в fileobj оборвется, fetch_all продолжит поток с этого места.
+        """
+        size = stream.filesize
+        if not size and end is None:
+            stream.stream_to_buffer(fileobj)
+            return
+        checkpoint = Checkpoint(keep, size, self.segment_size) if keep and start == 0 and end is None else None
+        # Копия пишется с начала потока, поэтому продолжать чужую разметку нельзя
+        if checkpoint and not checkpoint.downloaded:
+            tee = CheckpointTee(fileobj, checkpoint)
+            try:
+                self.copy_to(stream, tee, progress, refresh, job=job, connections=connections)
+            finally:
+                tee.close()
+            return
+        if end is not None:
+            size = min(size, end + 1) if size else end + 1
+
+        source = StreamSource(stream, refresh)
+        if connections > 1:
+            self._copy_parallel(source, fileobj, progress, start, size, job, connections)
+            return
+        offset = start
+        attempt = 0
+        while offset < size:
+            end = min(offset + self.segment_size, size) - 1
+            generation = source.generation
+            try:
+                def write(chunk):
+                    fileobj.write(chunk)
+                    if progress:
+                        progress(len(chunk))
+                offset += self._read_range(source.url, offset, end, write, job)
+                attempt = 0
+            except TransportError as e:
+                # Уже записанные байты не повторяем - продолжаем с текущего смещения
+                offset += e.received
+                attempt = self._retry_or_raise(e, attempt, source, generation)
+
+    def _copy_parallel(self, source, fileobj, progress, start, size, job, connections):
+        segment_size = min(self.segment_size, PIPE_SEGMENT_SIZE)
+        pending = deque()
+
+        def write_next():
+            data = pending.popleft().result()
+            fileobj.write(data)
+            if progress:
+                progress(len(data))
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            try:
+                for offset in range(start, size, segment_size):
+                    if len(pending) >= connections:
+                        write_next()
+                    end = min(offset + segment_size, size) - 1
+                    pending.append(executor.submit(self._fetch_bytes, source, offset, end, job))
+                while pending:
+                    write_next()
+            except BaseException:
+                # Запись не удалась (например, ffmpeg завершился) - оставшиеся сегменты не нужны
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def _fetch_bytes(self, source, start, end, job=None):
+        """Байты [start, end] в памяти, с повторами и докачкой"""
+        data = bytearray()
+        attempt = 0
+        while start + len(data) <= end:
+            generation = source.generation
+            try:
+                self._read_range(source.url, start + len(data), end, data.extend, job)
+            except TransportError as e:
+                attempt = self._retry_or_raise(e, attempt, source, generation)
+        return data
+
+    def _plan(self, stream, path, progress=None, refresh=None, job=None):
+        """Разбивает поток на задачи-сегменты"""
+        size = stream.filesize
+        if not size:
+            # Размер неизвестен - сегментировать нельзя, качаем средствами pytubefix
+            folder, filename = os.path.split(path)
+            return None, [lambda: stream.download(output_path=folder, filename=filename, skip_existing=False)]
+
+        checkpoint = Checkpoint(path, size, self.segment_size)
+        source = StreamSource(stream, refresh)
+        if progress and checkpoint.downloaded:
+            # Байты, полученные до прерывания, тоже учитываем в прогрессе
+            progress(checkpoint.downloaded)
+
+        segments = []
+        for start in range(0, size, self.segment_size):
+            end = min(start + self.segment_size, size) - 1
+            segments.append(
+                lambda start=start, end=end: self._fetch_segment(source, checkpoint, start, end, progress, job)
+            )
+        return checkpoint, segments
+
+    def _fetch_segment(self, source, checkpoint, start, end, progress=None, job=None):
+        """Скачивает сегмент [start, end] в .part-файл с повторами и докачкой"""
+        attempt = 0
+        while True:
+            offset = start + checkpoint.done(start)
+            if offset > end:
+                return
+            generation = source.generation
+            try:
+                with open(checkpoint.part_path, 'r+b') as f:
+                    f.seek(offset)
+
+                    def write(chunk):
+                        f.write(chunk)
+                        # Смещение сохраняется только для байтов, которые уже в файле
+                        f.flush()
+                        checkpoint.advance(start, len(chunk))
+                        if progress:
+                            progress(len(chunk))
+                    self._read_range(source.url, offset, end, write, job)
+                checkpoint.save()
+                return
+            except TransportError as e:
+                attempt = self._retry_or_raise(e, attempt, source, generation)
+
+    def _retry_or_raise(self, error, attempt, source, generation):
+        """Ждет перед повтором (экспоненциально) или пробрасывает исходную ошибку"""
+        attempt += 1
+        if attempt > self.retries:
+            raise error.error
+        if isinstance(error.error, urllib.error.HTTPError) and error.error.code in EXPIRED_URL_CODES:
+            source.refresh(generation)
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        print(f"Ошибка загрузки ({str(error)}), повтор {attempt}/{self.retries} через {delay:.0f} с")
+        time.sleep(delay)
+        return attempt
+
+    def _open_range(self, url, start, end):
+        separator = '&' if '?' in url else '?'
+        return self.client.request(
+            f"{url}{separator}range={start}-{end}",
+            headers=dict(DEFAULT_HEADERS, Range=f"bytes={start}-{end}"),
+            timeout=self.timeout
+        )
+
+    def _read_range(self, url, start, end, write, job=None):
+        """Скачивает байты [start, end], передавая блоки в write. Возвращает число байтов"""
+        expected = end - start + 1
+        received = 0
+        try:
+            response = self._open_range(url, start, end)
+        except TRANSPORT_ERRORS as e:
+            raise TransportError(e) from e
+        with response:
+            while received < expected:
+                try:
+                    chunk = response.read(min(self.shaper.chunk_size(CHUNK_SIZE), expected - received))
+                except TRANSPORT_ERRORS as e:
+                    raise TransportError(e, received) from e
+                if not chunk:
+                    break
+                self.shaper.consume(job, len(chunk))
+                # Ошибку записи повторный запрос не исправит - она уходит вызывающему как есть
+                write(chunk)
+                received += len(chunk)
+
+        if received != expected:
+            raise TransportError(Exception(f"Получено {received} байт вместо {expected} (диапазон {start}-{end})"), received)
+        return received
+
+
+class StreamSource:
+    """Ссылка на поток, которую можно обновить, когда подписанный URL истек"""
+
+    def __init__(self, stream, refresh=None):
+        self.stream = stream
+        self.url = stream.url
+        self.generation = 0
+        self._refresh = refresh
+        self._lock = threading.Lock()
+
+    def refresh(self, generation):
+        """Обновляет ссылку, если ее еще не обновил другой сегмент после ошибки"""
+        with self._lock:
+            if self._refresh and generation == self.generation:
+                self.url = self._refresh(self.stream)
+                self.generation += 1
+
+
+class Checkpoint:
+    """Прогресс сегментов .part-файла, сохраняемый рядом в .part.json"""
+
+    def __init__(self, path, size, segment_size):
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.json'
+        self.size = size
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+        state = None
+        if os.path.exists(self.part_path) and os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+        # Чужая или испорченная разметка - начинаем заново
+        if state and state.get('size') == size and state.get('segment_size') == segment_size:
+            self._done = {int(start): done for start, done in state['done'].items()}
+        else:
+            self._done = {}
+            # Выделяем файл целиком, сегменты пишутся по своим смещениям
+            with open(self.part_path, 'wb') as f:
+                f.truncate(size)
+            self.save()
+
+    @property
+    def downloaded(self):
+        with self._lock:
+            return sum(self._done.values())
+
+    def done(self, start):
+        with self._lock:
+            return self._done.get(start, 0)
+
+    def advance(self, start, nbytes):
+        with self._lock:
+            self._done[start] = self._done.get(start, 0) + nbytes
+            self._unsaved += nbytes
+            should_save = self._unsaved >= CHECKPOINT_INTERVAL
+        if should_save:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            state = {'size': self.size, 'segment_size': self.segment_size, 'done': self._done}
+            self._unsaved = 0
+            temp_path = self.state_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.state_path)
+
+    def complete(self):
+        """Все сегменты получены: .part становится итоговым файлом"""
+        os.replace(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+class CheckpointTee:
+    """Пишет поток по порядку в fileobj и в .part-файл Checkpoint, отмечая полученные сегменты"""
+
+    def __init__(self, fileobj, checkpoint):
+        self.fileobj = fileobj
+        self.checkpoint = checkpoint
+        self.offset = 0
+        self._part = open(checkpoint.part_path, 'r+b')
+
+    def write(self, data):
+        # Сначала на диск: байты, которые не дошли до fileobj, тоже не придется качать заново
+        self._part.write(data)
+        self._part.flush()
+        segment_size = self.checkpoint.segment_size
+        remaining = len(data)
+        while remaining:
+            start = self.offset // segment_size * segment_size
+            nbytes = min(remaining, start + segment_size - self.offset)
+            self.checkpoint.advance(start, nbytes)
+            self.offset += nbytes
+            remaining -= nbytes
+        self.fileobj.write(data)
+
+    def close(self):
+        self._part.close()
+        self.checkpoint.save()
+
+
+class LiveFile:
+    """Файл, который еще дописывается загрузкой.
+
+    Загрузка пишет в него байты через write(), а читатели (HTTP-клиенты)
+    получают их по мере появления, не дожидаясь конца загрузки.
+    """
+
+    def __init__(self, path, total=None, name=None, resume=False):
+        self.path = path
+        # Имя итогового файла (для заголовков ответа)
+        self.name = name or os.path.basename(path)
+        self.total = total
+        self.written = 0
+        self.done = False
+        self.error = None
+        # При докачке дописываем уже полученное начало файла
+        if resume and os.path.exists(path) and (not total or os.path.getsize(path) <= total):
+            self.written = os.path.getsize(path)
+            self._file = open(path, 'ab')
+        else:
+            self._file = open(path, 'wb')
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        self._file.write(data)
+        # Читатели открывают файл отдельно, поэтому сбрасываем буфер сразу
+        self._file.flush()
+        with self._cond:
+            self.written += len(data)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        self._file.close()
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def moved(self, new_path):
+        """Файл переименован - новые читатели открывают его по новому пути"""
+        with self._cond:
+            self.path = new_path
+
+    def open_reader(self):
+        """Открывает файл на чтение (после открытия переименование уже не мешает)"""
+        with self._cond:
+            return open(self.path, 'rb')
+
+    def iter_bytes(self, reader, chunk_size=CHUNK_SIZE, timeout=60):
+        """Отдает байты из reader по мере их записи загрузкой"""
+        offset = 0
+        try:
+            while True:
+                with self._cond:
+                    while offset >= self.written and not self.done:
+                        if not self._cond.wait(timeout):
+                            raise Exception("Загрузка не продвигается")
+                    if self.error:
+                        raise Exception(self.error)
+                    available = self.written - offset
+                    if available == 0 and self.done:
+                        return
+                while available > 0:
+                    chunk = reader.read(min(chunk_size, available))
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    available -= len(chunk)
+                    yield chunk
+        finally:
+            reader.close()
@@ -0,0 +1,73 @@
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+PROBE_TIMEOUT = 10  # секунды на каждый запуск ffmpeg
+
+
+class FFmpegInfo:
+    """Что умеет ffmpeg этого узла: версия, форматы контейнеров и кодеки"""
+
+    def __init__(self, version=None, muxers=(), encoders=(), error=None):
+        self.version = version
+        self.muxers = set(muxers)
+        self.encoders = set(encoders)
+        self.error = error
+
+    @property
+    def available(self):
+        return self.error is None
+
+    def missing(self, muxers=(), encoders=()):
+        """Недостающие форматы и кодеки из списков (все, если ffmpeg не найден)"""
+        return ([name for name in muxers if name not in self.muxers] +
+                [name for name in encoders if name not in self.encoders])
+
+    def to_dict(self):
+        return {
+            'available': self.available,
+            'version': self.version,
+            'muxers': len(self.muxers),
+            'encoders': len(self.encoders),
+            'error': self.error,
+        }
+
+
+def run_ffmpeg(binary, option):
+    result = subprocess.run([binary, '-hide_banner', option], capture_output=True, timeout=PROBE_TIMEOUT)
+    if result.returncode != 0:
+        raise Exception(result.stderr.decode(errors='replace').strip() or f"код возврата {result.returncode}")
+    return result.stdout.decode(errors='replace')
+
+
+def parse_names(output):
+    """Имена из списка -muxers / -encoders: после строки из дефисов идут строки 'флаги имя описание'"""
+    names = set()
+    listing = False
+    for line in output.splitlines():
+        fields = line.split()
+        if not listing:
+            listing = len(fields) == 1 and set(fields[0]) == {'-'}
+        elif len(fields) >= 2:
+            # У муксеров бывает несколько имен через запятую
+            names.update(fields[1].split(','))
+    return names
+
+
+def probe_ffmpeg(binary='ffmpeg'):
+    """Один раз опрашивает ffmpeg (три запуска параллельно). Ошибки не бросает"""
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            version, muxers, encoders = executor.map(
+                lambda option: run_ffmpeg(binary, option), ('-version', '-muxers', '-encoders')
+            )
+    except FileNotFoundError:
+        return FFmpegInfo(error=f"{binary} не найден")
+    except Exception as e:
+        return FFmpegInfo(error=f"{binary} не отвечает: {str(e)}")
+    # "ffmpeg version 6.1.1-3ubuntu5 Copyright ..."
+    words = version.split()
+    return FFmpegInfo(
+        version=words[2] if len(words) > 2 and words[1] == 'version' else None,
+        muxers=parse_names(muxers),
+        encoders=parse_names(encoders)
+    )
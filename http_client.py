@@ -0,0 +1,401 @@
+import http.client
+import sqlite3
+import threading
+import time
+import urllib.error
+from collections import deque
+from urllib.parse import urlsplit, urljoin
+
+MAX_REDIRECTS = 5
+SHAPED_CHUNK_SIZE = 64 * 1024  # Блок чтения при включенном ограничении скорости: меньше рывков
+ACTIVE_JOB_WINDOW = 5  # Задача считается активной, если качала за последние секунды
+
+# Ошибки переиспользованного соединения, которое сервер уже закрыл: повторяем на новом
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class HostPool:
+    """Соединения с одним хостом: лимит одновременных и свободные keep-alive"""
+
+    def __init__(self, max_connections):
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = deque()  # (соединение, время возврата в пул)
+        self.in_use = 0
+
+
+class PooledResponse:
+    """Ответ, соединение которого после закрытия возвращается в пул"""
+
+    def __init__(self, client, key, connection, response, url):
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amount=None):
+        return self._response.read(amount)
+
+    def close(self):
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        # Переиспользовать можно только соединение с полностью прочитанным ответом
+        reusable = self._response.isclosed() and not self._response.will_close
+        if not reusable:
+            self._response.close()
+        self._client._release(self._key, connection, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HTTPClient:
+    """Общий HTTP-клиент для скачивания потоков.
+
+    Держит keep-alive соединения между запросами всех задач и ограничивает
+    число одновременных соединений с одним хостом. Ошибки HTTP (4xx/5xx)
+    бросаются как urllib.error.HTTPError, чтобы повторы работали как с urllib.
+    """
+
+    def __init__(self, max_per_host=16, max_idle_per_host=8, idle_timeout=30):
+        self.max_per_host = max_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def request(self, url, headers=None, timeout=30, method='GET'):
+        """Выполняет запрос, следуя редиректам. Ответ нужно закрыть (или использовать в with)"""
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request_once(method, url, headers or {}, timeout)
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+                location = urljoin(url, response.headers['Location'])
+                response.read()
+                response.close()
+                url = location
+                continue
+            if response.status >= 400:
+                error = urllib.error.HTTPError(url, response.status, response._response.reason, response.headers, None)
+                response.close()
+                raise error
+            return response
+        raise Exception(f"Слишком много перенаправлений: {url}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hosts': len(self._hosts),
+                'in_use': sum(pool.in_use for pool in self._hosts.values()),
+                'idle': sum(len(pool.idle) for pool in self._hosts.values()),
+                'created': self.created,
+                'reused': self.reused,
+                'max_per_host': self.max_per_host,
+            }
+
+    def close(self):
+        """Закрывает свободные соединения"""
+        with self._lock:
+            pools = list(self._hosts.values())
+        for pool in pools:
+            while pool.idle:
+                pool.idle.popleft()[0].close()
+
+    def _request_once(self, method, url, headers, timeout):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        pool = self._pool(key)
+        pool.slots.acquire()
+        with self._lock:
+            pool.in_use += 1
+        connection = None
+        try:
+            connection, reused = self._checkout(pool, key, timeout)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # Сервер закрыл простаивавшее соединение - повторяем на новом
+                connection.close()
+                connection = self._connect(key, timeout)
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            self._release(key, None, False)
+            raise
+        return PooledResponse(self, key, connection, response, url)
+
+    def _pool(self, key):
+        with self._lock:
+            pool = self._hosts.get(key)
+            if pool is None:
+                pool = self._hosts[key] = HostPool(self.max_per_host)
+            return pool
+
+    def _checkout(self, pool, key, timeout):
+        """Свободное соединение из пула или новое. Возвращает (соединение, переиспользовано ли)"""
+        now = time.monotonic()
+        with self._lock:
+            while pool.idle:
+                connection, released_at = pool.idle.pop()
+                if now - released_at < self.idle_timeout:
+                    self.reused += 1
+                    break
+                connection.close()
+            else:
+                connection = None
+        if connection is None:
+            return self._connect(key, timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        with self._lock:
+            self.created += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _release(self, key, connection, reusable):
+        pool = self._pool(key)
+        with self._lock:
+            pool.in_use -= 1
+            if connection is not None and reusable and len(pool.idle) < self.max_idle_per_host:
+                pool.idle.append((connection, time.monotonic()))
+                connection = None
+        if connection is not None:
+            connection.close()
+        pool.slots.release()
+
+
+class JobBucket:
+    """Токены и счетчики одной задачи"""
+
+    def __init__(self, now):
+        self.tokens = 0.0
+        self.updated = now
+        self.last_seen = now
+        self.bytes = 0
+
+
+class BandwidthShaper:
+    """Ограничение скорости скачивания: общий лимит и лимит на задачу (байт/с, 0 - без ограничения).
+
+    Общий лимит делится между задачами по очереди, а не по числу их
+    соединений: мелкая загрузка получает свою долю сразу, а то, что она не
+    использует, достается крупным. Байты оплачиваются после чтения, поэтому
+    короткий долг допустим, а средняя скорость держится на уровне лимита.
+    """
+
+    def __init__(self, rate=0, job_rate=0, burst=1.0, job_ttl=60):
+        self.rate = rate
+        self.job_rate = job_rate
+        # Сколько секунд простоя можно "накопить" и потратить сразу
+        self.burst = burst
+        self.job_ttl = job_ttl
+        self._cond = threading.Condition()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._turns = deque()  # Задачи, ждущие общих токенов, по очереди
+        self._waiting = {}  # Задача -> число ее ждущих соединений
+        self._jobs = {}
+        self.throttled = 0.0  # Суммарное время ожидания, секунды
+
+    @property
+    def enabled(self):
+        return bool(self.rate or self.job_rate)
+
+    def chunk_size(self, default):
+        return min(default, SHAPED_CHUNK_SIZE) if self.enabled else default
+
+    def configure(self, rate=None, job_rate=None):
+        """Меняет лимиты на лету: ждущие соединения сразу пересчитывают ожидание"""
+        with self._cond:
+            if rate is not None:
+                self.rate = rate
+            if job_rate is not None:
+                self.job_rate = job_rate
+            self._tokens = min(self._tokens, self.rate * self.burst)
+            self._cond.notify_all()
+
+    def consume(self, job, nbytes):
+        """Оплачивает nbytes прочитанных задачей job байт, при необходимости ждет"""
+        if not self.enabled:
+            return
+        started = time.monotonic()
+        with self._cond:
+            bucket = self._bucket(job, started)
+            bucket.bytes += nbytes
+            if self.job_rate:
+                self._refill_job(bucket)
+                bucket.tokens -= nbytes
+                while self.job_rate and bucket.tokens < 0:
+                    self._cond.wait(-bucket.tokens / self.job_rate)
+                    self._refill_job(bucket)
+            if self.rate:
+                self._wait_turn(job, nbytes)
+            waited = time.monotonic() - started
+            self.throttled += waited
+            bucket.last_seen = time.monotonic()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'limit': self.rate,
+                'job_limit': self.job_rate,
+                'active_jobs': self.active_jobs(),
+                'waiting_jobs': len(self._turns),
+                'throttled_seconds': round(self.throttled, 3),
+            }
+
+    def active_jobs(self):
+        now = time.monotonic()
+        with self._cond:
+            return sum(1 for bucket in self._jobs.values() if now - bucket.last_seen < ACTIVE_JOB_WINDOW)
+
+    def _bucket(self, job, now):
+        bucket = self._jobs.get(job)
+        if bucket is None:
+            # Заодно забываем задачи, которые давно ничего не качали
+            for stale in [key for key, value in self._jobs.items() if now - value.last_seen > self.job_ttl]:
+                del self._jobs[stale]
+            bucket = self._jobs[job] = JobBucket(now)
+            bucket.tokens = self.job_rate * self.burst
+        return bucket
+
+    def _refill_job(self, bucket):
+        now = time.monotonic()
+        bucket.tokens = min(bucket.tokens + (now - bucket.updated) * self.job_rate, self.job_rate * self.burst)
+        bucket.updated = now
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.rate * self.burst)
+        self._updated = now
+
+    def _wait_turn(self, job, nbytes):
+        self._waiting[job] = self._waiting.get(job, 0) + 1
+        if job not in self._turns:
+            self._turns.append(job)
+        try:
+            while self.rate:
+                self._refill()
+                if self._tokens > 0 and self._turns[0] == job:
+                    self._tokens -= nbytes
+                    # Следующая очередь - у другой задачи
+                    self._turns.popleft()
+                    if self._waiting[job] > 1:
+                        self._turns.append(job)
+                    self._cond.notify_all()
+                    return
+                if self._tokens <= 0:
+                    self._cond.wait(max(-self._tokens / self.rate, 0.001))
+                else:
+                    self._cond.wait(0.05)
+        finally:
+            self._waiting[job] -= 1
+            if not self._waiting[job]:
+                del self._waiting[job]
+                if job in self._turns:
+                    self._turns.remove(job)
+                self._cond.notify_all()
+
+
+class SharedBandwidthShaper(BandwidthShaper):
+    """Ограничение скорости, общее для нескольких процессов (лимиты хранятся в SQLite).
+
+    configure() в любом процессе меняет лимиты для всех. Общий лимит делится
+    между процессами по числу их активных загрузок: раз в sync_interval
+    каждый процесс сообщает свое число и пересчитывает свою долю (self.rate),
+    а self.limit - лимит на все процессы. Лимит на задачу действует как есть.
+    """
+
+    def __init__(self, path, owner, rate=0, job_rate=0, sync_interval=1.0, **kwargs):
+        super().__init__(rate=rate, job_rate=job_rate, **kwargs)
+        self.path = path
+        self.owner = owner
+        self.sync_interval = sync_interval
+        self.limit = rate
+        self._thread = None
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+
+        with self._db_lock, self._db as db:
+            db.execute("CREATE TABLE IF NOT EXISTS bandwidth_limits "
+                       "(id INTEGER PRIMARY KEY, rate REAL, job_rate REAL, config_rate REAL, config_job_rate REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS bandwidth_workers "
+                       "(owner TEXT PRIMARY KEY, active_jobs INTEGER, updated_at REAL)")
+            row = db.execute("SELECT config_rate, config_job_rate FROM bandwidth_limits WHERE id = 1").fetchone()
+            # Лимиты из настроек берутся, только если настройки изменились:
+            # иначе перезапуск процесса сбросил бы лимиты, заданные через configure()
+            if row is None or tuple(row) != (rate, job_rate):
+                db.execute("INSERT OR REPLACE INTO bandwidth_limits VALUES (1, ?, ?, ?, ?)",
+                           (rate, job_rate, rate, job_rate))
+        self.sync()
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(self.sync_interval)
+                try:
+                    self.sync()
+                except Exception as e:
+                    print(f"Ошибка синхронизации ограничения скорости: {str(e)}")
+
+        self._thread = threading.Thread(target=run, name='bandwidth-sync', daemon=True)
+        self._thread.start()
+
+    def configure(self, rate=None, job_rate=None):
+        with self._db_lock, self._db as db:
+            db.execute("UPDATE bandwidth_limits SET rate = COALESCE(?, rate), job_rate = COALESCE(?, job_rate) "
+                       "WHERE id = 1", (rate, job_rate))
+        self.sync()
+
+    def sync(self):
+        """Сообщает число своих активных загрузок и пересчитывает долю общего лимита"""
+        active = self.active_jobs()
+        now = time.time()
+        with self._db_lock, self._db as db:
+            db.execute("INSERT OR REPLACE INTO bandwidth_workers (owner, active_jobs, updated_at) VALUES (?, ?, ?)",
+                       (self.owner, active, now))
+            # Процессы, которые давно не отмечались, остановились
+            db.execute("DELETE FROM bandwidth_workers WHERE updated_at < ?", (now - 60 * self.sync_interval,))
+            rate, job_rate = db.execute("SELECT rate, job_rate FROM bandwidth_limits WHERE id = 1").fetchone()
+            total = db.execute("SELECT COALESCE(SUM(active_jobs), 0) FROM bandwidth_workers WHERE updated_at >= ?",
+                               (now - 3 * self.sync_interval,)).fetchone()[0]
+        self.limit = rate
+        # Процесс без загрузок получает долю одной загрузки, чтобы новая не стояла до пересчета
+        share = rate * max(active, 1) / max(total + (0 if active else 1), 1) if rate else 0
+        BandwidthShaper.configure(self, rate=share, job_rate=job_rate)
+
+    def stats(self):
+        stats = super().stats()
+        stats['worker_limit'] = stats['limit']
+        stats['limit'] = self.limit
+        return stats
@@ -0,0 +1,311 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field, fields, asdict
+from typing import Optional
+
+# Статусы, после которых задача больше не меняется
+FINISHED_STATUSES = ('completed', 'error')
+# Статусы задач, которые еще выполняются (или ждут в очереди)
+ACTIVE_STATUSES = ('queued', 'processing', 'downloading', 'merging')
+VERSION_QUERY_BATCH = 500  # Задач в одном запросе versions()
+
+
+@dataclass
+class Job:
+    """Запись о загрузке: только сериализуемые поля, без объектов pytubefix"""
+    download_id: str
+    url: str
+    quality: str = 'highest'
+    status: str = 'queued'
+    audio_format: Optional[str] = None  # Перекодировать аудио в mp3/opus/aac
+    audio_bitrate: Optional[int] = None  # kbps
+    clip_start: Optional[float] = None  # Отрезок видео, секунды
+    clip_end: Optional[float] = None
+    batch_id: Optional[str] = None  # Пакет (/batch), в который входит задача
+    priority: Optional[str] = None  # Класс приоритета в очереди: high/normal/low
+
+    # Информация о видео
+    title: Optional[str] = None
+    author: Optional[str] = None
+    length: Optional[int] = None
+    views: Optional[int] = None
+    thumbnail: Optional[str] = None
+    resolution: Optional[str] = None
+    filesize: Optional[float] = None  # МБ
+    use_adaptive: Optional[bool] = None
+
+    # Прогресс
+    downloaded_bytes: Optional[int] = None
+    total_bytes: Optional[int] = None
+    speed: Optional[int] = None
+    eta: Optional[int] = None
+    progress: Optional[float] = None
+    merge_progress: Optional[float] = None
+
+    # Результат
+    stream_url: Optional[str] = None
+    coalesced_with: Optional[str] = None
+    filepath: Optional[str] = None
+    filename: Optional[str] = None
+    error: Optional[str] = None
+
+    # Процесс ('хост:pid'), который выполняет задачу
+    owner: Optional[str] = None
+
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    version: int = 0
+
+    def to_dict(self):
+        """Поля задачи для JSON-ответа (пустые поля не включаются)"""
+        return {key: value for key, value in asdict(self).items() if value is not None}
+
+
+JOB_FIELDS = [f.name for f in fields(Job)]
+
+
+class MemoryJobStore:
+    """Хранилище задач в памяти процесса"""
+
+    def __init__(self, ttl=24 * 3600, eviction_interval=60):
+        self.ttl = ttl
+        self.eviction_interval = eviction_interval
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._last_eviction = time.time()
+
+    def create(self, job):
+        with self._cond:
+            self._jobs[job.download_id] = job
+            self._cond.notify_all()
+        self._maybe_evict()
+        return job
+
+    def get(self, download_id):
+        with self._cond:
+            job = self._jobs.get(download_id)
+            # Копия, чтобы вызывающий код не менял запись мимо update()
+            return Job(**asdict(job)) if job else None
+
+    def update(self, download_id, **values):
+        """Обновляет поля задачи. Возвращает False, если задачи нет"""
+        unknown = set(values) - set(JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля задачи: {', '.join(sorted(unknown))}")
+        with self._cond:
+            job = self._jobs.get(download_id)
+            if job is None:
+                return False
+            for key, value in values.items():
+                setattr(job, key, value)
+            job.updated_at = time.time()
+            job.version += 1
+            self._cond.notify_all()
+            return True
+
+    def claim(self, download_id, expected_owner, new_owner):
+        """Передает задачу новому владельцу, только если старый не сменился"""
+        with self._cond:
+            job = self._jobs.get(download_id)
+            if job is None or job.owner != expected_owner:
+                return False
+            job.owner = new_owner
+            job.updated_at = time.time()
+            job.version += 1
+            return True
+
+    def delete(self, download_id):
+        with self._cond:
+            self._jobs.pop(download_id, None)
+
+    def list_by_status(self, statuses):
+        with self._cond:
+            return [Job(**asdict(job)) for job in self._jobs.values() if job.status in statuses]
+
+    def queued_ahead(self, job):
+        """Сколько задач того же процесса ждут в очереди дольше job (оценка позиции для других процессов)"""
+        with self._cond:
+            return sum(1 for other in self._jobs.values()
+                       if other.status == 'queued' and other.owner == job.owner and other.created_at < job.created_at)
+
+    def list_by_batch(self, batch_id):
+        """Задачи пакета в порядке создания"""
+        with self._cond:
+            jobs = [Job(**asdict(job)) for job in self._jobs.values() if job.batch_id == batch_id]
+        return sorted(jobs, key=lambda job: job.created_at)
+
+    def wait(self, timeout):
+        """Ждет любого изменения задач не дольше timeout секунд"""
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def versions(self, download_ids):
+        """Версии задач {download_id: version}; удаленных задач в ответе нет"""
+        with self._cond:
+            return {download_id: self._jobs[download_id].version
+                    for download_id in download_ids if download_id in self._jobs}
+
+    def evict_expired(self):
+        """Удаляет завершенные задачи старше TTL"""
+        threshold = time.time() - self.ttl
+        with self._cond:
+            expired = [download_id for download_id, job in self._jobs.items()
+                       if job.status in FINISHED_STATUSES and job.updated_at < threshold]
+            for download_id in expired:
+                del self._jobs[download_id]
+        return len(expired)
+
+    def count(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def _maybe_evict(self):
+        if time.time() - self._last_eviction >= self.eviction_interval:
+            self._last_eviction = time.time()
+            self.evict_expired()
+
+
+class SQLiteJobStore(MemoryJobStore):
+    """Хранилище задач в SQLite (WAL): общее для нескольких процессов и переживает перезапуск"""
+
+    SQL_TYPES = {str: 'TEXT', int: 'INTEGER', float: 'REAL', bool: 'INTEGER'}
+
+    def __init__(self, path, ttl=24 * 3600, eviction_interval=60, poll_interval=0.5):
+        super().__init__(ttl=ttl, eviction_interval=eviction_interval)
+        self.path = path
+        # Изменения из других процессов замечаем опросом с этим интервалом
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+
+        columns = []
+        for f in fields(Job):
+            base_type = f.type.__args__[0] if hasattr(f.type, '__args__') else f.type
+            column = f"{f.name} {self.SQL_TYPES.get(base_type, 'TEXT')}"
+            if f.name == 'download_id':
+                column += ' PRIMARY KEY'
+            columns.append(column)
+
+        with self._connection() as db:
+            db.execute(f"CREATE TABLE IF NOT EXISTS jobs ({', '.join(columns)})")
+            # Базы от прошлых версий: добавляем недостающие колонки
+            existing = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+            for name, column in zip(JOB_FIELDS, columns):
+                if name not in existing:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status_updated ON jobs (status, updated_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id, created_at)")
+
+    def create(self, job):
+        values = asdict(job)
+        with self._connection() as db:
+            db.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(JOB_FIELDS)}) "
+                f"VALUES ({', '.join('?' for _ in JOB_FIELDS)})",
+                [values[name] for name in JOB_FIELDS]
+            )
+        self._notify()
+        self._maybe_evict()
+        return job
+
+    def get(self, download_id):
+        row = self._connection().execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE download_id = ?", (download_id,)
+        ).fetchone()
+        return self._job_from_row(row) if row else None
+
+    def update(self, download_id, **values):
+        unknown = set(values) - set(JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля задачи: {', '.join(sorted(unknown))}")
+        assignments = [f"{name} = ?" for name in values]
+        assignments += ["updated_at = ?", "version = version + 1"]
+        with self._connection() as db:
+            cursor = db.execute(
+                f"UPDATE jobs SET {', '.join(assignments)} WHERE download_id = ?",
+                list(values.values()) + [time.time(), download_id]
+            )
+        self._notify()
+        return cursor.rowcount > 0
+
+    def claim(self, download_id, expected_owner, new_owner):
+        with self._connection() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET owner = ?, updated_at = ?, version = version + 1 "
+                "WHERE download_id = ? AND owner IS ?",
+                (new_owner, time.time(), download_id, expected_owner)
+            )
+        return cursor.rowcount > 0
+
+    def delete(self, download_id):
+        with self._connection() as db:
+            db.execute("DELETE FROM jobs WHERE download_id = ?", (download_id,))
+
+    def list_by_status(self, statuses):
+        rows = self._connection().execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE status IN ({', '.join('?' for _ in statuses)})",
+            list(statuses)
+        ).fetchall()
+        return [self._job_from_row(row) for row in rows]
+
+    def queued_ahead(self, job):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND owner IS ? AND created_at < ?",
+            (job.owner, job.created_at)
+        ).fetchone()[0]
+
+    def list_by_batch(self, batch_id):
+        rows = self._connection().execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE batch_id = ? ORDER BY created_at, rowid",
+            (batch_id,)
+        ).fetchall()
+        return [self._job_from_row(row) for row in rows]
+
+    def wait(self, timeout):
+        with self._cond:
+            self._cond.wait(min(timeout, self.poll_interval))
+
+    def versions(self, download_ids):
+        result = {}
+        download_ids = list(download_ids)
+        db = self._connection()
+        # Поиск по первичному ключу, частями: у SQLite есть лимит параметров запроса
+        for index in range(0, len(download_ids), VERSION_QUERY_BATCH):
+            batch = download_ids[index:index + VERSION_QUERY_BATCH]
+            result.update(db.execute(
+                f"SELECT download_id, version FROM jobs WHERE download_id IN ({', '.join('?' for _ in batch)})",
+                batch
+            ).fetchall())
+        return result
+
+    def evict_expired(self):
+        with self._connection() as db:
+            cursor = db.execute(
+                f"DELETE FROM jobs WHERE status IN ({', '.join('?' for _ in FINISHED_STATUSES)}) AND updated_at < ?",
+                list(FINISHED_STATUSES) + [time.time() - self.ttl]
+            )
+        return cursor.rowcount
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _connection(self):
+        # У каждого потока свое соединение: объекты sqlite3 нельзя делить между потоками
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _job_from_row(row):
+        job = Job(**dict(zip(JOB_FIELDS, row)))
+        if job.use_adaptive is not None:
+            job.use_adaptive = bool(job.use_adaptive)
+        return job
@@ -0,0 +1,131 @@
+import os
+import shutil
+import threading
+import time
+from types import SimpleNamespace
+
+# Семейство кодека по началу строки codecs из манифеста ('avc1.640028' -> 'h264')
+CODEC_FAMILIES = {
+    'avc1': 'h264',
+    'avc3': 'h264',
+    'av01': 'av1',
+    'vp09': 'vp9',
+    'vp9': 'vp9',
+    'vp8': 'vp8',
+    'mp4a': 'aac',
+    'opus': 'opus',
+    'vorbis': 'vorbis',
+}
+
+# Контейнеры, принимающие пару кодеков без перекодирования: (расширение, видео, аудио)
+CONTAINERS = (
+    ('mp4', {'h264', 'av1'}, {'aac'}),
+    ('webm', {'vp9', 'vp8', 'av1'}, {'opus', 'vorbis'}),
+)
+# Matroska принимает любые пары
+FALLBACK_CONTAINER = 'mkv'
+
+# Приоритет ввода-вывода ffmpeg: best-effort, самый низкий уровень
+IONICE_ARGS = ['-c', '2', '-n', '7', '-t']
+
+
+def codec_family(codec):
+    if not codec:
+        return None
+    return CODEC_FAMILIES.get(codec.split('.', 1)[0].lower())
+
+
+def merged_container(video_codec, audio_codec, video_container=None, audio_container=None):
+    """Расширение файла для объединения видео и аудио без перекодирования.
+
+    Выбирается по кодекам потоков, а не по контейнеру видео: webm-видео с
+    аудио AAC в webm не объединить. Если кодеки неизвестны, подходит общий
+    контейнер потоков, иначе - mkv.
+    """
+    video, audio = codec_family(video_codec), codec_family(audio_codec)
+    if video and audio:
+        for extension, video_codecs, audio_codecs in CONTAINERS:
+            if video in video_codecs and audio in audio_codecs:
+                return extension
+        return FALLBACK_CONTAINER
+    if video_container and video_container == audio_container:
+        return video_container
+    return FALLBACK_CONTAINER
+
+
+def compatible_audio(video_codec, video_container, audio_codec, audio_container):
+    """Объединится ли аудио с видео в mp4/webm (а не в запасной mkv)"""
+    return merged_container(video_codec, audio_codec, video_container, audio_container) != FALLBACK_CONTAINER
+
+
+def merge_timeout(nbytes, base, min_rate):
+    """Таймаут ffmpeg: base секунд плюс время на nbytes входа при скорости не ниже min_rate байт/с"""
+    if not min_rate:
+        return base
+    return base + (nbytes or 0) / min_rate
+
+
+class FFmpegWatchdog:
+    """Убивает зависший ffmpeg, которому байты входов подаются через pipe.
+
+    Время скачивания входов не считается - ограничен только ffmpeg: сколько
+    запись в его pipe ждет, пока он прочитает, и сколько он работает после
+    конца всех входов (без pipe-входов - с запуска).
+    """
+
+    def __init__(self, process, timeout, inputs=0):
+        self.process = process
+        self.timeout = timeout
+        self.timed_out = False
+        # Когда началась запись в pipe входа, которую ffmpeg еще не принял
+        self._blocked_since = [None] * inputs
+        self._remaining = inputs
+        self._done_at = None if inputs else time.monotonic()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._watch, name='ffmpeg-watchdog', daemon=True).start()
+
+    def writer(self, index, pipe):
+        """Объект с write() для входа index: пишет в pipe, отмечая время ожидания"""
+        def write(data):
+            self._blocked_since[index] = time.monotonic()
+            try:
+                pipe.write(data)
+            finally:
+                self._blocked_since[index] = None
+        return SimpleNamespace(write=write)
+
+    def input_done(self):
+        with self._lock:
+            self._remaining -= 1
+            if not self._remaining:
+                self._done_at = time.monotonic()
+
+    def _watch(self):
+        while self.process.poll() is None:
+            time.sleep(min(1.0, self.timeout))
+            now = time.monotonic()
+            waiting = [now - since for since in list(self._blocked_since) if since is not None]
+            if self._done_at is not None:
+                waiting.append(now - self._done_at)
+            if waiting and max(waiting) > self.timeout and self.process.poll() is None:
+                self.timed_out = True
+                self.process.kill()
+                return
+
+
+def low_priority(cmd, niceness):
+    """Команда с пониженным приоритетом CPU (nice) и ввода-вывода (ionice), если они есть в системе.
+
+    nice и ionice заменяют себя командой (exec), поэтому PID и унаследованные
+    дескрипторы остаются у ffmpeg.
+    """
+    if not niceness or os.name != 'posix':
+        return cmd
+    prefix = []
+    ionice = shutil.which('ionice')
+    if ionice:
+        prefix += [ionice] + IONICE_ARGS
+    nice = shutil.which('nice')
+    if nice:
+        prefix += [nice, '-n', str(niceness)]
+    return prefix + cmd
@@ -0,0 +1,69 @@
+import threading
+import time
+
+
+class ProgressTracker:
+    """Счетчик скачанных байтов одной загрузки: процент, скорость и ETA.
+
+    add() вызывается из потоков загрузки на каждый блок, а on_update
+    получает снимок не чаще одного раза в interval секунд.
+    """
+
+    def __init__(self, total_bytes, on_update, interval=0.5, smoothing=0.3):
+        self.total_bytes = total_bytes or 0
+        self.on_update = on_update
+        self.interval = interval
+        self.smoothing = smoothing
+
+        self.downloaded = 0
+        self.speed = 0.0
+        self._lock = threading.Lock()
+        self._last_time = time.time()
+        self._last_bytes = 0
+
+    def add(self, nbytes):
+        with self._lock:
+            self.downloaded += nbytes
+            now = time.time()
+            elapsed = now - self._last_time
+            if elapsed < self.interval:
+                return
+            # Экспоненциальное сглаживание, чтобы скорость не скакала
+            current = (self.downloaded - self._last_bytes) / elapsed
+            self.speed = current if not self.speed else self.smoothing * current + (1 - self.smoothing) * self.speed
+            self._last_time = now
+            self._last_bytes = self.downloaded
+            snapshot = self._snapshot()
+        self.on_update(snapshot)
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {
+            'downloaded_bytes': self.downloaded,
+            'total_bytes': self.total_bytes,
+            'speed': round(self.speed),
+            'eta': None,
+            'progress': None,
+        }
+        if self.total_bytes:
+            snapshot['progress'] = round(min(100.0, self.downloaded * 100 / self.total_bytes), 1)
+            if self.speed > 0:
+                snapshot['eta'] = round(max(0, self.total_bytes - self.downloaded) / self.speed)
+        return snapshot
+
+
+def parse_ffmpeg_progress(lines, duration, on_update):
+    """Читает вывод ffmpeg -progress и сообщает процент объединения"""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode(errors='replace')
+        key, _, value = line.strip().partition('=')
+        if key in ('out_time_us', 'out_time_ms') and value.isdigit() and duration:
+            # out_time_ms в ffmpeg исторически тоже в микросекундах
+            seconds = int(value) / 1_000_000
+            on_update(round(min(100.0, seconds * 100 / duration), 1))
+        elif key == 'progress' and value == 'end':
+            on_update(100.0)
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import threading
+
+
+class ResultStore:
+    """Готовые файлы, адресуемые по (ID видео, itag'и потоков или битрейт перекодирования, контейнер).
+
+    Одинаковые запросы получают уже готовый файл, а параллельные запросы
+    одного и того же ключа присоединяются к единственной активной загрузке.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        # key -> {'leader': download_id, 'followers': [download_id, ...]}
+        self._in_flight = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(video_id, itags, extension, variant=None):
+        """variant отличает файлы из тех же потоков (например, клип '30000-60000ms')"""
+        parts = tuple(str(int(itag)) for itag in itags)
+        return (video_id, parts + ((variant,) if variant else ()), extension)
+
+    @staticmethod
+    def make_transcode_key(video_id, bitrate, extension):
+        """Ключ перекодированного аудио: не зависит от исходного потока"""
+        return (video_id, (f"{int(bitrate)}k",), extension)
+
+    def filename_for(self, key):
+        # ID видео идет последним: /download_file отдает часть имени после первого '_'
+        video_id, parts, extension = key
+        return f"{'-'.join(parts)}_{video_id}.{extension}"
+
+    def path_for(self, key):
+        return os.path.join(self.folder, self.filename_for(key))
+
+    def acquire(self, key, download_id):
+        """Регистрирует загрузку по ключу.
+
+        Возвращает ('done', путь к файлу), ('leader', None) - эта загрузка
+        должна скачать файл сама, или ('follower', download_id лидера).
+        """
+        with self._lock:
+            job = self._in_flight.get(key)
+            if job is not None:
+                job['followers'].append(download_id)
+                self.coalesced += 1
+                return 'follower', job['leader']
+
+            path = self.path_for(key)
+            if os.path.exists(path):
+                self.hits += 1
+                return 'done', path
+
+            self._in_flight[key] = {'leader': download_id, 'followers': []}
+            self.misses += 1
+            return 'leader', None
+
+    def complete(self, key):
+        """Завершает загрузку по ключу, возвращает ID ожидавших загрузок"""
+        with self._lock:
+            job = self._in_flight.pop(key, None)
+        return job['followers'] if job else []
+
+    def fail(self, key):
+        """Снимает неудачную загрузку, возвращает ID ожидавших загрузок"""
+        return self.complete(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._in_flight),
+                'hits': self.hits,
+                'coalesced': self.coalesced,
+                'misses': self.misses,
+            }
+
+
+class SQLiteResultStore(ResultStore):
+    """Загрузки в процессе, общие для нескольких процессов (SQLite, та же база, что и задачи).
+
+    Запрос, пришедший в другой процесс, присоединяется к уже идущей загрузке
+    того же файла. Лидер, чья задача уже не выполняется (процесс остановился,
+    а задачу никто не возобновил), заменяется новым.
+    """
+
+    def __init__(self, folder, path, is_active=None):
+        super().__init__(folder)
+        self.path = path
+        self.is_active = is_active or (lambda download_id: True)
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS results_in_flight (key TEXT PRIMARY KEY, leader TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS results_followers "
+                       "(key TEXT, download_id TEXT, PRIMARY KEY (key, download_id))")
+
+    def acquire(self, key, download_id):
+        name = self.filename_for(key)
+        db = self._connection()
+        with db:
+            # Два процесса не должны одновременно стать лидерами одного ключа
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT leader FROM results_in_flight WHERE key = ?", (name,)).fetchone()
+            # Возобновленная после перезапуска задача остается лидером
+            if row is not None and row[0] != download_id and self.is_active(row[0]):
+                db.execute("INSERT OR IGNORE INTO results_followers (key, download_id) VALUES (?, ?)",
+                           (name, download_id))
+                self.coalesced += 1
+                return 'follower', row[0]
+
+            path = self.path_for(key)
+            if os.path.exists(path):
+                self.hits += 1
+                return 'done', path
+
+            db.execute("INSERT OR REPLACE INTO results_in_flight (key, leader) VALUES (?, ?)", (name, download_id))
+            self.misses += 1
+            return 'leader', None
+
+    def complete(self, key):
+        name = self.filename_for(key)
+        db = self._connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            followers = [download_id for download_id, in db.execute(
+                "SELECT download_id FROM results_followers WHERE key = ?", (name,)
+            )]
+            db.execute("DELETE FROM results_followers WHERE key = ?", (name,))
+            db.execute("DELETE FROM results_in_flight WHERE key = ?", (name,))
+        return followers
+
+    def stats(self):
+        stats = super().stats()
+        stats['in_flight'] = self._connection().execute("SELECT COUNT(*) FROM results_in_flight").fetchone()[0]
+        return stats
+
+    def _connection(self):
+        # Как в SQLiteJobStore: у каждого потока свое соединение
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
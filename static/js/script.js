@@ -13,6 +13,7 @@ document.addEventListener('DOMContentLoaded', function() {
     let currentDownloadId = null;
     let selectedQuality = null;
     let statusCheckInterval = null;
+    let statusEventSource = null;
 
     // Получение информации о видео
     getInfoBtn.addEventListener('click', async function() {
@@ -174,35 +175,79 @@ document.addEventListener('DOMContentLoaded', function() {
     function startStatusChecking() {
         if (statusCheckInterval) {
             clearInterval(statusCheckInterval);
+            statusCheckInterval = null;
+        }
+        if (statusEventSource) {
+            statusEventSource.close();
+            statusEventSource = null;
         }
         
+        // Сервер сам присылает изменения статуса через Server-Sent Events
+        if (window.EventSource) {
+            statusEventSource = new EventSource(`/events/${currentDownloadId}`);
+            statusEventSource.onmessage = (event) => {
+                handleStatus(JSON.parse(event.data));
+            };
+            statusEventSource.onerror = () => {
+                // Соединение оборвалось до завершения - переходим на опрос
+                if (statusEventSource) {
+                    statusEventSource.close();
+                    statusEventSource = null;
+                    startStatusPolling();
+                }
+            };
+        } else {
+            startStatusPolling();
+        }
+    }
+
+    function startStatusPolling() {
         statusCheckInterval = setInterval(async () => {
             try {
                 const response = await fetch(`/status/${currentDownloadId}`);
                 const data = await response.json();
-                
-                updateDownloadProgress(data);
-                
-                // Если загрузка завершена или произошла ошибка, останавливаем проверку
-                if (data.status === 'completed' || data.status === 'error') {
-                    clearInterval(statusCheckInterval);
-                    
-                    if (data.status === 'completed') {
-                        // Показываем ссылку для скачивания
-                        const downloadLink = document.getElementById('downloadLink');
-                        downloadLink.href = data.download_url;
-                        downloadLink.classList.remove('hidden');
-                        
-                        // Обновляем текст прогресса
-                        document.getElementById('progressText').textContent = 'Загрузка завершена!';
-                    }
-                }
+                handleStatus(data);
             } catch (error) {
                 console.error('Error checking status:', error);
             }
         }, 2000); // Проверяем каждые 2 секунды
     }
 
+    function handleStatus(data) {
+        updateDownloadProgress(data);
+        
+        // Progressive и аудио можно скачивать, не дожидаясь конца загрузки
+        if (data.stream_url && data.status === 'downloading') {
+            const downloadLink = document.getElementById('downloadLink');
+            if (downloadLink.classList.contains('hidden')) {
+                downloadLink.href = data.stream_url;
+                downloadLink.classList.remove('hidden');
+            }
+        }
+        
+        // Если загрузка завершена или произошла ошибка, останавливаем проверку
+        if (data.status === 'completed' || data.status === 'error') {
+            if (statusCheckInterval) {
+                clearInterval(statusCheckInterval);
+                statusCheckInterval = null;
+            }
+            if (statusEventSource) {
+                statusEventSource.close();
+                statusEventSource = null;
+            }
+            
+            if (data.status === 'completed') {
+                // Показываем ссылку для скачивания
+                const downloadLink = document.getElementById('downloadLink');
+                downloadLink.href = data.download_url;
+                downloadLink.classList.remove('hidden');
+                
+                // Обновляем текст прогресса
+                document.getElementById('progressText').textContent = 'Загрузка завершена!';
+            }
+        }
+    }
+
     function updateDownloadProgress(data) {
         const progressFill = document.getElementById('progressFill');
         const progressText = document.getElementById('progressText');
@@ -212,13 +257,33 @@ document.addEventListener('DOMContentLoaded', function() {
         let statusText = '';
         
         switch (data.status) {
+            case 'queued':
+                progressPercent = 5;
+                statusText = data.queue_position
+                    ? `В очереди (позиция ${data.queue_position})...`
+                    : 'В очереди...';
+                break;
             case 'processing':
                 progressPercent = 25;
                 statusText = 'Получение информации о видео...';
                 break;
             case 'downloading':
-                progressPercent = 50;
+                // Реальный прогресс по байтам, если сервер его знает
+                progressPercent = data.progress != null ? 10 + data.progress * 0.8 : 50;
                 statusText = 'Скачивание видео...';
+                if (data.progress != null) {
+                    statusText = `Скачивание видео... ${data.progress.toFixed(0)}%`;
+                    if (data.speed) statusText += ` (${formatBytes(data.speed)}/с`;
+                    if (data.speed && data.eta != null) statusText += `, осталось ${formatDuration(data.eta)}`;
+                    if (data.speed) statusText += ')';
+                }
+                break;
+            case 'merging':
+                progressPercent = data.merge_progress != null ? 90 + data.merge_progress * 0.1 : 90;
+                statusText = 'Объединение видео и аудио...';
+                if (data.merge_progress != null) {
+                    statusText = `Объединение видео и аудио... ${data.merge_progress.toFixed(0)}%`;
+                }
                 break;
             case 'completed':
                 progressPercent = 100;
@@ -247,6 +312,22 @@ document.addEventListener('DOMContentLoaded', function() {
         downloadDetails.innerHTML = detailsHtml;
     }
 
+    function formatBytes(bytes) {
+        const units = ['Б', 'КБ', 'МБ', 'ГБ'];
+        let value = bytes;
+        let unit = 0;
+        while (value >= 1024 && unit < units.length - 1) {
+            value /= 1024;
+            unit++;
+        }
+        return `${value.toFixed(unit ? 1 : 0)} ${units[unit]}`;
+    }
+
+    function formatDuration(seconds) {
+        const minutes = Math.floor(seconds / 60);
+        return `${minutes}:${String(seconds % 60).padStart(2, '0')}`;
+    }
+
     function showError(message) {
         errorMessageDiv.textContent = message;
         errorMessageDiv.classList.remove('hidden');
@@ -0,0 +1,466 @@
+import heapq
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: без блокировки файла очисткой занимается каждый процесс
+    fcntl = None
+
+# Временные файлы загрузки начинаются с ее ID: <id>_video, <id>_audio,
+# <id>.<ext>, <id>.<ext>.part, *.part.json
+TEMP_FILE_PATTERN = re.compile(r'^(dl_\d+_[0-9a-f]+)(?:_video|_audio|\.)')
+TEMP_SUFFIXES = ('', '.part', '.part.json')
+
+
+def temp_names(download_id, extension=None):
+    """Имена всех временных файлов, которые может создать загрузка"""
+    bases = [f"{download_id}_video", f"{download_id}_audio"]
+    if extension:
+        bases.append(f"{download_id}.{extension}")
+    return [base + suffix for base in bases for suffix in TEMP_SUFFIXES]
+
+
+class FileEntry:
+    __slots__ = ('size', 'last_access', 'refs')
+
+    def __init__(self, size, last_access):
+        self.size = size
+        self.last_access = last_access
+        self.refs = 0
+
+
+class StorageManager:
+    """Бюджет места в папке загрузок с LRU-вытеснением готовых файлов.
+
+    Индекс файлов (размер, последнее обращение, число пользователей) живет в
+    памяти, а порядок вытеснения - в куче по времени обращения, поэтому
+    освобождение места не требует обхода папки. Файлы, которые сейчас
+    отдаются клиентам, не удаляются. Временные файлы учитываются по ID
+    загрузки (reserve), поэтому уборка брошенных тоже обходится без scandir.
+    """
+
+    def __init__(self, folder, max_bytes, max_age=None, is_active=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        # Файлы без обращений дольше max_age секунд удаляются, даже если место есть
+        self.max_age = max_age
+        # is_active(download_id) - выполняется ли еще загрузка (ее временные файлы трогать нельзя)
+        self.is_active = is_active or (lambda download_id: False)
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._heap = []
+        self._reserved = {}
+        self._temp = {}  # download_id -> имена временных файлов
+        self.total_bytes = 0
+        self.evictions = 0
+        self.orphans_removed = 0
+        self._thread = None
+
+    def scan(self):
+        """Строит индекс по содержимому папки (один раз при запуске).
+
+        Временные файлы, оставшиеся от прошлого запуска, запоминаются по ID
+        загрузки - дальше recover_orphans проверяет только их.
+        """
+        entries, temp = self._scan_folder()
+        with self._lock:
+            for download_id, names in temp.items():
+                self._temp.setdefault(download_id, set()).update(names)
+            self._entries = entries
+            self._heap = [(entry.last_access, name) for name, entry in entries.items()]
+            heapq.heapify(self._heap)
+            self.total_bytes = sum(entry.size for entry in entries.values())
+
+    def _scan_folder(self):
+        entries = {}
+        temp = {}
+        with os.scandir(self.folder) as items:
+            for item in items:
+                if not item.is_file():
+                    continue
+                match = TEMP_FILE_PATTERN.match(item.name)
+                if match:
+                    temp.setdefault(match.group(1), set()).add(item.name)
+                    continue
+                stat = item.stat()
+                entries[item.name] = FileEntry(stat.st_size, max(stat.st_atime, stat.st_mtime))
+        return entries, temp
+
+    def start(self, interval=60):
+        """Фоновое вытеснение и уборка брошенных временных файлов"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"Ошибка очистки папки загрузок: {str(e)}")
+
+        self._thread = threading.Thread(target=run, name='storage-manager', daemon=True)
+        self._thread.start()
+
+    def sweep(self):
+        """Вытесняет лишнее и удаляет брошенные временные файлы. Возвращает удаленные имена"""
+        return self.evict() + self.recover_orphans()
+
+    def add(self, path):
+        """Регистрирует готовый файл (место под него освобождено заранее через reserve)"""
+        name = os.path.basename(path)
+        size = os.path.getsize(path)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = self._entries[name] = FileEntry(size, now)
+                self.total_bytes += size
+            else:
+                self.total_bytes += size - entry.size
+                entry.size = size
+                entry.last_access = now
+            heapq.heappush(self._heap, (now, name))
+
+    def touch(self, path):
+        """Отмечает обращение к файлу (он переезжает в конец очереди на вытеснение)"""
+        name = os.path.basename(path)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            entry.last_access = now
+            # Старая запись в куче остается и будет пропущена как устаревшая
+            heapq.heappush(self._heap, (now, name))
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._heap = [(e.last_access, n) for n, e in self._entries.items()]
+                heapq.heapify(self._heap)
+
+    def acquire(self, path):
+        """Файл используется (отдается клиенту) - вытеснять его нельзя"""
+        name = os.path.basename(path)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.refs += 1
+        self.touch(path)
+
+    def release(self, path):
+        with self._lock:
+            entry = self._entries.get(os.path.basename(path))
+            if entry is not None and entry.refs > 0:
+                entry.refs -= 1
+
+    @contextmanager
+    def using(self, path):
+        self.acquire(path)
+        try:
+            yield
+        finally:
+            self.release(path)
+
+    def reserve(self, key, nbytes, extension=None):
+        """Резервирует место под будущий файл загрузки key и заранее освобождает его.
+
+        Временные файлы загрузки (с расширением результата extension)
+        запоминаются, чтобы убрать их, если загрузка будет брошена.
+        """
+        with self._lock:
+            self._reserved[key] = nbytes
+            self._temp.setdefault(key, set()).update(temp_names(key, extension))
+        self.evict()
+
+    def unreserve(self, key):
+        with self._lock:
+            self._reserved.pop(key, None)
+
+    def evict(self):
+        """Удаляет давно не используемые файлы, пока не уложимся в бюджет"""
+        removed = []
+        skipped = []
+        cutoff = time.time() - self.max_age if self.max_age else None
+        with self._lock:
+            reserved = sum(self._reserved.values())
+            while self._heap:
+                over_budget = self.total_bytes + reserved > self.max_bytes
+                last_access, name = self._heap[0]
+                if not over_budget and (cutoff is None or last_access >= cutoff):
+                    break
+                heapq.heappop(self._heap)
+                entry = self._entries.get(name)
+                if entry is None or entry.last_access != last_access:
+                    continue
+                if entry.refs:
+                    skipped.append((last_access, name))
+                    continue
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Не удалось удалить {name}: {str(e)}")
+                    skipped.append((last_access, name))
+                    continue
+                del self._entries[name]
+                self.total_bytes -= entry.size
+                self.evictions += 1
+                removed.append(name)
+            for item in skipped:
+                heapq.heappush(self._heap, item)
+        return removed
+
+    def recover_orphans(self):
+        """Удаляет временные файлы (_video, _audio, .part) загрузок, которые уже не выполняются"""
+        removed = []
+        with self._lock:
+            tracked = list(self._temp.items())
+        for download_id, names in tracked:
+            if self.is_active(download_id):
+                continue
+            if self._remove_temp(names, removed):
+                with self._lock:
+                    self._temp.pop(download_id, None)
+        return removed
+
+    def _remove_temp(self, names, removed):
+        """Удаляет временные файлы; False, если какой-то удалить не удалось"""
+        done = True
+        for name in names:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                continue
+            except OSError:
+                done = False
+                continue
+            self.orphans_removed += 1
+            removed.append(name)
+        return done
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'total_bytes': self.total_bytes,
+                'reserved_bytes': sum(self._reserved.values()),
+                'max_bytes': self.max_bytes,
+                'in_use': sum(1 for entry in self._entries.values() if entry.refs),
+                'evictions': self.evictions,
+                'orphans_removed': self.orphans_removed,
+            }
+
+
+class SQLiteStorageManager(StorageManager):
+    """Бюджет места, общий для нескольких процессов с одной папкой загрузок.
+
+    Индекс файлов, резервы, счетчики использования и временные файлы загрузок
+    хранятся в SQLite (той же базе, что и задачи), поэтому каждый процесс
+    видит полный бюджет и не удалит файл, который отдает другой. Фоновую
+    очистку ведет один процесс - тот, кто держит блокировку файла <path>.sweeper;
+    если он остановится, ее подхватит следующий.
+    """
+
+    def __init__(self, folder, path, max_bytes, max_age=None, is_active=None, owner=None, owner_alive=None):
+        super().__init__(folder, max_bytes, max_age=max_age, is_active=is_active)
+        self.path = path
+        # Кто держит файлы и резервы (owner) и жив ли еще процесс-владелец
+        self.owner = owner or str(os.getpid())
+        self.owner_alive = owner_alive or (lambda owner: True)
+        self._local = threading.local()
+        self._lock_file = None
+        self._indexed = False
+
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS storage_files "
+                       "(name TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS storage_files_access ON storage_files (last_access)")
+            db.execute("CREATE TABLE IF NOT EXISTS storage_refs "
+                       "(name TEXT, owner TEXT, refs INTEGER, PRIMARY KEY (name, owner))")
+            db.execute("CREATE TABLE IF NOT EXISTS storage_reservations "
+                       "(key TEXT PRIMARY KEY, nbytes INTEGER, owner TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS storage_temp "
+                       "(download_id TEXT, name TEXT, PRIMARY KEY (download_id, name))")
+
+    @property
+    def sweeper(self):
+        """Ведет ли этот процесс фоновую очистку (захватывает блокировку, если она свободна)"""
+        if fcntl is None:
+            return True
+        if self._lock_file is None:
+            lock_file = open(self.path + '.sweeper', 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            # Блокировка держится до конца процесса: файл остается открытым
+            self._lock_file = lock_file
+        return True
+
+    def scan(self):
+        """Сверяет общий индекс с папкой. Это делает только процесс, ведущий очистку"""
+        if not self.sweeper:
+            return
+        entries, temp = self._scan_folder()
+        with self._connection() as db:
+            known = {name for name, in db.execute("SELECT name FROM storage_files")}
+            db.executemany("DELETE FROM storage_files WHERE name = ?",
+                           [(name,) for name in known - set(entries)])
+            # Для известных файлов время обращения из базы точнее, чем atime
+            db.executemany("INSERT OR IGNORE INTO storage_files (name, size, last_access) VALUES (?, ?, ?)",
+                           [(name, entry.size, entry.last_access) for name, entry in entries.items()])
+            db.executemany("UPDATE storage_files SET size = ? WHERE name = ?",
+                           [(entry.size, name) for name, entry in entries.items()])
+            db.executemany("INSERT OR IGNORE INTO storage_temp (download_id, name) VALUES (?, ?)",
+                           [(download_id, name) for download_id, names in temp.items() for name in names])
+        self._indexed = True
+
+    def start(self, interval=60):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    if not self.sweeper:
+                        continue
+                    if not self._indexed:
+                        # Очистку подхватили после остановленного процесса
+                        self.scan()
+                    self.sweep()
+                except Exception as e:
+                    print(f"Ошибка очистки папки загрузок: {str(e)}")
+
+        self._thread = threading.Thread(target=run, name='storage-manager', daemon=True)
+        self._thread.start()
+
+    def sweep(self):
+        self.release_dead_owners()
+        return super().sweep()
+
+    def release_dead_owners(self):
+        """Снимает счетчики использования и резервы процессов, которые остановились"""
+        db = self._connection()
+        owners = {owner for owner, in db.execute(
+            "SELECT owner FROM storage_refs UNION SELECT owner FROM storage_reservations"
+        )}
+        dead = [(owner,) for owner in owners if not self.owner_alive(owner)]
+        if dead:
+            with db:
+                db.executemany("DELETE FROM storage_refs WHERE owner = ?", dead)
+                db.executemany("DELETE FROM storage_reservations WHERE owner = ?", dead)
+
+    def add(self, path):
+        with self._connection() as db:
+            db.execute(
+                "INSERT INTO storage_files (name, size, last_access) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET size = excluded.size, last_access = excluded.last_access",
+                (os.path.basename(path), os.path.getsize(path), time.time())
+            )
+
+    def touch(self, path):
+        with self._connection() as db:
+            db.execute("UPDATE storage_files SET last_access = ? WHERE name = ?",
+                       (time.time(), os.path.basename(path)))
+
+    def acquire(self, path):
+        with self._connection() as db:
+            db.execute(
+                "INSERT INTO storage_refs (name, owner, refs) VALUES (?, ?, 1) "
+                "ON CONFLICT (name, owner) DO UPDATE SET refs = refs + 1",
+                (os.path.basename(path), self.owner)
+            )
+        self.touch(path)
+
+    def release(self, path):
+        params = (os.path.basename(path), self.owner)
+        with self._connection() as db:
+            db.execute("UPDATE storage_refs SET refs = refs - 1 WHERE name = ? AND owner = ?", params)
+            db.execute("DELETE FROM storage_refs WHERE name = ? AND owner = ? AND refs <= 0", params)
+
+    def reserve(self, key, nbytes, extension=None):
+        with self._connection() as db:
+            db.execute("INSERT OR REPLACE INTO storage_reservations (key, nbytes, owner) VALUES (?, ?, ?)",
+                       (key, nbytes, self.owner))
+            db.executemany("INSERT OR IGNORE INTO storage_temp (download_id, name) VALUES (?, ?)",
+                           [(key, name) for name in temp_names(key, extension)])
+        self.evict()
+
+    def unreserve(self, key):
+        with self._connection() as db:
+            db.execute("DELETE FROM storage_reservations WHERE key = ?", (key,))
+
+    def evict(self):
+        removed = []
+        cutoff = time.time() - self.max_age if self.max_age else None
+        db = self._connection()
+        with db:
+            # Вытеснение из нескольких процессов идет по очереди
+            db.execute("BEGIN IMMEDIATE")
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM storage_files").fetchone()[0]
+            reserved = db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM storage_reservations").fetchone()[0]
+            excess = total + reserved - self.max_bytes
+            # Кандидаты в порядке давности обращения (по индексу), без используемых
+            victims = []
+            for name, size, last_access in db.execute(
+                "SELECT name, size, last_access FROM storage_files AS f "
+                "WHERE NOT EXISTS (SELECT 1 FROM storage_refs AS r WHERE r.name = f.name) "
+                "ORDER BY last_access"
+            ):
+                if excess <= 0 and (cutoff is None or last_access >= cutoff):
+                    break
+                victims.append(name)
+                excess -= size
+            for name in victims:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Не удалось удалить {name}: {str(e)}")
+                    continue
+                db.execute("DELETE FROM storage_files WHERE name = ?", (name,))
+                self.evictions += 1
+                removed.append(name)
+        return removed
+
+    def recover_orphans(self):
+        removed = []
+        db = self._connection()
+        tracked = {}
+        for download_id, name in db.execute("SELECT download_id, name FROM storage_temp"):
+            tracked.setdefault(download_id, []).append(name)
+        for download_id, names in tracked.items():
+            if self.is_active(download_id):
+                continue
+            if self._remove_temp(names, removed):
+                with db:
+                    db.execute("DELETE FROM storage_temp WHERE download_id = ?", (download_id,))
+        return removed
+
+    def stats(self):
+        db = self._connection()
+        files, total_bytes = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM storage_files").fetchone()
+        return {
+            'files': files,
+            'total_bytes': total_bytes,
+            'reserved_bytes': db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM storage_reservations").fetchone()[0],
+            'max_bytes': self.max_bytes,
+            'in_use': db.execute("SELECT COUNT(DISTINCT name) FROM storage_refs").fetchone()[0],
+            'evictions': self.evictions,
+            'orphans_removed': self.orphans_removed,
+            'sweeper': self._lock_file is not None or fcntl is None,
+        }
+
+    def _connection(self):
+        # Как в SQLiteJobStore: у каждого потока свое соединение
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
@@ -0,0 +1,246 @@
+import re
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from muxing import merged_container, compatible_audio, codec_family
+
+
+def parse_resolution(value):
+    """'1080p' / '1080p60' -> 1080, иначе 0"""
+    match = re.match(r'(\d+)p', str(value or ''))
+    return int(match.group(1)) if match else 0
+
+
+def parse_bitrate(value):
+    """'160kbps' -> 160, иначе 0"""
+    match = re.match(r'(\d+)\s*kbps', str(value or ''))
+    return int(match.group(1)) if match else 0
+
+
+@dataclass
+class StreamInfo:
+    """Поток, разобранный один раз: все поля для выбора уже числа"""
+    stream: Any
+    itag: int
+    kind: str  # 'progressive', 'video' (adaptive) или 'audio'
+    resolution: int
+    resolution_label: Optional[str]
+    fps: int
+    bitrate: int  # kbps для аудио, бит/с для видео
+    codec: Optional[str]
+    container: str
+    filesize: int
+
+    @classmethod
+    def from_stream(cls, stream):
+        if getattr(stream, 'is_progressive', False):
+            kind = 'progressive'
+        elif getattr(stream, 'includes_video_track', True) and getattr(stream, 'resolution', None):
+            kind = 'video'
+        else:
+            kind = 'audio'
+
+        if kind == 'audio':
+            bitrate = parse_bitrate(getattr(stream, 'abr', None))
+            codec = getattr(stream, 'audio_codec', None)
+        else:
+            bitrate = getattr(stream, 'bitrate', None) or 0
+            codec = getattr(stream, 'video_codec', None)
+
+        return cls(
+            stream=stream,
+            itag=stream.itag,
+            kind=kind,
+            resolution=parse_resolution(getattr(stream, 'resolution', None)),
+            resolution_label=getattr(stream, 'resolution', None),
+            fps=getattr(stream, 'fps', None) or 0,
+            bitrate=bitrate,
+            codec=codec,
+            container=stream_container(stream, kind),
+            filesize=getattr(stream, 'filesize', None) or 0,
+        )
+
+
+def stream_container(stream, kind):
+    """Расширение файла для потока"""
+    subtype = getattr(stream, 'subtype', None)
+    if subtype:
+        return subtype
+    mime = getattr(stream, 'mime_type', '') or ''
+    if 'mp4' in mime:
+        return 'mp4'
+    if 'webm' in mime or kind == 'audio':
+        return 'webm'
+    return 'mp4'
+
+
+class Selection:
+    """Выбранные потоки: один progressive/аудио поток или пара adaptive видео + аудио"""
+
+    def __init__(self, single=None, video=None, audio=None):
+        self.single = single
+        self.video = video
+        self.audio = audio
+
+    @property
+    def use_adaptive(self):
+        return self.video is not None
+
+    @property
+    def parts(self):
+        return [self.video, self.audio] if self.use_adaptive else [self.single]
+
+    @property
+    def streams(self):
+        return [part.stream for part in self.parts]
+
+    @property
+    def itags(self):
+        return [part.itag for part in self.parts]
+
+    @property
+    def filesize(self):
+        """Суммарный размер в байтах"""
+        return sum(part.filesize for part in self.parts)
+
+    @property
+    def resolution_label(self):
+        return self.parts[0].resolution_label
+
+    @property
+    def extension(self):
+        if self.use_adaptive:
+            # Контейнер результата объединения определяют кодеки обоих потоков
+            return merged_container(self.video.codec, self.audio.codec, self.video.container, self.audio.container)
+        return self.parts[0].container
+
+
+class StreamIndex:
+    """Индекс потоков видео, построенный за один проход.
+
+    Отвечает на запросы "лучшее", "худшее", "аудио", точное и ближайшее
+    разрешение без повторной фильтрации и сортировки списка потоков.
+    """
+
+    def __init__(self, streams):
+        self.records = []
+        # разрешение -> первый поток с этим разрешением (порядок манифеста сохраняется)
+        self.progressive_by_resolution = {}
+        self.video_by_resolution = {}
+        self.best_audio = None  # лучший adaptive аудиопоток
+        self.first_audio = None
+        self.audio_records = []
+
+        for stream in streams:
+            record = StreamInfo.from_stream(stream)
+            self.records.append(record)
+            if record.kind == 'progressive':
+                if record.resolution:
+                    self.progressive_by_resolution.setdefault(record.resolution, record)
+            elif record.kind == 'video':
+                self.video_by_resolution.setdefault(record.resolution, record)
+            else:
+                self.audio_records.append(record)
+                if self.first_audio is None:
+                    self.first_audio = record
+                if self.best_audio is None or record.bitrate > self.best_audio.bitrate:
+                    self.best_audio = record
+
+        # Разрешений всего несколько, так что их сортировка ничего не стоит
+        self.progressive_resolutions = sorted(self.progressive_by_resolution)
+        # Adaptive видео имеет смысл, только если есть аудио для объединения
+        self.video_resolutions = sorted(self.video_by_resolution) if self.best_audio else []
+
+        # Аудио к adaptive-видео зависит только от его кодека и контейнера: (семейство, контейнер) -> аудио
+        self.companions = {}
+        for record in self.video_by_resolution.values():
+            key = (codec_family(record.codec), record.container)
+            if key not in self.companions:
+                self.companions[key] = self._best_compatible_audio(record)
+
+    @property
+    def best_progressive(self):
+        if not self.progressive_resolutions:
+            return None
+        return self.progressive_by_resolution[self.progressive_resolutions[-1]]
+
+    @property
+    def best_video(self):
+        if not self.video_resolutions:
+            return None
+        return self.video_by_resolution[self.video_resolutions[-1]]
+
+    def select(self, quality):
+        """Потоки для значения качества из /get_info ('highest', 'lowest', 'audio', '720p')"""
+        if quality == 'highest':
+            return self.highest()
+        if quality == 'lowest':
+            return self.lowest()
+        if quality == 'audio':
+            return self.audio()
+        return self.exact(quality) or self.nearest(quality)
+
+    def highest(self):
+        # Adaptive выбираем, только если он действительно лучше progressive
+        progressive = self.best_progressive
+        video = self.best_video
+        if video and video.resolution > (progressive.resolution if progressive else 0):
+            return Selection(video=video, audio=self.companion_audio(video))
+        return Selection(single=progressive) if progressive else None
+
+    def lowest(self):
+        # Для lowest используем только progressive потоки (они проще для скачивания)
+        if not self.progressive_resolutions:
+            return None
+        return Selection(single=self.progressive_by_resolution[self.progressive_resolutions[0]])
+
+    def audio(self):
+        audio = self.best_audio if self.best_audio and self.best_audio.bitrate else self.first_audio
+        return Selection(single=audio) if audio else None
+
+    def exact(self, quality):
+        """Точное разрешение: сначала progressive, потом adaptive"""
+        resolution = parse_resolution(quality)
+        if resolution in self.progressive_by_resolution:
+            return Selection(single=self.progressive_by_resolution[resolution])
+        if resolution in self.video_by_resolution and self.best_audio:
+            video = self.video_by_resolution[resolution]
+            return Selection(video=video, audio=self.companion_audio(video))
+        return None
+
+    def nearest(self, quality):
+        """Ближайшее progressive разрешение не ниже заданного, иначе максимальное"""
+        target = parse_resolution(quality)
+        for resolution in self.progressive_resolutions:
+            if resolution >= target:
+                return Selection(single=self.progressive_by_resolution[resolution])
+        best = self.best_progressive
+        return Selection(single=best) if best else None
+
+    def companion_audio(self, video):
+        """Аудио для adaptive-видео: лучшее из объединяемых с ним в mp4/webm, иначе просто лучшее"""
+        key = (codec_family(video.codec), video.container)
+        if key not in self.companions:
+            self.companions[key] = self._best_compatible_audio(video)
+        return self.companions[key]
+
+    def _best_compatible_audio(self, video):
+        compatible = [record for record in self.audio_records
+                      if compatible_audio(video.codec, video.container, record.codec, record.container)]
+        if not compatible:
+            return self.best_audio
+        return max(compatible, key=lambda record: record.bitrate)
+
+    def video_options(self):
+        """Лучший поток для каждого разрешения, от большего к меньшему.
+
+        При одинаковом разрешении progressive предпочтительнее: его не нужно объединять.
+        """
+        options = []
+        for resolution in sorted(set(self.progressive_resolutions) | set(self.video_resolutions), reverse=True):
+            if resolution in self.progressive_by_resolution:
+                options.append(Selection(single=self.progressive_by_resolution[resolution]))
+            else:
+                video = self.video_by_resolution[resolution]
+                options.append(Selection(video=video, audio=self.companion_audio(video)))
+        return options
@@ -0,0 +1,218 @@
+import hashlib
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:  # Уменьшение превью необязательно: без Pillow отдаем оригинал
+    Image = None
+
+THUMBNAIL_NAME = re.compile(r'^([\w-]{11})(?:_(\d+))?$')
+MAX_THUMBNAIL_SIZE = 5 * 1024 * 1024  # Превью YouTube заметно меньше
+
+
+def image_mimetype(data):
+    """Тип изображения по первым байтам"""
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+class Thumbnail:
+    """Байты превью, готовые к отдаче"""
+
+    def __init__(self, data):
+        self.data = data
+        self.mimetype = image_mimetype(data)
+        self.etag = hashlib.sha1(data).hexdigest()[:20]
+
+
+class ThumbnailCache:
+    """Превью видео: скачиваются один раз и хранятся на диске в пределах бюджета.
+
+    Последние отданные превью держатся и в памяти. Уменьшенные копии
+    (ширины из sizes) строятся в фоновом пуле, если установлен Pillow;
+    пока копия не готова, отдается оригинал.
+    """
+
+    def __init__(self, folder, fetch, max_bytes=200 * 1024 * 1024, memory_bytes=16 * 1024 * 1024,
+                 sizes=(320, 480), executor=None):
+        # fetch(video_id) -> байты оригинального превью
+        self.folder = folder
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.sizes = tuple(sizes) if Image is not None else ()
+        self.executor = executor
+
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # имя файла -> размер, в порядке обращений
+        self._memory = OrderedDict()  # имя файла -> Thumbnail
+        self._memory_size = 0
+        self._loading = {}
+        self._resizing = set()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.evictions = 0
+
+        os.makedirs(folder, exist_ok=True)
+        self._scan()
+
+    def get(self, video_id, width=None):
+        """Возвращает (Thumbnail, точный ли размер). Бросает исключение, если превью не скачать"""
+        if width is not None and width not in self.sizes:
+            width = None
+        if width is not None:
+            thumbnail = self._load(f"{video_id}_{width}")
+            if thumbnail is not None:
+                return thumbnail, True
+
+        original = self._load(video_id)
+        if original is None:
+            original = self._fetch(video_id)
+        if width is not None:
+            self._schedule_resize(video_id, width, original.data)
+        return original, width is None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._files),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'memory_bytes': self._memory_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'fetches': self.fetches,
+                'evictions': self.evictions,
+                'resize': bool(self.sizes),
+            }
+
+    def _scan(self):
+        entries = []
+        with os.scandir(self.folder) as items:
+            for item in items:
+                if item.is_file() and THUMBNAIL_NAME.match(item.name):
+                    stat = item.stat()
+                    entries.append((stat.st_atime, item.name, stat.st_size))
+        with self._lock:
+            for _, name, size in sorted(entries):
+                self._files[name] = size
+                self.total_bytes += size
+
+    def _load(self, name):
+        """Превью из памяти или с диска, None если его нет"""
+        with self._lock:
+            thumbnail = self._memory.get(name)
+            if thumbnail is not None:
+                self._memory.move_to_end(name)
+                self._files.move_to_end(name)
+                self.hits += 1
+                return thumbnail
+            on_disk = name in self._files
+            if on_disk:
+                self._files.move_to_end(name)
+        if not on_disk:
+            return None
+        try:
+            with open(os.path.join(self.folder, name), 'rb') as f:
+                thumbnail = Thumbnail(f.read())
+        except OSError:
+            # Файл удалили снаружи
+            with self._lock:
+                self.total_bytes -= self._files.pop(name, 0)
+            return None
+        with self._lock:
+            self.hits += 1
+            self._remember(name, thumbnail)
+        return thumbnail
+
+    def _fetch(self, video_id):
+        """Скачивает оригинал. Параллельные запросы одного превью ждут одно скачивание"""
+        with self._lock:
+            self.misses += 1
+            load_lock = self._loading.setdefault(video_id, threading.Lock())
+        with load_lock:
+            try:
+                thumbnail = self._load(video_id)
+                if thumbnail is not None:
+                    return thumbnail
+                with self._lock:
+                    self.fetches += 1
+                thumbnail = Thumbnail(self.fetch(video_id))
+                self._store(video_id, thumbnail)
+                return thumbnail
+            finally:
+                with self._lock:
+                    self._loading.pop(video_id, None)
+
+    def _store(self, name, thumbnail):
+        path = os.path.join(self.folder, name)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(thumbnail.data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self.total_bytes += len(thumbnail.data) - self._files.pop(name, 0)
+            self._files[name] = len(thumbnail.data)
+            self._remember(name, thumbnail)
+            evicted = self._evict()
+        for evicted_name in evicted:
+            try:
+                os.remove(os.path.join(self.folder, evicted_name))
+            except OSError:
+                pass
+
+    def _remember(self, name, thumbnail):
+        previous = self._memory.pop(name, None)
+        if previous is not None:
+            self._memory_size -= len(previous.data)
+        self._memory[name] = thumbnail
+        self._memory_size += len(thumbnail.data)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_size -= len(dropped.data)
+
+    def _evict(self):
+        """Самые давно запрошенные файлы сверх бюджета (под блокировкой)"""
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self.total_bytes -= size
+            dropped = self._memory.pop(name, None)
+            if dropped is not None:
+                self._memory_size -= len(dropped.data)
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
+
+    def _schedule_resize(self, video_id, width, data):
+        name = f"{video_id}_{width}"
+        with self._lock:
+            if name in self._resizing or self.executor is None:
+                return
+            self._resizing.add(name)
+        self.executor.submit(self._resize, name, width, data)
+
+    def _resize(self, name, width, data):
+        try:
+            image = Image.open(io.BytesIO(data))
+            if image.width > width:
+                image.thumbnail((width, image.height * width // image.width + 1))
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+            self._store(name, Thumbnail(output.getvalue()))
+        except Exception as e:
+            print(f"Ошибка при уменьшении превью {name}: {str(e)}")
+        finally:
+            with self._lock:
+                self._resizing.discard(name)
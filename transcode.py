@@ -0,0 +1,62 @@
+import subprocess
+
+from muxing import low_priority
+
+# Формат -> (кодек ffmpeg, формат контейнера ffmpeg, расширение файла)
+AUDIO_FORMATS = {
+    'mp3': ('libmp3lame', 'mp3', 'mp3'),
+    'opus': ('libopus', 'ogg', 'opus'),
+    'aac': ('aac', 'ipod', 'm4a'),
+}
+DEFAULT_BITRATE = 192  # kbps
+MIN_BITRATE = 32
+MAX_BITRATE = 320
+
+
+def audio_extension(audio_format):
+    return AUDIO_FORMATS[audio_format][2]
+
+
+def parse_audio_options(audio_format, audio_bitrate):
+    """Проверяет формат и битрейт из запроса. Возвращает (формат, битрейт) или бросает ValueError"""
+    if not audio_format:
+        return None, None
+    audio_format = str(audio_format).lower()
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"audio_format must be one of: {', '.join(AUDIO_FORMATS)}")
+    try:
+        bitrate = int(str(audio_bitrate or DEFAULT_BITRATE).lower().rstrip('k'))
+    except ValueError:
+        raise ValueError('audio_bitrate must be a number of kbps')
+    if not MIN_BITRATE <= bitrate <= MAX_BITRATE:
+        raise ValueError(f'audio_bitrate must be between {MIN_BITRATE} and {MAX_BITRATE} kbps')
+    return audio_format, bitrate
+
+
+def transcode_file(input_path, output_path, audio_format, bitrate, timeout=300, niceness=0):
+    """Перекодирует скачанное аудио из input_path.
+
+    Поток скачивается заранее, а не подается в ffmpeg по мере скачивания:
+    так слот перекодирования (ядро процессора) занят только на время
+    кодирования, а не всей загрузки.
+    """
+    codec, container, _ = AUDIO_FORMATS[audio_format]
+    cmd = [
+        'ffmpeg',
+        '-i', input_path,
+        '-vn',
+        '-c:a', codec,
+        '-b:a', f'{bitrate}k',
+        '-f', container,
+        '-y',
+        '-loglevel', 'error',
+        output_path
+    ]
+
+    try:
+        subprocess.run(low_priority(cmd, niceness), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, timeout=timeout, check=True)
+    except subprocess.TimeoutExpired:
+        raise Exception("Таймаут при перекодировании аудио")
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"Ошибка ffmpeg: {e.stderr.decode(errors='replace')}")
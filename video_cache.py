@@ -0,0 +1,148 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+from stream_selection import StreamIndex
+
+# Идентификатор видео YouTube - 11 символов из [A-Za-z0-9_-]
+VIDEO_ID = re.compile(r'[\w-]{11}')
+VIDEO_ID_PATTERN = re.compile(r'(?:v=|/shorts/|/embed/|/live/|/v/|/e/|/vi/|youtu\.be/)([\w-]{11})')
+
+
+def extract_video_id(url):
+    """Возвращает нормализованный ID видео или исходный URL, если ID не найден.
+
+    Результат - только ключ кэша: в именах файлов и ссылках используется
+    VideoInfo.video_id, который берется у извлеченного видео.
+    """
+    match = VIDEO_ID_PATTERN.search(url)
+    if match:
+        return match.group(1)
+    if VIDEO_ID.fullmatch(url):
+        return url
+    return url.strip()
+
+
+def stream_url_expiry(streams):
+    """Минимальное время истечения подписанных URL потоков (unix time) или None"""
+    expiry = None
+    for stream in streams:
+        try:
+            expire = parse_qs(urlparse(stream.url).query).get('expire')
+        except Exception:
+            continue
+        if expire:
+            value = int(expire[0])
+            expiry = value if expiry is None else min(expiry, value)
+    return expiry
+
+
+class VideoInfo:
+    """Метаданные видео и список потоков, извлеченные один раз"""
+
+    def __init__(self, video_id, yt):
+        # ID от pytubefix, а не из URL: он попадает в имена файлов и пути
+        self.video_id = getattr(yt, 'video_id', None) or video_id
+        if not isinstance(self.video_id, str) or not VIDEO_ID.fullmatch(self.video_id):
+            raise ValueError(f"Не удалось определить ID видео: {video_id}")
+        self.title = yt.title
+        self.author = yt.author
+        self.length = yt.length
+        self.views = yt.views
+        self.thumbnail_url = yt.thumbnail_url
+        self.streams = yt.streams
+        # Индекс для выбора потоков строится один раз и живет вместе с записью кэша
+        self.stream_index = StreamIndex(self.streams)
+
+
+class VideoInfoCache:
+    """LRU-кэш метаданных и манифестов потоков с TTL"""
+
+    def __init__(self, loader, max_entries=256, ttl=1800, expiry_margin=300):
+        # loader(url) -> объект с атрибутами YouTube (title, author, streams, ...)
+        self.loader = loader
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Запас до истечения подписанных URL, чтобы не отдать почти протухшие ссылки
+        self.expiry_margin = expiry_margin
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Блокировки на отдельные видео, чтобы параллельные промахи не извлекали одно и то же
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, url):
+        """Возвращает VideoInfo для URL, извлекая его с YouTube только при промахе"""
+        video_id = extract_video_id(url)
+
+        with self._lock:
+            info = self._lookup(video_id)
+            if info is not None:
+                self.hits += 1
+                return info
+            self.misses += 1
+            load_lock = self._loading.setdefault(video_id, threading.Lock())
+
+        with load_lock:
+            # Пока ждали, видео мог загрузить другой поток
+            with self._lock:
+                info = self._lookup(video_id)
+                if info is not None:
+                    return info
+
+            try:
+                info = VideoInfo(video_id, self.loader(url))
+                expires_at = time.time() + self.ttl
+                url_expiry = stream_url_expiry(info.streams)
+                if url_expiry is not None:
+                    expires_at = min(expires_at, url_expiry - self.expiry_margin)
+
+                with self._lock:
+                    self._entries[video_id] = (info, expires_at)
+                    self._entries.move_to_end(video_id)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+            finally:
+                with self._lock:
+                    self._loading.pop(video_id, None)
+
+            return info
+
+    def peek(self, url):
+        """VideoInfo из кэша без извлечения и без учета в статистике, None если его там нет"""
+        with self._lock:
+            return self._lookup(extract_video_id(url))
+
+    def invalidate(self, url):
+        """Удаляет видео из кэша (например, когда ссылки на потоки истекли)"""
+        with self._lock:
+            self._entries.pop(extract_video_id(url), None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
+
+    def _lookup(self, video_id):
+        entry = self._entries.get(video_id)
+        if entry is None:
+            return None
+        info, expires_at = entry
+        if time.time() >= expires_at:
+            del self._entries[video_id]
+            return None
+        self._entries.move_to_end(video_id)
+        return info